@@ -74,6 +74,8 @@ class Main:
     def init_modules(self, window, app):
         self.module_setting = self.ModuleSetting(window, app)
         self.module_log = self.ModuleLog(window, self.module_setting)
+        self.work_thd_pool = self.WorkerPool(window, app, self.module_log)
+        self.BaseModule.worker_pool = self.work_thd_pool
         self.module_e = self.ModuleE(window, self.module_setting, self.module_log)
         self.module_d = self.ModuleD(window, self.module_setting, self.module_log)
         self.module_s = self.ModuleS(window, self.module_setting, self.module_log)
@@ -87,62 +89,158 @@ class Main:
         self.module_stae = self.ModuleSTAE(window, self.module_setting, self.module_log)
         self.module_ctae = self.ModuleCTAE(window, self.module_setting, self.module_log)
         self.module_uyk = self.ModuleUploadYiKeAlbum(window, self.module_setting, self.module_log)
-        # TODO 原有module中有大量直接操作ui的代码，不能用下属线程启动方式
-        # self.work_thd_pool = self.ThdModule(self, self.module_log)
+        for k, v in self.__dict__.items():
+            if k.startswith("module") and isinstance(v, self.BaseModule):
+                self.work_thd_pool.connect_module(v)
 
     def run(self):
         self.window.show()
         sys.exit(self.app.exec())
 
-    class ThdModule:
+    '''
+    后台任务。耗时的模块操作放到 QThreadPool 中执行，进度、日志、结果和异常通过信号回到界面线程
+    任务函数的第一个参数是 Worker，通过 worker.log / worker.progress 上报，不能直接操作控件
+    '''
+    class WorkerSignals(QtCore.QObject):
+        progress = QtCore.Signal(int, float)
+        log = QtCore.Signal(int, str)
+        result = QtCore.Signal(int, object)
+        error = QtCore.Signal(int, str)
+        finished = QtCore.Signal(int)
+
+    class Worker(QtCore.QRunnable):
+        job_id: int = None
+        name: str = None
+        fn = None
+        args: tuple = None
+        kwargs: dict = None
+        signals = None
+
+        def __init__(self, job_id: int, name: str, fn, *args, **kwargs):
+            super().__init__()
+            self.job_id = job_id
+            self.name = name
+            self.fn = fn
+            self.args = args
+            self.kwargs = kwargs
+            # signals 在界面线程创建，工作线程中 emit 时自动排队到界面线程执行
+            self.signals = Main.WorkerSignals()
+            # 由 WorkerPool.jobs 持有，任务结束后再释放
+            self.setAutoDelete(False)
+
+        def run(self):
+            try:
+                result = self.fn(self, *self.args, **self.kwargs)
+            except Exception as e:
+                self.signals.log.emit(self.job_id, traceback.format_exc())
+                self.signals.error.emit(self.job_id, str(e))
+            else:
+                self.signals.result.emit(self.job_id, result)
+            finally:
+                self.signals.finished.emit(self.job_id)
+
+        def log(self, info: str):
+            self.signals.log.emit(self.job_id, info)
+
+        def progress(self, proc: float):
+            self.signals.progress.emit(self.job_id, proc)
+
+    class WorkerPool(QtCore.QObject):
 
+        window: QWidget = None
         log = None
-        instant = None
-        thd_pool = {}
+        pool: QtCore.QThreadPool = None
+        jobs: dict = None
+        job_index = 0
+        # 任务大多在等待 ffmpeg 和网络，线程数不按 cpu 核数限制
+        max_workers = 8
         global_progress_bar: QtWidgets.QProgressBar = None
 
-        def __init__(self, instant, log):
+        def __init__(self, window: QWidget, app: QtWidgets.QApplication, log, max_workers: int = None):
+            super().__init__()
+            self.window = window
             self.log = log
-            self.instant = instant
-            self.create_thd()
-            self.init_global_widget()
-            self.instant.app.aboutToQuit.connect(self.destory)
-
-        def destory(self):
-            for k, v in self.thd_pool.items():
-                v.exit()
-
-        def create_thd(self):
-            attrs: dict = self.instant.__dict__
-            for k, v in attrs.items():
-                if "module" in k and hasattr(v, "moveToThread"):
-                    thd = QtCore.QThread()
-                    self.thd_pool[k] = thd
-                    self.log.write_log("{} create thd.".format(k))
-                    v.moveToThread(thd)
-                    thd.start()
-
-        def init_global_widget(self):
-            self.global_progress_bar = self.instant.window.globalProgressBar
-            attrs: dict = self.instant.__dict__
-            for k, v in attrs.items():
-                if "module" in k and hasattr(v, "signal_global_progress_rece"):
-                    v.signal_global_progress_rece.connect(self.slot_global_progress_rece)
-                    v.signal_global_msg_box_send.connect(self.slot_global_msg_box_rece)
+            self.jobs = {}
+            self.job_index = 0
+            if max_workers is not None:
+                self.max_workers = max_workers
+            self.pool = QtCore.QThreadPool()
+            self.pool.setMaxThreadCount(max(self.max_workers, QtCore.QThread.idealThreadCount()))
+            self.global_progress_bar = window.findChild(QtWidgets.QProgressBar, "globalProgressBar")
+            app.aboutToQuit.connect(self.destroy)
+
+        def destroy(self):
+            # 还没开始的任务直接丢弃，正在运行的任务随进程退出
+            self.pool.clear()
+
+        # 返回 Worker，on_result / on_error / on_finished 都在界面线程中调用
+        def submit(self, name: str, fn, *args, on_result=None, on_error=None, on_finished=None, **kwargs):
+            self.job_index += 1
+            worker = Main.Worker(self.job_index, name, fn, *args, **kwargs)
+            worker.signals.progress.connect(self.slot_progress)
+            worker.signals.log.connect(self.slot_log)
+            worker.signals.result.connect(self.slot_result)
+            worker.signals.error.connect(self.slot_error)
+            worker.signals.finished.connect(self.slot_finished)
+            # 持有引用直到任务结束，避免 signals 被提前回收
+            self.jobs[worker.job_id] = (worker, on_result, on_error, on_finished)
+            self.log.write_log("job {} {} submitted, {} running".format(worker.job_id, name, len(self.jobs)))
+            self.pool.start(worker)
+            return worker
+
+        def running_jobs(self) -> list:
+            return [job[0].name for job in self.jobs.values()]
+
+        # 模块自己的进度和提示信号也统一由这里显示
+        def connect_module(self, module):
+            module.signal_global_progress_rece.connect(self.slot_global_progress_rece)
+            module.signal_global_msg_box_send.connect(self.slot_global_msg_box_rece)
+
+        def slot_progress(self, job_id: int, proc: float):
+            self.slot_global_progress_rece(proc)
+
+        def slot_log(self, job_id: int, info: str):
+            job = self.jobs.get(job_id)
+            name = job[0].name if job is not None else ""
+            self.log.write_log("[{}] {}".format(name, info))
+
+        def slot_result(self, job_id: int, result):
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            self.log.write_log("job {} {} done".format(job_id, job[0].name))
+            if job[1] is not None:
+                job[1](result)
+
+        def slot_error(self, job_id: int, msg: str):
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            self.log.write_log("job {} {} failed {}".format(job_id, job[0].name, msg))
+            if job[2] is not None:
+                job[2](msg)
+            else:
+                QtWidgets.QMessageBox.critical(self.window, "error", msg)
+
+        def slot_finished(self, job_id: int):
+            job = self.jobs.pop(job_id, None)
+            if job is not None and job[3] is not None:
+                job[3]()
 
         def slot_global_progress_rece(self, proc):
-            val = proc * 100
+            val = int(proc * 100)
             if val >= 100:
                 val = 100
             self.global_progress_bar.setValue(val)
 
         def slot_global_msg_box_rece(self, title: str, msg: str):
-            QtWidgets.QMessageBox.information(self.instant.window, title, msg)
+            QtWidgets.QMessageBox.information(self.window, title, msg)
 
     class BaseModule(QtCore.QObject):
         parent: QWidget
         setting = None
         log = None
+        worker_pool = None
         signal_global_progress_rece = QtCore.Signal(float)
         signal_global_msg_box_send = QtCore.Signal(str, str)
 
@@ -213,9 +311,35 @@ class Main:
         def progress_bar_increase(self, proc):
             self.signal_global_progress_rece.emit(proc)
 
+        # ffmpeg 切割进度回调，在模块线程中执行，整个文件的完成比例通过信号显示到全局进度条
+        def split_progress(self, file_name: str, segment, stats: dict):
+            if segment is None:
+                self.progress_bar_increase(stats["percent"])
+
+        # config.ini [encrypt] fileWorkers 为目录加密解密时同时处理的文件数，为空时由 MediaEncrypt 按 cpu 核数和缓冲区上限决定
+        def get_file_workers(self) -> int:
+            val = self.setting.get_config("fileWorkers", "encrypt")
+            if val is None or val == "":
+                self.setting.set_config("fileWorkers", "", "encrypt")
+                return None
+            return int(val)
+
         def msg_box(self, titile: str, msg: str):
             self.signal_global_msg_box_send.emit(titile, msg)
 
+        # 耗时任务交给线程池，控件的值要在提交前读出来。运行期间禁用 button，避免重复启动
+        def start_job(self, name: str, fn, *args, button: QtWidgets.QAbstractButton = None, on_result=None,
+                      on_error=None, **kwargs):
+            if button is not None:
+                button.setEnabled(False)
+
+            def on_finished():
+                if button is not None:
+                    button.setEnabled(True)
+
+            return self.worker_pool.submit(name, fn, *args, on_result=on_result, on_error=on_error,
+                                           on_finished=on_finished, **kwargs)
+
     class ModuleSetting:
         setting_db_path_tool_btn: QToolButton
         setting_db_path_text_line: QLineEdit
@@ -394,6 +518,8 @@ class Main:
 
         log_plain_text_edit: QtWidgets.QPlainTextEdit
         log_index = 1
+        # 任意线程都可以写日志，经信号排队到界面线程再追加到控件
+        signal_log = QtCore.Signal(str)
 
         def __init__(self, window: QWidget, setting):
             super().__init__(window, setting, None)
@@ -404,9 +530,12 @@ class Main:
             self.log_plain_text_edit = self.parent.findChild(QtWidgets.QPlainTextEdit, "logPlainTextEdit")
 
         def connect_slots(self):
-            pass
+            self.signal_log.connect(self.slot_append_log, QtCore.Qt.QueuedConnection)
 
         def write_log(self, info):
+            self.signal_log.emit(info)
+
+        def slot_append_log(self, info: str):
             self.log_plain_text_edit.appendPlainText(str(self.log_index) + " | " + info)
             self.log_index += 1
 
@@ -442,10 +571,14 @@ class Main:
             if key == "":
                 QtWidgets.QMessageBox.critical(self.parent, "error", "key is required.")
                 return
-            self.write_log("start in dir {}".format(self.setting.source_dir))
-            e = main.MediaEncrypt(self.setting.db_con)
-            e.encrypt_files_with_subfix_by_group(key, self.setting.source_dir, self.setting.dest_dir)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            self.start_job("encrypt", self.__encrypt_job__, key, self.setting.source_dir, self.setting.dest_dir,
+                           self.get_file_workers(), button=self.e_start_btn)
+
+        def __encrypt_job__(self, worker, key: str, source_dir: str, dest_dir: str, file_workers: int):
+            worker.log("start in dir {}".format(source_dir))
+            e = main.MediaEncrypt(self.setting.db_con, file_workers=file_workers)
+            e.encrypt_files_with_subfix_by_group(key, source_dir, dest_dir)
+            worker.log("done in dir {}".format(dest_dir))
 
     class ModuleD(BaseModule):
 
@@ -469,16 +602,15 @@ class Main:
             if key == "":
                 QtWidgets.QMessageBox.critical(self.parent, "error", "key is required.")
                 return
-            e = main.MediaEncrypt(self.setting.db_con)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
-            try:
-                e.decrypt_files(key, self.setting.source_dir, self.setting.dest_dir)
-            except Exception as e:
-                self.write_log(str(e))
-                QtWidgets.QMessageBox.critical(self.parent, "error", str(e.with_traceback()))
-                return
-            self.write_log("done in dir,l {}".format(self.setting.dest_dir))
-            QtWidgets.QMessageBox.information(self.parent, "info", "done")
+            self.start_job("decrypt", self.__decrypt_job__, key, self.setting.source_dir, self.setting.dest_dir,
+                           self.get_file_workers(), button=self.d_start_btn,
+                           on_result=lambda r: QtWidgets.QMessageBox.information(self.parent, "info", "done"))
+
+        def __decrypt_job__(self, worker, key: str, source_dir: str, dest_dir: str, file_workers: int):
+            e = main.MediaEncrypt(self.setting.db_con, file_workers=file_workers)
+            worker.log("start in dir {}".format(source_dir))
+            e.decrypt_files(key, source_dir, dest_dir)
+            worker.log("done in dir {}".format(dest_dir))
 
     class ModuleS(BaseModule):
 
@@ -508,10 +640,14 @@ class Main:
             if file_size == "":
                 QtWidgets.QMessageBox.critical(self.parent, "error", "key is required.")
                 return
-            s = main.Spliter(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir, file_size)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
+            self.start_job("split", self.__split_job__, self.setting.source_dir, self.setting.dest_dir, file_size,
+                           exclude_files, button=self.s_start_btn)
+
+        def __split_job__(self, worker, source_dir: str, dest_dir: str, file_size: int, exclude_files: list):
+            s = main.Spliter(self.setting.db_con, source_dir, dest_dir, file_size)
+            worker.log("start in dir {}".format(source_dir))
             s.split_dir(exclude_files)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            worker.log("done in dir {}".format(dest_dir))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog\
@@ -537,10 +673,14 @@ class Main:
         def slot_start(self):
             if not self.is_setting():
                 return
-            c = main.Combo(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
+            self.start_job("combo", self.__combo_job__, self.setting.source_dir, self.setting.dest_dir,
+                           button=self.c_start_btn)
+
+        def __combo_job__(self, worker, source_dir: str, dest_dir: str):
+            c = main.Combo(self.setting.db_con, source_dir, dest_dir)
+            worker.log("start in dir {}".format(source_dir))
             c.combo_dir()
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            worker.log("done in dir {}".format(dest_dir))
 
     class ModuleSF(BaseModule):
 
@@ -573,11 +713,16 @@ class Main:
             exclude_files = []
             for i in range(0, self.sf_exclude_files_list_widget.count()):
                 exclude_files.append(self.sf_exclude_files_list_widget.item(i).text())
-            sf = main.Spliter(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir, 0)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
+            self.start_job("split ffmpeg", self.__split_ffmpeg_job__, self.setting.source_dir, self.setting.dest_dir,
+                           exclude_files, max_size, ffmpeg_cmd, button=self.sf_start_btn,
+                           on_result=lambda r: QtWidgets.QMessageBox.information(self.parent, "info", "done"))
+
+        def __split_ffmpeg_job__(self, worker, source_dir: str, dest_dir: str, exclude_files: list, max_size: int,
+                                 ffmpeg_cmd: str):
+            sf = main.Spliter(self.setting.db_con, source_dir, dest_dir, 0, progress_callback=self.split_progress)
+            worker.log("start in dir {}".format(source_dir))
             sf.split_dir_with_ffmpeg_fixed_size(exclude_files, max_size, ffmpeg_cmd)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
-            QtWidgets.QMessageBox.information(self.parent, "info", "done")
+            worker.log("done in dir {}".format(dest_dir))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog\
@@ -610,10 +755,14 @@ class Main:
             if ffmpeg_cmd == "":
                 QtWidgets.QMessageBox.critical(self.parent, "error", "ffmpeg cmd is required.")
                 return
-            sf = main.Combo(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
+            self.start_job("combo ffmpeg", self.__combo_ffmpeg_job__, self.setting.source_dir, self.setting.dest_dir,
+                           ffmpeg_cmd, button=self.cfct_start_btn)
+
+        def __combo_ffmpeg_job__(self, worker, source_dir: str, dest_dir: str, ffmpeg_cmd: str):
+            sf = main.Combo(self.setting.db_con, source_dir, dest_dir)
+            worker.log("start in dir {}".format(source_dir))
             sf.combo_dir_with_ffmpeg(ffmpeg_cmd)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            worker.log("done in dir {}".format(dest_dir))
 
     class ModuleST(BaseModule):
 
@@ -647,10 +796,15 @@ class Main:
             exclude_files = []
             for i in range(0, self.st_exclude_files_list_widget.count()):
                 exclude_files.append(self.st_exclude_files_list_widget.item(i).text())
-            sf = main.Spliter(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir, 0)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
+            self.start_job("split translate", self.__split_translate_job__, self.setting.source_dir,
+                           self.setting.dest_dir, exclude_files, duration, ffmpeg_cmd, button=self.st_start_btn)
+
+        def __split_translate_job__(self, worker, source_dir: str, dest_dir: str, exclude_files: list, duration: int,
+                                    ffmpeg_cmd: str):
+            sf = main.Spliter(self.setting.db_con, source_dir, dest_dir, 0, progress_callback=self.split_progress)
+            worker.log("start in dir {}".format(source_dir))
             sf.split_dir_with_translate(exclude_files, duration, ffmpeg_cmd)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            worker.log("done in dir {}".format(dest_dir))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog \
@@ -692,10 +846,15 @@ class Main:
             exclude_files = []
             for i in range(0, self.sae_exclude_files_list_widget.count()):
                 exclude_files.append(self.sae_exclude_files_list_widget.item(i).text())
-            sae = main.SplitAndEncrypt(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir, key, file_size)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
+            self.start_job("split and encrypt", self.__split_and_encrypt_job__, self.setting.source_dir,
+                           self.setting.dest_dir, key, file_size, exclude_files, button=self.sae_start_btn)
+
+        def __split_and_encrypt_job__(self, worker, source_dir: str, dest_dir: str, key: str, file_size: int,
+                                      exclude_files: list):
+            sae = main.SplitAndEncrypt(self.setting.db_con, source_dir, dest_dir, key, file_size)
+            worker.log("start in dir {}".format(source_dir))
             sae.split_and_encrypt_dir(exclude_files)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            worker.log("done in dir {}".format(dest_dir))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog \
@@ -733,10 +892,14 @@ class Main:
             exclude_files = []
             for i in range(0, self.cae_exclude_files_list_widget.count()):
                 exclude_files.append(self.cae_exclude_files_list_widget.item(i).text())
-            sae = main.SplitAndEncrypt(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir, key)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
+            self.start_job("decrypt and combo", self.__decrypt_and_combo_job__, self.setting.source_dir,
+                           self.setting.dest_dir, key, exclude_files, button=self.cae_start_btn)
+
+        def __decrypt_and_combo_job__(self, worker, source_dir: str, dest_dir: str, key: str, exclude_files: list):
+            sae = main.SplitAndEncrypt(self.setting.db_con, source_dir, dest_dir, key)
+            worker.log("start in dir {}".format(source_dir))
             sae.decrypt_and_combo_dir(exclude_files)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            worker.log("done in dir {}".format(dest_dir))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog \
@@ -783,18 +946,19 @@ class Main:
             is_check_name_repeate = self.sfae_tr_cb.isChecked()
             for i in range(0, self.sfae_exclude_files_list_widget.count()):
                 exclude_files.append(self.sfae_exclude_files_list_widget.item(i).text())
-            stae = main.SplitAndEncrypt(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir, key)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
-            try:
-                stae.split_ffmpeg_and_encrypt_dir_fixed_size(exclude_files, max_size, ffmpeg_cmd, is_check_name_repeate)
-            except Exception as e:
-                QtWidgets.QMessageBox.critical(self.parent, "error", str(e))
-                self.write_log(str(e.args))
-                self.write_log(traceback.format_exc())
-                print(traceback.format_exc())
-                return
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
-            QtWidgets.QMessageBox.information(self.parent, "info", "done")
+            self.start_job("split ffmpeg and encrypt", self.__split_ffmpeg_and_encrypt_job__, self.setting.source_dir,
+                           self.setting.dest_dir, key, exclude_files, max_size, ffmpeg_cmd, is_check_name_repeate,
+                           button=self.sfae_start_btn,
+                           on_result=lambda r: QtWidgets.QMessageBox.information(self.parent, "info", "done"))
+
+        def __split_ffmpeg_and_encrypt_job__(self, worker, source_dir: str, dest_dir: str, key: str,
+                                             exclude_files: list, max_size: int, ffmpeg_cmd: str,
+                                             is_check_name_repeate: bool):
+            stae = main.SplitAndEncrypt(self.setting.db_con, source_dir, dest_dir, key,
+                                        progress_callback=self.split_progress)
+            worker.log("start in dir {}".format(source_dir))
+            stae.split_ffmpeg_and_encrypt_dir_fixed_size(exclude_files, max_size, ffmpeg_cmd, is_check_name_repeate)
+            worker.log("done in dir {}".format(dest_dir))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog \
@@ -842,16 +1006,18 @@ class Main:
             exclude_files = []
             for i in range(0, self.stae_exclude_files_list_widget.count()):
                 exclude_files.append(self.stae_exclude_files_list_widget.item(i).text())
-            stae = main.SplitAndEncrypt(self.setting.db_con, self.setting.source_dir, self.setting.dest_dir, key)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
-            try: 
-                stae.split_translate_and_encrypt_dir(exclude_files, duration, ffmpeg_cmd)
-            except Exception as e:
-                QtWidgets.QMessageBox.critical(self.parent, "error", str(e))
-                self.write_log(str(e.with_traceback(sys.exc_info())))
-                return
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
-            QtWidgets.QMessageBox.critical(self.parent, "info", "done")
+            self.start_job("split translate and encrypt", self.__split_translate_and_encrypt_job__,
+                           self.setting.source_dir, self.setting.dest_dir, key, exclude_files, duration, ffmpeg_cmd,
+                           button=self.stae_start_btn,
+                           on_result=lambda r: QtWidgets.QMessageBox.information(self.parent, "info", "done"))
+
+        def __split_translate_and_encrypt_job__(self, worker, source_dir: str, dest_dir: str, key: str,
+                                                exclude_files: list, duration: int, ffmpeg_cmd: str):
+            stae = main.SplitAndEncrypt(self.setting.db_con, source_dir, dest_dir, key,
+                                        progress_callback=self.split_progress)
+            worker.log("start in dir {}".format(source_dir))
+            stae.split_translate_and_encrypt_dir(exclude_files, duration, ffmpeg_cmd)
+            worker.log("done in dir {}".format(dest_dir))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog \
@@ -935,11 +1101,23 @@ class Main:
         uyk_pl_search_index = {}
 
         uyk_signal_ul_progress_bar = QtCore.Signal(float)
+        # 预取流水线在线程池中运行，每个分段就绪时通过信号回到界面线程，结束和异常由任务回调处理
+        uyk_signal_pl_part_ready = QtCore.Signal(int, int, str, str)
+        uyk_signal_pl_stopped = QtCore.Signal(object)
 
         play_file_dict = None
         cache_db = None
         vlc_play_list: vlc.MediaList = None
         vlc_player: vlc.MediaListPlayer = None
+        pl_pipeline: main.PrefetchPipeline = None
+        pl_first_part_path: str = None
+        pl_prefetch = 3
+        stream_server: main.DecryptStreamServer = None
+        # 当前播放注册的解密流，停止播放或切换相册时注销
+        pl_stream_urls: list = None
+        preview_cache: main.PreviewCache = None
+        # config.ini [cache] previewMaxMb 预览缓存上限
+        preview_cache_default_max_mb = 10240
 
         def __init__(self, window: QWidget, setting, log):
             # Main.BaseModule.__init__(self, window, setting, log)
@@ -949,9 +1127,28 @@ class Main:
             # self.log = log
             # self.get_widget()
             # self.connect_slots()
+            self.pl_stream_urls = []
             self.cache_db = self.CacheDbCon(self.write_log)
+            self.preview_cache = self.__init_preview_cache__()
             self.slot_pl_album_select()
 
+        # preview/ 的加密分段和 thumb/ 的缩略图共用一个按字节数限制的 LRU 缓存
+        def __init_preview_cache__(self) -> main.PreviewCache:
+            max_mb = self.setting.get_config("previewMaxMb", "cache")
+            if max_mb is None or max_mb == "":
+                max_mb = self.preview_cache_default_max_mb
+                self.setting.set_config("previewMaxMb", max_mb, "cache")
+            preview_cache = main.PreviewCache("cache/cache.db", int(max_mb) * 1024 * 1024)
+            for dir_name in ["preview", "thumb"]:
+                preview_cache.add_dir(os.path.join(os.getcwd(), dir_name))
+            freed = preview_cache.evict()
+            self.write_log("preview cache {} bytes, evicted {} bytes".format(preview_cache.total_size(), freed))
+            return preview_cache
+
+        @staticmethod
+        def __thumb_name__(new_name: str) -> str:
+            return new_name + "de.jpg"
+
         def get_widget(self):
             self.uyk_dir_line_edit = self.parent.findChild(QtWidgets.QLineEdit, "uykDirLineEdit")
             self.uyk_dir_tool_btn = self.parent.findChild(QtWidgets.QToolButton, "uykDirToolBtn")
@@ -992,7 +1189,7 @@ class Main:
 
         def connect_slots(self):
             self.uyk_dir_tool_btn.clicked.connect(self.slot_set_dir)
-            # self.uyk_start_btn.clicked.connect(self.slot_start)
+            self.uyk_start_btn.clicked.connect(self.slot_start)
             self.uyk_exclude_files_list_widget.doubleClicked.connect(self.slot_add_exclude_file)
             self.uyk_album_fetch_btn.clicked.connect(self.slot_list_album)
             self.uyk_dl_list_albums_btn.clicked.connect(self.slot_dl_list_album)
@@ -1014,6 +1211,8 @@ class Main:
             self.uyk_pl_load_db_push_button.clicked.connect(self.slot_pl_load_db)
             self.uyk_pl_db_list_widget.itemClicked.connect(self.slot_pl_set_album)
             self.uyk_pl_regenerate_album_push_button.clicked.connect(self.slot_pl_regenerate_album)
+            self.uyk_signal_pl_part_ready.connect(self.slot_pl_part_ready)
+            self.uyk_signal_pl_stopped.connect(self.slot_pl_stopped)
 
         def slot_set_dir(self):
             dir_path = QFileDialog.getExistingDirectory(self.parent)
@@ -1036,14 +1235,17 @@ class Main:
                 exclude_files.append(self.uyk_exclude_files_list_widget.item(i).text())
             album = self.uyk_albums_combo_box.currentText()
             uyk_client = self.__get_uky_client__(cookies)
-            self.write_log("start in dir {}".format(self.setting.source_dir))
             if album == "None":
                 album_name = None
             else:
                 album_name = album
-            uyk_client.upload_dirs_qt(dir_path, exclude_files, album_name,
-                                      self.progress_bar_increase)
-            self.write_log("done in dir {}".format(self.setting.dest_dir))
+            self.start_job("upload", self.__upload_job__, uyk_client, dir_path, exclude_files, album_name,
+                           button=self.uyk_start_btn)
+
+        def __upload_job__(self, worker, uyk_client, dir_path: str, exclude_files: list, album_name: str):
+            worker.log("start in dir {}".format(dir_path))
+            uyk_client.upload_dirs_qt(dir_path, exclude_files, album_name, worker.progress)
+            worker.log("done in dir {}".format(dir_path))
 
         def slot_add_exclude_file(self):
             input_file_name, ok = QtWidgets.QInputDialog \
@@ -1137,26 +1339,38 @@ class Main:
             selected_item = selected_items[0]
             item_title = selected_item.text()
             preview_type = self.uyk_dl_select_preview_type_combo_box.currentText()
+            key = self.uyk_pl_key_line_edit.text()
+            if key == "":
+                QtWidgets.QMessageBox.information(self.parent, "error", "key is required.")
+                return
             uyk_client = self.__get_uky_client__(cookies)
             self.write_log("play item {}".format(item_title))
             item = self.uyk_dl_client_items_dict[item_title]
+
+            def on_result(decrypt_file_path: str):
+                if preview_type == "Play":
+                    uyk_client.play(decrypt_file_path)
+                else:
+                    os.startfile(dest_dir)
+                QtWidgets.QMessageBox.information(self.parent, "success", "downloaded.")
+
+            self.start_job("download", self.__download_job__, uyk_client, item, item_title, dest_dir, key,
+                           on_result=on_result)
+
+        def __download_job__(self, worker, uyk_client, item, item_title: str, dest_dir: str, key: str) -> str:
             uyk_client.download(item, dest_dir)
             file_path = "/".join([dest_dir, item_title.replace("/youa/web/", "")])
-            decrypt_file_path = file_path.join("de")
-            self.__decrypt__(file_path, decrypt_file_path)
-            if preview_type == "Play":
-                uyk_client.play(decrypt_file_path)
-            else:
-                os.startfile(dest_dir)
-            QtWidgets.QMessageBox.information(self.parent, "success", "downloaded.")
-            self.write_log("play {} done".format(file_path))
+            decrypt_file_path = file_path + "de"
+            self.__decrypt__(key, file_path, decrypt_file_path)
+            worker.log("download {} done".format(file_path))
+            return decrypt_file_path
 
-        def __decrypt__(self, source_file_path, dest_file_path):
-            key = self.uyk_pl_key_line_edit.text()
-            if key == "":
-                QtWidgets.QMessageBox.information(self.parent, "error", "key is required.")
+        def __decrypt__(self, key, source_file_path, dest_file_path):
             d = main.MediaEncrypt(self.setting.db_con)
-            d.decrypt_file(key, source_file_path, dest_file_path)
+            try:
+                d.decrypt_file(key, source_file_path, dest_file_path)
+            finally:
+                d.release_buffers()
 
         def slot_set_dest_dir(self):
             dest_dir_path = QFileDialog.getExistingDirectory(self.parent)
@@ -1244,21 +1458,52 @@ class Main:
             else:
                 self.__do_play_file__(pl_file_path)
 
+        # 通过本地解密流播放，不再把整个文件解密到磁盘
         def __do_play_file__(self, encrypt_file_path: str):
-            decrypt_file_path = encrypt_file_path + "de"
-            self.__decrypt__(encrypt_file_path, decrypt_file_path)
+            key = self.uyk_pl_key_line_edit.text()
+            self.__stop_playback__()
+            stream_url = self.__get_stream_server__().add_stream(key, [encrypt_file_path])
+            self.pl_stream_urls.append(stream_url)
             cookies = self.uyk_cookies_plain_text_edit.toPlainText()
             self.uyk_client = self.__get_uky_client__(cookies)
-            thumb_pic_path = self.uyk_client.generate_thumbnail(decrypt_file_path, "/")
+            thumb_pic_path = self.uyk_client.generate_thumbnail(stream_url, "/")
+            if os.path.exists(thumb_pic_path):
+                self.preview_cache.put(thumb_pic_path)
             # self.uyk_client.play(decrypt_file_path)
-            self.__play_media_list_potplayer([decrypt_file_path])
+            self.__play_media_list_potplayer([stream_url])
             return thumb_pic_path
 
+        def __get_stream_server__(self) -> main.DecryptStreamServer:
+            if self.stream_server is None:
+                self.stream_server = main.DecryptStreamServer()
+                self.stream_server.start()
+            return self.stream_server
+
+        # 停止当前播放并注销它的解密流
+        def __stop_playback__(self):
+            if self.pl_pipeline is not None:
+                self.pl_pipeline.cancel()
+                self.pl_pipeline = None
+            if self.vlc_player is not None:
+                vlc_player = self.vlc_player
+                self.vlc_player = None
+                vlc_player.stop()
+            self.__release_streams__()
+
+        def __release_streams__(self):
+            stream_urls = self.pl_stream_urls
+            self.pl_stream_urls = []
+            if self.stream_server is not None:
+                for stream_url in stream_urls:
+                    self.stream_server.remove_stream(stream_url)
+
         def __do_play_item__(self, item_title: str, count: int):
             cookies = self.uyk_cookies_plain_text_edit.toPlainText()
             if cookies == "":
                 QtWidgets.QMessageBox.critical(self.parent, "error", "cookies is required.")
                 return
+            key = self.uyk_pl_key_line_edit.text()
+            stream_server = self.__get_stream_server__()
             preview_dir = os.path.join(os.getcwd(), "preview")
             if not os.path.exists(preview_dir):
                 os.mkdir(preview_dir)
@@ -1269,69 +1514,88 @@ class Main:
             if metas is None:
                 QtWidgets.QMessageBox.critical(self.parent, "error", "not found in metas.")
                 return
-            play_list = []
-            index = 0
+            # 缓存库只能在界面线程访问，先查出全部分段再交给流水线
+            parts = []
+            for meta in metas:
+                new_name = meta[2]
+                new_name = new_name.replace("-", "_").replace(" ", "_")
+                local_item = self.cache_db.get_item_by_file_name(new_name)
+                if local_item is None:
+                    self.write_log("item {} not found in album.".format(item_title))
+                    self.msg_box("error", "item {} not found in album.".format(item_title))
+                    return
+                parts.append((self.uyk_dl_client_items_dict.get(local_item[2]), os.path.join(preview_dir, new_name)))
             self.progress_bar_increase(0.01)
-            selected_player = self.uyk_pl_player_select_combo_box.currentText()
-            if selected_player == "VLC":
-                for meta in metas:
-                    new_name = meta[2]
-                    new_name = new_name.replace("-", "_").replace(" ", "_")
-                    local_item = self.cache_db.get_item_by_file_name(new_name)
-                    if local_item is None:
-                        self.write_log("item {} not found in album.".format(item_title))
-                        self.msg_box("error", "item {} not found in album.".format(item_title))
-                        return
-                    self.write_log("start download {}.".format(local_item[2]))
-                    item = self.uyk_dl_client_items_dict.get(local_item[2])
-                    file_path = os.path.join(preview_dir, new_name)
-                    if not os.path.exists(file_path):
-                        uyk_client.download(item, preview_dir)
-                        self.write_log("downloading in {}".format(file_path))
-                    decrypt_file_path = file_path + "de"
-                    if not os.path.exists(decrypt_file_path):
-                        self.__decrypt__(file_path, decrypt_file_path)
-                        self.write_log("decrypt in {}".format(decrypt_file_path))
-                    # uyk_client.play(decrypt_file_path)
-                    if self.vlc_player is not None and self.vlc_player.is_playing():
-                        self.__add_media_list_vlc(decrypt_file_path)
-                    else:
-                        self.__play_media_list_vlc([decrypt_file_path])
-                        self.__set_thumb__(decrypt_file_path)
-                    self.write_log("play {} done".format(file_path))
-                    play_list.append(decrypt_file_path)
-                    index += 1
-                    self.progress_bar_increase(index/len(metas))
-            else:
-                for meta in metas:
-                    new_name = meta[2]
-                    new_name = new_name.replace("-", "_").replace(" ", "_")
-                    local_item = self.cache_db.get_item_by_file_name(new_name)
-                    if local_item is None:
-                        self.write_log("item {} not found in album.".format(item_title))
-                        self.msg_box("error", "item {} not found in album.".format(item_title))
-                        return
-                    self.write_log("start download {}.".format(local_item[2]))
-                    item = self.uyk_dl_client_items_dict.get(local_item[2])
-                    file_path = os.path.join(preview_dir, new_name)
-                    if not os.path.exists(file_path):
-                        uyk_client.download(item, preview_dir)
-                        self.write_log("downloading in {}".format(file_path))
-                    decrypt_file_path = file_path + "de"
-                    if not os.path.exists(decrypt_file_path):
-                        self.__decrypt__(file_path, decrypt_file_path)
-                        self.write_log("decrypt in {}".format(decrypt_file_path))
-                    # uyk_client.play(decrypt_file_path)
-                    self.write_log("play {} done".format(file_path))
-                    play_list.append(decrypt_file_path)
-                    index += 1
-                    self.progress_bar_increase(index/len(metas))
-            # self.__play_media_list_potplayer(play_list)
-            # self.__play_media_list_vlc(play_list)
-                self.__do_player__(play_list)
-                self.__set_thumb__(play_list[0])
+
+            preview_cache = self.preview_cache
+            # 正在播放的分段不参与淘汰
+            preview_cache.pin([part[1] for part in parts])
+            self.__stop_playback__()
+            stream_urls = self.pl_stream_urls
+
+            # 命中缓存的分段不再下载
+            def download(part):
+                item, file_path = part
+                if not preview_cache.get(file_path):
+                    uyk_client.download(item, preview_dir)
+                    preview_cache.put(file_path)
+                return file_path
+
+            # 下载完成的加密分段直接通过本地解密流播放，明文不落盘
+            # 先登记再检查取消，被新的播放取消后注册的流由这里注销
+            def decrypt(part, file_path):
+                stream_url = stream_server.add_stream(key, [file_path])
+                stream_urls.append(stream_url)
+                if pipeline.cancelled.is_set():
+                    stream_server.remove_stream(stream_url)
+                return stream_url
+
+            pipeline = main.PrefetchPipeline(download, decrypt, self.pl_prefetch)
+            self.pl_pipeline = pipeline
+            self.start_job("play", self.__run_play_pipeline__, pipeline, parts, on_result=self.slot_pl_done,
+                           on_error=self.slot_pl_error)
+
+        # 被新的播放取消时返回 None
+        def __run_play_pipeline__(self, worker, pipeline: main.PrefetchPipeline, parts: list):
+            play_list = pipeline.run(parts, lambda index, part, decrypt_file_path:
+                                     self.uyk_signal_pl_part_ready.emit(index, len(parts), decrypt_file_path, part[1]))
+            if pipeline.cancelled.is_set():
+                return None
             return play_list
 
+        # VLC 在第一个分段就绪时开始播放，之后的分段追加到播放列表
+        def slot_pl_part_ready(self, index: int, count: int, decrypt_file_path: str, encrypt_file_path: str):
+            self.write_log("stream in {}".format(decrypt_file_path))
+            if index == 0:
+                self.pl_first_part_path = encrypt_file_path
+            if self.uyk_pl_player_select_combo_box.currentText() == "VLC":
+                if index > 0 and self.vlc_player is not None:
+                    self.__add_media_list_vlc(decrypt_file_path)
+                else:
+                    self.__play_media_list_vlc([decrypt_file_path])
+                    self.__set_thumb__(decrypt_file_path, encrypt_file_path)
+            self.progress_bar_increase((index + 1) / count)
+
+        # 其他播放器只能一次传入完整的播放列表
+        def slot_pl_done(self, play_list: list):
+            if play_list is None:
+                return
+            self.write_log("play list {} ready".format(len(play_list)))
+            if self.uyk_pl_player_select_combo_box.currentText() != "VLC" and len(play_list) > 0:
+                self.__do_player__(play_list)
+                self.__set_thumb__(play_list[0], self.pl_first_part_path)
+
+        # 只处理当前播放器，被新播放替换掉的播放器已经在 __stop_playback__ 中注销过
+        def slot_pl_stopped(self, player):
+            if player is not self.vlc_player:
+                return
+            self.write_log("play stopped")
+            self.__release_streams__()
+
+        def slot_pl_error(self, msg: str):
+            self.write_log("play failed {}".format(msg))
+            self.msg_box("error", msg)
+
         def __do_player__(self, media_path_list: list):
             selected_player = self.uyk_pl_player_select_combo_box.currentText()
             if selected_player == "VLC":
@@ -1339,12 +1603,17 @@ class Main:
             else:
                 self.__play_media_list_potplayer(media_path_list)
 
-        def __set_thumb__(self, media_path: str):
-            file_name = os.path.split(media_path)[-1]
-            if not os.path.exists(os.path.join(os.getcwd(), "thumb", file_name)):
-                thumb_pic_path = self.uyk_client.generate_thumbnail(media_path, os.sep)
+        # 缩略图按加密分段命名，与 slot_pl_set_album 查找的文件名一致，已有缩略图不再重新截图
+        def __set_thumb__(self, media_path: str, encrypt_file_path: str = None):
+            if encrypt_file_path is not None:
+                thumb_name = self.__thumb_name__(os.path.split(encrypt_file_path)[-1])
             else:
-                thumb_pic_path = os.path.join(os.getcwd(), "thumb", file_name)
+                thumb_name = os.path.split(media_path)[-1] + ".jpg"
+            thumb_pic_path = os.path.join(os.getcwd(), "thumb", thumb_name)
+            if not self.preview_cache.get(thumb_pic_path):
+                thumb_pic_path = self.uyk_client.generate_thumbnail(media_path, "/", thumb_file_name=thumb_name)
+                if os.path.exists(thumb_pic_path):
+                    self.preview_cache.put(thumb_pic_path)
             thumb_pixmap = QtGui.QPixmap(thumb_pic_path)
             thumb_pixmap.scaled(130, self.uyk_pl_db_pic_label.height(), QtCore.Qt.KeepAspectRatio)
             self.uyk_pl_db_pic_label.setPixmap(thumb_pixmap)
@@ -1364,6 +1633,9 @@ class Main:
             self.vlc_play_list = ml
             mlp: vlc.MediaListPlayer = vlc.MediaListPlayer()
             self.vlc_player = mlp
+            # 回调在 vlc 线程中，通过信号回到界面线程
+            for event_type in [vlc.EventType.MediaListPlayerStopped, vlc.EventType.MediaListPlayerPlayed]:
+                mlp.event_manager().event_attach(event_type, lambda event: self.uyk_signal_pl_stopped.emit(mlp))
             mlp.set_media_list(ml)
             for m in media_path_list:
                 ml.add_media(m)
@@ -1375,7 +1647,7 @@ class Main:
 
         def __get_uky_client__(self, cookies):
             if self.uyk_client is None:
-                self.uyk_client = main.YiKeClient(cookies)
+                self.uyk_client = main.YiKeClient(cookies, media_probe=main.MediaProbe(self.setting.db_con))
             return self.uyk_client
 
         def write_log(self, param):
@@ -1417,50 +1689,52 @@ class Main:
             current_album = self.uyk_pl_album_combo_box.currentData()
             if current_album is None:
                 return
-            request_type = "page"
-            if request_type == "page":
-                conti = True
-                index = 1
-                while conti:
-                    list1 = current_album.get_sub_1page(cursor=self.uyk_dl_client_current_page_item)
-                    # list1 = current_album.get_sub_All(max=-1)
-                    if list1['has_more']:
-                        cursor_nextpage = list1['cursor']
-                        self.uyk_dl_client_current_page_item = cursor_nextpage
-                    else:
-                        conti = False
-                    for item in list1["items"]:
-                        file_name = item.info['path'].replace("/youa/web/", "")
-                        qitem = QtWidgets.QListWidgetItem(file_name)
-                        self.uyk_dl_items_list_widget.addItem(qitem)
-                        self.uyk_dl_client_items_dict.setdefault(file_name, item)
-                        self.write_log("cache album {} page {}".format(current_album_text, index))
-                        self.__cache_yike_items__(current_album_text, file_name, item)
-                        index += 1
-                    time.sleep(2)
-            else:
-                list1 = current_album.get_sub_All(max=-1)
+
+            # 缓存库和翻页游标只在界面线程中读写
+            def on_result(result: tuple):
+                items, cursor = result
+                self.uyk_dl_client_current_page_item = cursor
+                for file_name, item in items:
+                    self.uyk_dl_items_list_widget.addItem(QtWidgets.QListWidgetItem(file_name))
+                    self.uyk_dl_client_items_dict.setdefault(file_name, item)
+                    self.__cache_yike_items__(current_album_text, file_name, item)
+                if os.path.exists(cursor_serial_path):
+                    with open(cursor_serial_path, "wb") as f:
+                        pickle.dump(cursor, f)
+                self.uyk_dl_client_items_fetched[current_album_text] = 1
+                self.msg_box("info", "item has cached.")
+
+            self.start_job("cache album", self.__album_cache_job__, current_album, current_album_text,
+                           self.uyk_dl_client_current_page_item, button=self.uyk_pl_album_cache_push_button,
+                           on_result=on_result)
+
+        # 从 cursor 开始翻页拉取相册全部条目，只访问网络，返回 (条目列表, 最后的游标)
+        def __album_cache_job__(self, worker, current_album, current_album_text: str, cursor) -> tuple:
+            items = []
+            conti = True
+            index = 1
+            while conti:
+                list1 = current_album.get_sub_1page(cursor=cursor)
+                # list1 = current_album.get_sub_All(max=-1)
                 if list1['has_more']:
-                    cursor_nextpage = list1['cursor']
-                    self.uyk_dl_client_current_page_item = cursor_nextpage
+                    cursor = list1['cursor']
+                else:
+                    conti = False
                 for item in list1["items"]:
-                    qitem = QtWidgets.QListWidgetItem(item.info['path'].replace("/youa/web/", ""))
-                    self.uyk_dl_items_list_widget.addItem(qitem)
-                    self.uyk_dl_client_items_dict.setdefault(item.info['path'].replace("/youa/web/", ""), item)
-                    self.write_log("cache album {} page {}".format(current_album_text, list1['index']))
-            self.write_log("done")
-            self.uyk_dl_client_items_fetched[current_album_text] = 1
-            if os.path.exists(cursor_serial_path):
-                with open(cursor_serial_path, "wb") as f:
-                    pickle.dump(self.uyk_dl_client_current_page_item, f)
-            self.msg_box("info", "item has cached.")
+                    file_name = item.info['path'].replace("/youa/web/", "")
+                    items.append((file_name, item))
+                    worker.log("cache album {} page {}".format(current_album_text, index))
+                    index += 1
+                time.sleep(2)
+            worker.log("done")
+            return items, cursor
 
         def __cache_yike_items__(self, album: str, file_name: str, item):
             db_item = self.cache_db.get_item_by_file_name(file_name)
             if db_item is None:
                 self.cache_db.insert_item(album, file_name, item.info['album_id'], item.info['path'], pickle.dumps(item))
             else:
-                self.log("file_name {} already cached in db".format(file_name))
+                self.write_log("file_name {} already cached in db".format(file_name))
 
         def __load_yike_items_cache__(self, album: str):
             items = self.cache_db.list_items_by_album(album)
@@ -1536,6 +1810,7 @@ class Main:
                 return cursor.fetchone()
 
         def slot_pl_album_select(self):
+            self.__stop_playback__()
             current_album_text = self.uyk_pl_album_combo_box.currentText()
             self.__load_yike_items_cache__(current_album_text)
             self.write_log("play: album {} cache loaded.".format(current_album_text))
@@ -1577,9 +1852,9 @@ class Main:
             text = item.text().split("#")[1]
             f = self.setting.db_con.list_meta_by_source_name_prefix_for_one_video(text)
             if f is not None:
-                thumb_name = f[0][2].replace("-", "_").replace(" ", "_") + "de.jpg"
+                thumb_name = self.__thumb_name__(f[0][2].replace("-", "_").replace(" ", "_"))
                 thumb_pic_path = os.path.join(os.getcwd(), "thumb", thumb_name)
-                if os.path.exists(thumb_pic_path):
+                if self.preview_cache.get(thumb_pic_path):
                     thumb_pixmap = QtGui.QPixmap(thumb_pic_path)
                     thumb_pixmap.scaled(130, 150, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
                     thumb_pixmap.scaled(130, 150)
@@ -1602,12 +1877,23 @@ class Main:
                 return
             file_name = items[0].text().split("#")[-1]
             f = self.setting.db_con.list_meta_by_source_name_prefix_for_one_video(file_name)
-            media_path = f[0][2].replace("-", "_").replace(" ", "_") + "de"
+            new_name = f[0][2].replace("-", "_").replace(" ", "_")
+            encrypt_file_path = os.path.join(os.getcwd(), "preview", new_name)
+            if not self.preview_cache.get(encrypt_file_path):
+                self.msg_box("info", "{} is not in preview cache, play it first.".format(new_name))
+                return
             self.pl_generate_album_time += 5
             cookies = self.uyk_cookies_plain_text_edit.toPlainText()
             self.uyk_client = self.__get_uky_client__(cookies)
-            preview_dir = os.path.join(os.getcwd(), "preview")
-            self.uyk_client.generate_thumbnail(os.path.join(preview_dir, media_path), os.sep, time=self.pl_generate_album_time)
+            stream_server = self.__get_stream_server__()
+            stream_url = stream_server.add_stream(self.uyk_pl_key_line_edit.text(), [encrypt_file_path])
+            try:
+                thumb_pic_path = self.uyk_client.generate_thumbnail(stream_url, "/", time=self.pl_generate_album_time,
+                                                                    thumb_file_name=self.__thumb_name__(new_name))
+            finally:
+                stream_server.remove_stream(stream_url)
+            if os.path.exists(thumb_pic_path):
+                self.preview_cache.put(thumb_pic_path)
             self.slot_pl_set_album(items[0])
 
 
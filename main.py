@@ -1,18 +1,41 @@
 #!/usr/bin/python3
+import asyncio
+import bisect
+import collections
+import contextlib
+import csv
 import datetime
+import io
+import json
 import logging
+import mimetypes
+import mmap
 import os
 import re
 import shutil
 import sqlite3
+import subprocess
 import sys
+import threading
+import time
+import urllib.parse
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from logging.handlers import TimedRotatingFileHandler
 
 import browser_cookie3
 import ffmpeg
 import psutil
+import requests
 from pybaiduphoto import API as YiKeAPI
+from pybaiduphoto.Requests import Requests as YiKeRequests
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # logging.basicConfig(filename="./logs/main.log", level=logging.INFO)
 # log = logging.getLogger("main")
@@ -61,7 +84,7 @@ CREATE TABLE "split_file_info_mpeg" (
 """
 
 table_ddl_split_file_info_translate = """
-CREATE TABLE "split_file_info_translate" (
+CREATE TABLE IF NOT EXISTS "split_file_info_translate" (
 	"id"	INTEGER NOT NULL UNIQUE,
 	"source_name"	TEXT NOT NULL,
 	"new_name"	TEXT NOT NULL,
@@ -71,17 +94,173 @@ CREATE TABLE "split_file_info_translate" (
 );
 """
 
+# 媒体探测缓存，文件大小和修改时间不变时直接复用上次的 ffprobe 结果
+table_ddl_media_probe = """
+CREATE TABLE IF NOT EXISTS "media_probe" (
+	"path"	TEXT NOT NULL UNIQUE,
+	"size"	INTEGER NOT NULL,
+	"mtime"	INTEGER NOT NULL,
+	"duration"	REAL,
+	"bit_rate"	INTEGER,
+	"probe"	TEXT NOT NULL,
+	"date"	TEXT NOT NULL,
+	PRIMARY KEY("path")
+);
+"""
+
+# 拆分片段表。source_table/source_id 指向 split_file_info* 中的一条记录，part_index 从 1 开始
+# offset 为片段在源文件中的字节偏移(按字节拆分时才有)，duration 为片段时长(按时间拆分时才有)
+# checksum 为加密后片段文件的 crc32，只拆分不加密时为空
+table_ddl_split_file_parts = """
+CREATE TABLE IF NOT EXISTS "split_file_parts" (
+	"id"	INTEGER NOT NULL UNIQUE,
+	"source_table"	TEXT NOT NULL,
+	"source_id"	INTEGER NOT NULL,
+	"part_index"	INTEGER NOT NULL,
+	"name"	TEXT NOT NULL,
+	"size"	INTEGER,
+	"offset"	INTEGER,
+	"duration"	REAL,
+	"checksum"	TEXT,
+	PRIMARY KEY("id" AUTOINCREMENT),
+	UNIQUE("source_table", "source_id", "part_index")
+);
+"""
+
+# 拆分加密任务日志。任务未完成前保留，已完成的片段记录在 split_job_part 中，中断后重跑跳过这些片段
+table_ddl_split_job = """
+CREATE TABLE IF NOT EXISTS "split_job" (
+	"id"	INTEGER NOT NULL UNIQUE,
+	"job_type"	TEXT NOT NULL,
+	"source_name"	TEXT NOT NULL,
+	"source_size"	INTEGER NOT NULL,
+	"source_mtime"	INTEGER NOT NULL,
+	"date"	TEXT NOT NULL,
+	PRIMARY KEY("id" AUTOINCREMENT),
+	UNIQUE("job_type", "source_name")
+);
+"""
+
+# stage 为 split(切出的明文片段) 或 encrypt(加密后的片段)，start/length 为片段的开始时间和时长或者字节偏移和长度
+table_ddl_split_job_part = """
+CREATE TABLE IF NOT EXISTS "split_job_part" (
+	"job_id"	INTEGER NOT NULL,
+	"part_index"	INTEGER NOT NULL,
+	"stage"	TEXT NOT NULL,
+	"name"	TEXT NOT NULL,
+	"start"	REAL,
+	"length"	REAL,
+	"size"	INTEGER NOT NULL,
+	"checksum"	TEXT NOT NULL,
+	"date"	TEXT NOT NULL,
+	PRIMARY KEY("job_id", "part_index", "stage")
+);
+"""
+
+# 编码器探测结果，按 ffmpeg 版本缓存，升级 ffmpeg 或驱动后版本号变化会重新探测
+table_ddl_encoder_probe = """
+CREATE TABLE IF NOT EXISTS "encoder_probe" (
+	"ffmpeg_version"	TEXT NOT NULL,
+	"encoder"	TEXT NOT NULL,
+	"available"	INTEGER NOT NULL,
+	"fps"	REAL,
+	"date"	TEXT NOT NULL,
+	PRIMARY KEY("ffmpeg_version", "encoder")
+);
+"""
+
+split_file_info_tables = ("split_file_info", "split_file_info_mpeg", "split_file_info_translate")
+
+
+# 将 split_file_info*.new_name 中 # 连接的片段名拆成 split_file_parts 记录
+# split_file_info 的片段如果已按组加密，片段大小取自 meta_info 中同组的记录
+def backfill_split_file_parts(cursor):
+    for source_table in split_file_info_tables:
+        rows = cursor.execute('select id, new_name from "{}"'.format(source_table)).fetchall()
+        for source_id, new_name in rows:
+            part_sizes = {}
+            if source_table == "split_file_info":
+                group_prefix = str(source_id) + "#"
+                part_sizes = dict(cursor.execute(
+                    "select source_name, `size` from meta_info where new_name >= ? and new_name < ?",
+                    (group_prefix, str(source_id) + "$")).fetchall())
+            offset = 0
+            parts = []
+            for index, name in enumerate(new_name.split("#")):
+                size = part_sizes.get(name)
+                offset = offset if offset is not None and size is not None else None
+                parts.append((source_table, source_id, index + 1, name, size, offset))
+                if offset is not None:
+                    offset += size
+            cursor.executemany('insert or ignore into split_file_parts (source_table, source_id, part_index, name, '
+                               '`size`, `offset`) values (?, ?, ?, ?, ?, ?)', parts)
+
+
+# 库结构版本记录在 PRAGMA user_version 中，schema_migrations[i] 将版本 i 升级到 i + 1，打开旧库时依次补齐
+# 升级步骤为 sql 语句或者接收 cursor 的函数
+# LIKE 'x%' 默认不区分大小写，只能使用 COLLATE NOCASE 的索引，等值查询使用默认 BINARY 索引
+schema_migrations = [
+    # 1: 早期版本建库时漏建 split_file_info_translate
+    [
+        table_ddl_split_file_info_translate,
+        table_ddl_media_probe,
+    ],
+    # 2: 按文件名查询的索引
+    [
+        'CREATE INDEX IF NOT EXISTS "idx_meta_info_new_name" ON "meta_info" ("new_name")',
+        'CREATE INDEX IF NOT EXISTS "idx_meta_info_new_name_nocase" ON "meta_info" ("new_name" COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS "idx_meta_info_source_name" ON "meta_info" ("source_name")',
+        'CREATE INDEX IF NOT EXISTS "idx_meta_info_source_name_nocase" ON "meta_info" ("source_name" COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS "idx_split_file_info_source_name" ON "split_file_info" ("source_name")',
+        'CREATE INDEX IF NOT EXISTS "idx_split_file_info_mpeg_source_name" ON "split_file_info_mpeg" ("source_name")',
+        'CREATE INDEX IF NOT EXISTS "idx_split_file_info_translate_source_name" ON "split_file_info_translate" ("source_name")',
+    ],
+    # 3: 片段单独成表，不再解析 new_name 中 # 连接的字符串
+    [
+        table_ddl_split_file_parts,
+        backfill_split_file_parts,
+    ],
+    # 4: 可恢复的拆分加密任务日志
+    [
+        table_ddl_split_job,
+        table_ddl_split_job_part,
+    ],
+    # 5: 编码器探测缓存
+    [
+        table_ddl_encoder_probe,
+    ],
+]
+
 class DbCon:
 
     con = None
     db_path = None
-
-    def __init__(self, db_path="meta.db"):
+    journal_mode: str = None
+    synchronous: str = None
+    # 所有写入都持有 lock，事务期间其他线程的写入会等到事务结束，不会被混进同一个事务提交或回滚
+    lock: threading.RLock = None
+    # 事务嵌套层数按线程记录
+    local: threading.local = None
+    journal_modes = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+    synchronous_levels = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    # journal_mode 为 WAL 时写入不再阻塞读取，配合 synchronous=NORMAL 每次提交不用等待 fsync
+    # 两者为 None 时沿用 sqlite 默认值
+    def __init__(self, db_path="meta.db", journal_mode: str = None, synchronous: str = None):
+        if journal_mode is not None and journal_mode.upper() not in self.journal_modes:
+            raise ValueError("journal_mode {} not supported. available {}".format(journal_mode, self.journal_modes))
+        if synchronous is not None and synchronous.upper() not in self.synchronous_levels:
+            raise ValueError("synchronous {} not supported. available {}".format(synchronous, self.synchronous_levels))
         self.db_path = db_path
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.lock = threading.RLock()
+        self.local = threading.local()
         self.get_db_con()
 
     def __del__(self):
-        self.con.close()
+        if self.con is not None:
+            self.con.close()
 
     def init_meta_db(self):
         cursor = self.con.cursor()
@@ -90,12 +269,69 @@ class DbCon:
         cursor.execute(table_ddl_split_file_info_mpeg)
         cursor.close()
         self.con.commit()
+        self.migrate()
 
-    def insert_meta(self, source_name, new_name, file_size, date):
+    # 按 user_version 执行未完成的升级。升级语句都可以重复执行，中断后下次打开会从未完成的版本继续
+    def migrate(self):
         cursor = self.con.cursor()
-        cursor.execute("insert into meta_info (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target_version in range(version + 1, len(schema_migrations) + 1):
+            log.info("migrate meta db {} to version {}".format(self.db_path, target_version))
+            try:
+                for sql in schema_migrations[target_version - 1]:
+                    if callable(sql):
+                        sql(cursor)
+                    else:
+                        cursor.execute(sql)
+                cursor.execute("PRAGMA user_version={}".format(target_version))
+                self.con.commit()
+            except Exception as e:
+                self.con.rollback()
+                cursor.close()
+                raise e
         cursor.close()
-        self.con.commit()
+
+    @property
+    def transaction_depth(self) -> int:
+        return getattr(self.local, "depth", 0)
+
+    # 事务内的写入只在最外层退出时提交一次，异常时整体回滚。可以嵌套
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.local.depth = self.transaction_depth + 1
+            try:
+                yield self
+            except BaseException:
+                self.local.depth -= 1
+                if self.local.depth == 0:
+                    self.con.rollback()
+                raise
+            else:
+                self.local.depth -= 1
+                if self.local.depth == 0:
+                    self.con.commit()
+
+    # 事务外每次写入立即提交，事务内推迟到事务结束
+    def commit(self):
+        with self.lock:
+            if self.transaction_depth == 0:
+                self.con.commit()
+
+    def insert_meta(self, source_name, new_name, file_size, date):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert into meta_info (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
+            cursor.close()
+            self.commit()
+
+    # rows 为 [(source_name, new_name, size, date)]
+    def insert_meta_many(self, rows: list):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.executemany("insert into meta_info (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", rows)
+            cursor.close()
+            self.commit()
 
     def get_meta_by_new_name(self, new_name):
         cursor = self.con.cursor()
@@ -127,43 +363,172 @@ class DbCon:
     #        split_file_info
     #
 
-    def insert_split_file_info(self, source_name, new_name, file_size, date):
-        cursor = self.con.cursor()
-        cursor.execute("insert into split_file_info (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
-        cursor.close()
-        self.con.commit()
+    def insert_split_file_info(self, source_name, new_name, file_size, date) -> int:
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert into split_file_info (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
+            row_id = cursor.lastrowid
+            cursor.close()
+            self.commit()
+            return row_id
 
     def get_split_file_info_by_source_name(self, source_name) -> list:
         cursor = self.con.cursor()
         cursor.execute("select * from split_file_info where source_name=?", (source_name, ))
         return cursor.fetchone()
 
-    def insert_split_file_info_mpeg(self, source_name, new_name, file_size, date):
+    def get_split_file_info_by_id(self, id: int) -> list:
         cursor = self.con.cursor()
-        cursor.execute("insert into split_file_info_mpeg (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
-        cursor.close()
-        self.con.commit()
+        cursor.execute("select * from split_file_info where id=?", (id, ))
+        return cursor.fetchone()
+
+    def insert_split_file_info_mpeg(self, source_name, new_name, file_size, date) -> int:
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert into split_file_info_mpeg (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
+            row_id = cursor.lastrowid
+            cursor.close()
+            self.commit()
+            return row_id
 
     def get_split_file_info_by_source_name_mpeg(self, source_name) -> list:
         cursor = self.con.cursor()
         cursor.execute("select * from split_file_info_mpeg where source_name=?", (source_name,))
         return cursor.fetchone()
 
-    def insert_split_file_info_translate(self, source_name, new_name, file_size, date):
-        cursor = self.con.cursor()
-        cursor.execute("insert into split_file_info_translate (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
-        cursor.close()
-        self.con.commit()
+    def insert_split_file_info_translate(self, source_name, new_name, file_size, date) -> int:
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert into split_file_info_translate (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)", (source_name, new_name, file_size, date))
+            row_id = cursor.lastrowid
+            cursor.close()
+            self.commit()
+            return row_id
 
     def get_split_file_info_by_source_name_translate(self, source_name) -> list:
         cursor = self.con.cursor()
         cursor.execute("select * from split_file_info_translate where source_name=?", (source_name,))
         return cursor.fetchone()
 
+    #
+    #        split_file_parts
+    #
+
+    # 拆分记录和片段记录在同一个事务中写入，new_name 仍然保存 # 连接的片段名以兼容旧版本
+    # parts 为 [(part_index, name, size, offset, duration, checksum)]，返回拆分记录的 id
+    def insert_split_file_info_with_parts(self, source_table: str, source_name: str, file_size: int, date,
+                                          parts: list) -> int:
+        if source_table not in split_file_info_tables:
+            raise ValueError("table {} not a split file info table.".format(source_table))
+        with self.transaction():
+            cursor = self.con.cursor()
+            cursor.execute('insert into "{}" (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)'.format(
+                source_table), (source_name, "#".join([part[1] for part in parts]), file_size, date))
+            source_id = cursor.lastrowid
+            cursor.close()
+            self.insert_split_file_parts(source_table, source_id, parts)
+        return source_id
+
+    # parts 为 [(part_index, name, size, offset, duration, checksum)]
+    def insert_split_file_parts(self, source_table: str, source_id: int, parts: list):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.executemany("insert into split_file_parts (source_table, source_id, part_index, name, `size`, `offset`, "
+                               "duration, checksum) values (?, ?, ?, ?, ?, ?, ?, ?)",
+                               [(source_table, source_id) + tuple(part) for part in parts])
+            cursor.close()
+            self.commit()
+
+    # 片段加密完成后补写加密文件的 crc32
+    def update_split_file_part_checksum(self, source_table: str, source_id: int, part_index: int, checksum: str):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("update split_file_parts set checksum=? where source_table=? and source_id=? "
+                           "and part_index=?", (checksum, source_table, source_id, part_index))
+            cursor.close()
+            self.commit()
+
+    # 按 part_index 顺序返回
+    def list_split_file_parts(self, source_table: str, source_id: int) -> list:
+        cursor = self.con.cursor()
+        cursor.execute("select * from split_file_parts where source_table=? and source_id=? order by part_index",
+                       (source_table, source_id))
+        return cursor.fetchall()
+
+    # 片段表没有记录时(未升级的旧数据)退回解析 new_name
+    def list_split_file_part_names(self, source_table: str, file_info: list) -> list[str]:
+        parts = self.list_split_file_parts(source_table, file_info[0])
+        if len(parts) == 0:
+            return file_info[2].split("#")
+        return [part[4] for part in parts]
+
+    #
+    #        split_job
+    #
+
+    def get_split_job(self, job_type: str, source_name: str) -> list:
+        cursor = self.con.cursor()
+        cursor.execute("select * from split_job where job_type=? and source_name=?", (job_type, source_name))
+        return cursor.fetchone()
+
+    def insert_split_job(self, job_type: str, source_name: str, source_size: int, source_mtime: int, date) -> int:
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert into split_job (job_type, source_name, source_size, source_mtime, `date`) "
+                           "values (?, ?, ?, ?, ?)", (job_type, source_name, source_size, source_mtime, date))
+            row_id = cursor.lastrowid
+            cursor.close()
+            self.commit()
+            return row_id
+
+    def delete_split_job(self, job_id: int):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("delete from split_job_part where job_id=?", (job_id, ))
+            cursor.execute("delete from split_job where id=?", (job_id, ))
+            cursor.close()
+            self.commit()
+
+    def insert_split_job_part(self, job_id: int, part_index: int, stage: str, name: str, start, length, size: int,
+                              checksum: str, date):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert or replace into split_job_part (job_id, part_index, stage, name, start, length, `size`, "
+                           "checksum, `date`) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (job_id, part_index, stage, name, start, length, size, checksum, date))
+            cursor.close()
+            self.commit()
+
+    def list_split_job_parts(self, job_id: int) -> list:
+        cursor = self.con.cursor()
+        cursor.execute("select * from split_job_part where job_id=? order by part_index", (job_id, ))
+        return cursor.fetchall()
+
+    #
+    #        encoder_probe
+    #
+
+    def list_encoder_probe(self, ffmpeg_version: str) -> list:
+        cursor = self.con.cursor()
+        cursor.execute("select * from encoder_probe where ffmpeg_version=?", (ffmpeg_version, ))
+        return cursor.fetchall()
+
+    def insert_encoder_probe(self, ffmpeg_version: str, encoder: str, available: bool, fps: float, date):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert or replace into encoder_probe (ffmpeg_version, encoder, available, fps, `date`) "
+                           "values (?, ?, ?, ?, ?)", (ffmpeg_version, encoder, 1 if available else 0, fps, date))
+            cursor.close()
+            self.commit()
+
     def get_db_con(self):
         if self.con is not None:
             return self.con
         self.con = sqlite3.connect(self.db_path, check_same_thread=False)
+        if self.journal_mode is not None:
+            self.con.execute("PRAGMA journal_mode={}".format(self.journal_mode.upper()))
+        if self.synchronous is not None:
+            self.con.execute("PRAGMA synchronous={}".format(self.synchronous.upper()))
         cursor = self.con.cursor()
         try:
             cursor.execute("select * from meta_info;")
@@ -173,39 +538,543 @@ class DbCon:
             cursor.close()
             self.init_meta_db()
         else:
+            self.migrate()
             return self.con
 
+    #
+    #        media_probe
+    #
+
+    def get_media_probe(self, path: str, file_size: int, mtime: int) -> list:
+        cursor = self.con.cursor()
+        cursor.execute("select * from media_probe where path=? and `size`=? and mtime=?", (path, file_size, mtime))
+        return cursor.fetchone()
+
+    def insert_media_probe(self, path: str, file_size: int, mtime: int, duration: float, bit_rate: int, probe: str, date):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert or replace into media_probe (path, `size`, mtime, duration, bit_rate, probe, `date`) "
+                           "values (?, ?, ?, ?, ?, ?, ?)", (path, file_size, mtime, duration, bit_rate, probe, date))
+            cursor.close()
+            self.commit()
+
+    # 一次查询多个组的记录，返回 {组名: [meta_info 记录]}。每个组一个区间条件，分批查询避免超过 sqlite 参数个数限制
+    def list_meta_by_new_name_groups(self, group_names: list, batch_size: int = 400) -> dict:
+        group_names = [str(group_name) for group_name in group_names]
+        meta_groups: dict = {group_name: [] for group_name in group_names}
+        cursor = self.con.cursor()
+        for start in range(0, len(group_names), batch_size):
+            batch = group_names[start:start + batch_size]
+            condition = " or ".join(["(new_name >= ? and new_name < ?)"] * len(batch))
+            params = []
+            for group_name in batch:
+                params += [group_name + "#", group_name + "$"]
+            cursor.execute("select * from meta_info where " + condition, params)
+            for row in cursor.fetchall():
+                meta_groups[row[2].split("#")[0]].append(row)
+        cursor.close()
+        return meta_groups
+
     def get_meta_by_new_name_group(self, group_name):
         cursor = self.con.cursor()
-        cursor.execute("select * from meta_info where new_name like '{}#%'".format(group_name))
+        # '$' 是 '#' 的下一个字符，区间查询可以直接使用 new_name 索引
+        cursor.execute("select * from meta_info where new_name >= ? and new_name < ?",
+                       (str(group_name) + "#", str(group_name) + "$"))
         return cursor.fetchall()
 
 
+def file_crc32(file_path: str, chunk_size: int = 1024 * 1024 * 16) -> str:
+    crc = 0
+    with open(file_path, "rb") as f:
+        mb = f.read(chunk_size)
+        while mb:
+            crc = zlib.crc32(mb, crc)
+            mb = f.read(chunk_size)
+    return "%08x" % crc
+
+
+# 写入时顺带计算 crc32，避免为了校验和再读一遍文件
+class Crc32Writer:
+    f = None
+    crc: int = 0
+
+    def __init__(self, f):
+        self.f = f
+        self.crc = 0
+
+    def write(self, data) -> int:
+        self.crc = zlib.crc32(data, self.crc)
+        return self.f.write(data)
+
+    def hexdigest(self) -> str:
+        return "%08x" % self.crc
+
+
+'''
+拆分加密任务日志。每个完成的片段(切割或加密)连同大小、crc32 记录到 split_job_part，任务全部完成后删除
+源文件大小或修改时间变化时丢弃旧日志重新开始
+'''
+class SplitJournal:
+    db_con: DbCon = None
+    job_type: str = None
+    source_name: str = None
+    job_id: int = None
+    is_resumed: bool = False
+    parts: dict = None
+
+    def __init__(self, db_con: DbCon, job_type: str, source_dir: str, source_name: str):
+        self.db_con = db_con
+        self.job_type = job_type
+        self.source_name = source_name
+        stat = os.stat(os.path.join(source_dir, source_name))
+        with self.db_con.transaction():
+            job = self.db_con.get_split_job(job_type, source_name)
+            if job is not None and (job[3] != stat.st_size or job[4] != stat.st_mtime_ns):
+                log.info("source {} changed since last {} job, start over.".format(source_name, job_type))
+                self.db_con.delete_split_job(job[0])
+                job = None
+            if job is None:
+                self.job_id = self.db_con.insert_split_job(job_type, source_name, stat.st_size, stat.st_mtime_ns,
+                                                           datetime.datetime.now())
+                self.is_resumed = False
+            else:
+                self.job_id = job[0]
+                self.is_resumed = True
+        # (part_index, stage) -> split_job_part 记录
+        self.parts = {(part[1], part[2]): part for part in self.db_con.list_split_job_parts(self.job_id)}
+        if self.is_resumed:
+            log.info("resume {} job of {}, {} parts done.".format(job_type, source_name, len(self.parts)))
+
+    @staticmethod
+    def is_running(db_con: DbCon, job_type: str, source_name: str) -> bool:
+        return db_con.get_split_job(job_type, source_name) is not None
+
+    def get_part(self, part_index: int, stage: str) -> list:
+        return self.parts.get((part_index, stage))
+
+    # 日志中有记录，且文件仍在、大小一致、开始位置和长度与本次计划一致，才算完成
+    def is_part_done(self, part_index: int, stage: str, file_path: str, start=None, length=None) -> bool:
+        part = self.get_part(part_index, stage)
+        if part is None or not os.path.exists(file_path) or os.path.getsize(file_path) != part[6]:
+            return False
+        return self.__same__(part[4], start) and self.__same__(part[5], length)
+
+    def mark_part_done(self, part_index: int, stage: str, name: str, size: int, checksum: str, start=None, length=None):
+        with self.db_con.transaction():
+            self.db_con.insert_split_job_part(self.job_id, part_index, stage, name, start, length, size, checksum,
+                                              datetime.datetime.now())
+        self.parts[(part_index, stage)] = (self.job_id, part_index, stage, name, start, length, size, checksum)
+
+    # checksum 为空时在调用线程中计算
+    def mark_file_done(self, part_index: int, stage: str, file_path: str, start=None, length=None,
+                       checksum: str = None):
+        if checksum is None:
+            checksum = file_crc32(file_path)
+        self.mark_part_done(part_index, stage, os.path.basename(file_path), os.path.getsize(file_path),
+                            checksum, start, length)
+
+    def finish(self):
+        self.db_con.delete_split_job(self.job_id)
+        self.parts = {}
+
+    # 片段先写入按任务 id 命名的临时文件，中断后重跑可以找回或清理
+    def tmp_name(self, part_index: int, stage: str) -> str:
+        return "{}_job{}_{}_{}.tmp".format(self.job_type, self.job_id, stage, part_index)
+
+    # 删除本任务留下但日志中没有记录的临时文件，即写到一半中断的片段
+    def sweep_tmp(self, dir_path: str):
+        if not os.path.isdir(dir_path):
+            return
+        prefix = "{}_job{}_".format(self.job_type, self.job_id)
+        recorded = set(part[3] for part in self.parts.values())
+        for f_name in os.listdir(dir_path):
+            if f_name.startswith(prefix) and f_name.endswith(".tmp") and f_name not in recorded:
+                os.remove(os.path.join(dir_path, f_name))
+                log.info("remove stale tmp file {}".format(f_name))
+
+    # 日志中已记录最终文件名、但在改名前中断的片段，把临时文件改成最终文件名
+    def restore_parts(self, dir_path: str, stage: str):
+        for (part_index, part_stage), part in sorted(self.parts.items()):
+            if part_stage != stage:
+                continue
+            file_path = os.path.join(dir_path, part[3])
+            tmp_file_path = os.path.join(dir_path, self.tmp_name(part_index, stage))
+            if not os.path.exists(file_path) and os.path.exists(tmp_file_path) and \
+                    os.path.getsize(tmp_file_path) == part[6]:
+                os.replace(tmp_file_path, file_path)
+                log.info("restore {} to {}".format(tmp_file_path, part[3]))
+
+    def __same__(self, recorded, planned) -> bool:
+        if recorded is None or planned is None:
+            return recorded is None and planned is None
+        return abs(float(recorded) - float(planned)) < 0.001
+
+
+'''
+异或加密引擎。所有引擎输出完全一致，可互相解密。
+'''
+class PyXorCipher:
+    name = "python"
+
+    # 逐字节异或，速度很慢，仅作为参考实现
+    def xor(self, data, key_byte: int):
+        ret = bytearray()
+        for b in data:
+            ret.append(b ^ key_byte)
+        return ret
+
+    def xor_into(self, src: memoryview, dst: memoryview, key_byte: int):
+        for i in range(len(src)):
+            dst[i] = src[i] ^ key_byte
+
+
+class TranslateXorCipher:
+    name = "translate"
+    tables: dict = None
+    # translate需要临时bytes，分块处理控制额外内存
+    block_size = 1024 * 1024
+
+    def __init__(self):
+        self.tables = {}
+
+    # 单字节密钥的异或等价于一张256项的查找表，bytes.translate在C层批量处理
+    def get_table(self, key_byte: int) -> bytes:
+        table = self.tables.get(key_byte)
+        if table is None:
+            table = bytes(i ^ key_byte for i in range(256))
+            self.tables[key_byte] = table
+        return table
+
+    def xor(self, data, key_byte: int):
+        return bytes(data).translate(self.get_table(key_byte))
+
+    def xor_into(self, src: memoryview, dst: memoryview, key_byte: int):
+        table = self.get_table(key_byte)
+        for start in range(0, len(src), self.block_size):
+            end = start + self.block_size
+            dst[start:end] = src[start:end].tobytes().translate(table)
+
+
+class NumpyXorCipher:
+    name = "numpy"
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("numpy is required by cipher {}".format(self.name))
+
+    def xor(self, data, key_byte: int):
+        return numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint8), key_byte).tobytes()
+
+    def xor_into(self, src: memoryview, dst: memoryview, key_byte: int):
+        numpy.bitwise_xor(numpy.frombuffer(src, dtype=numpy.uint8), key_byte,
+                          out=numpy.frombuffer(dst, dtype=numpy.uint8))
+
+
+XOR_CIPHERS = {
+    PyXorCipher.name: PyXorCipher,
+    TranslateXorCipher.name: TranslateXorCipher,
+    NumpyXorCipher.name: NumpyXorCipher,
+}
+
+
+# 未指定时优先用 numpy 引擎(requirements.txt 中的 numpy)，未安装 numpy 时退回纯 Python 的 translate 引擎
+# 显式指定 numpy 而未安装时加解密抛出 ImportError
+def get_xor_cipher(name: str = None):
+    if name is None:
+        name = NumpyXorCipher.name if numpy is not None else TranslateXorCipher.name
+    cipher_class = XOR_CIPHERS.get(name)
+    if cipher_class is None:
+        raise ValueError("cipher {} not supported. available {}".format(name, list(XOR_CIPHERS.keys())))
+    return cipher_class()
+
+
+'''
+预分配缓冲区池。readinto读入后原地异或再写出，避免每个块重新分配内存
+'''
+class BufferPool:
+    lock: threading.Lock = None
+    free_buffers: dict = None
+    max_free_bytes: int = None
+    free_bytes: int = None
+
+    # max_free_bytes 为空闲缓冲区的总字节上限，超出时归还的缓冲区直接丢弃
+    def __init__(self, max_free_bytes: int = 1024 * 1024 * 128):
+        self.lock = threading.Lock()
+        self.free_buffers = {}
+        self.max_free_bytes = max_free_bytes
+        self.free_bytes = 0
+
+    def acquire(self, size: int) -> bytearray:
+        with self.lock:
+            buffers: list = self.free_buffers.get(size)
+            if buffers:
+                self.free_bytes -= size
+                return buffers.pop()
+        return bytearray(size)
+
+    def release(self, buf: bytearray):
+        with self.lock:
+            if self.free_bytes + len(buf) > self.max_free_bytes:
+                return
+            self.free_buffers.setdefault(len(buf), []).append(buf)
+            self.free_bytes += len(buf)
+
+    def clear(self):
+        with self.lock:
+            self.free_buffers.clear()
+            self.free_bytes = 0
+
+
+default_buffer_pool = BufferPool()
+
+
+class FileTask:
+    file_name: str
+    file_size: int
+    fn = None
+    args: tuple
+
+    def __init__(self, file_name: str, file_size: int, fn, args: tuple):
+        self.file_name = file_name
+        self.file_size = file_size
+        self.fn = fn
+        self.args = args
+
+
+'''
+目录级有界并发调度。按文件大小从大到小执行，大文件先开始可以缩短整批任务的完成时间
+'''
+class FileTaskScheduler:
+    max_workers: int = None
+    progress_callback = None
+
+    def __init__(self, max_workers: int = 1, progress_callback=None):
+        self.max_workers = max_workers
+        self.progress_callback = progress_callback
+
+    def run(self, tasks: list):
+        tasks = sorted(tasks, key=lambda t: t.file_size, reverse=True)
+        total = len(tasks)
+        if self.max_workers <= 1:
+            for index, task in enumerate(tasks):
+                task.fn(*task.args)
+                self.__progress__(index + 1, total, task.file_name)
+            return
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {pool.submit(task.fn, *task.args): task for task in tasks}
+            done = 0
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    done += 1
+                    self.__progress__(done, total, futures[future].file_name)
+            except Exception as e:
+                for future in futures:
+                    future.cancel()
+                raise e
+
+    def __progress__(self, done: int, total: int, file_name: str):
+        if self.progress_callback is not None:
+            self.progress_callback(done, total, file_name)
+
+
+# 进程池中执行的分块加密，需为模块级函数才能被pickle
+def xor_file_range_in_process(cipher_name: str, key_byte: int, file: str, output_file: str, offset: int, length: int):
+    return MediaEncrypt(None, cipher_name).xor_file_range(key_byte, file, output_file, offset, length)
+
+
 class MediaEncrypt:
 
     con: DbCon = None
-
-    def __init__(self, con):
+    cipher = None
+    buffer_pool: BufferPool = None
+    workers: int = None
+    executor: str = None
+    io_mode: str = None
+    file_workers: int = None
+    progress_callback = None
+    parallel_chunk_size = 1024 * 1024 * 16
+    mmap_chunk_size = 1024 * 1024 * 16
+    stream_chunk_size = 1024 * 1024 * 100
+
+    # workers > 1 时单个文件按字节区间并行加密，executor 为 thread 或 process
+    # io_mode 为 stream(readinto缓冲区) 或 mmap(源文件与目标文件映射间直接异或)
+    # file_workers 为目录下同时处理的文件数，为 None 时按 cpu 核数，且不超过缓冲区池上限能容纳的 16MB 块数
+    # progress_callback(done, total, file_name) 每完成一个文件回调一次
+    def __init__(self, con, cipher: str = None, buffer_pool: BufferPool = None, workers: int = 1,
+                 executor: str = "thread", io_mode: str = "stream", file_workers: int = None, progress_callback=None):
         self.con = con
+        self.cipher = get_xor_cipher(cipher)
+        self.buffer_pool = buffer_pool if buffer_pool is not None else default_buffer_pool
+        if executor not in ("thread", "process"):
+            raise ValueError("executor {} not supported.".format(executor))
+        if io_mode not in ("stream", "mmap"):
+            raise ValueError("io mode {} not supported.".format(io_mode))
+        self.workers = workers
+        self.executor = executor
+        self.io_mode = io_mode
+        self.file_workers = file_workers if file_workers is not None else self.default_file_workers()
+        self.progress_callback = progress_callback
+
+    def default_file_workers(self) -> int:
+        return max(1, min(os.cpu_count() or 1, self.buffer_pool.max_free_bytes // self.parallel_chunk_size))
+
+    # 多个文件同时处理时缩小每个文件的读写块，使所有文件的缓冲区合计不超过缓冲区池的字节上限
+    def file_chunk_size(self) -> int:
+        if self.file_workers <= 1:
+            return self.stream_chunk_size
+        return max(1024 * 1024, min(self.stream_chunk_size, self.buffer_pool.max_free_bytes // self.file_workers))
 
     def encrypt_xor(self, bytes, key_bytes):
         if len(key_bytes) > 1:
             raise ValueError("key bytes must be one num");
-        ret = bytearray()
-        for b in bytes:
-            ret.append(b ^ key_bytes[0])
-        return ret
+        return self.cipher.xor(bytes, key_bytes[0])
 
     def decrypt_xor(self, bytes, key_bytes):
         return self.encrypt_xor(bytes, key_bytes)
 
+    # 只校验并转换密钥，不依赖数据库和加密引擎
+    @staticmethod
+    def get_key_byte(key: str) -> int:
+        key_bytes = bytes(key, "u8")
+        if len(key_bytes) != 1:
+            raise ValueError("key bytes must be one num")
+        return key_bytes[0]
+
+    # 从f读取length字节(None为读到末尾)，原地异或后写入of，返回处理的字节数
+    def xor_stream(self, key_byte: int, f, of, length: int = None, chunk_size=1024 * 1024 * 100) -> int:
+        buf = self.buffer_pool.acquire(chunk_size)
+        total = 0
+        try:
+            with memoryview(buf) as view:
+                while length is None or total < length:
+                    read_size = chunk_size if length is None else min(chunk_size, length - total)
+                    n = f.readinto(view[:read_size])
+                    if not n:
+                        break
+                    block = view[:n]
+                    self.cipher.xor_into(block, block, key_byte)
+                    of.write(block)
+                    total += n
+        finally:
+            self.buffer_pool.release(buf)
+        return total
+
     def encrypt_file(self, key, file, output_file, chunk_size=1024 * 1024 * 100):
+        if self.io_mode == "mmap":
+            try:
+                self.encrypt_file_mmap(key, file, output_file)
+                return
+            except (OSError, ValueError) as e:
+                # 网络盘等不支持映射的文件退回到流式读写
+                log.warning("file {} mmap failed, fallback to stream. {}".format(file, e))
+        if self.workers > 1 and os.path.getsize(file) > self.parallel_chunk_size:
+            self.encrypt_file_parallel(key, file, output_file, min(chunk_size, self.parallel_chunk_size))
+            return
+        key_byte = self.get_key_byte(key)
         with open(file, "rb") as f, open(output_file, "wb") as of:
-            chuck_block = f.read(chunk_size)
-            while chuck_block:
-                out_chuck = self.encrypt_xor(chuck_block, bytes(key, "u8"))
-                of.write(out_chuck)
-                chuck_block = f.read(chunk_size)
+            self.xor_stream(key_byte, f, of, chunk_size=chunk_size)
+
+    # 异或与位置无关，按chunk_size切分字节区间并行处理，结果按偏移写入预先分配大小的输出文件
+    def encrypt_file_parallel(self, key, file, output_file, chunk_size=1024 * 1024 * 16, workers: int = None):
+        key_byte = self.get_key_byte(key)
+        if workers is None:
+            workers = self.workers
+        file_size = os.path.getsize(file)
+        with open(output_file, "wb") as of:
+            of.truncate(file_size)
+        ranges = [(offset, min(chunk_size, file_size - offset)) for offset in range(0, file_size, chunk_size)]
+        log.info("file {} encrypt in {} ranges with {} {} workers".format(file, len(ranges), workers, self.executor))
+        if self.executor == "process":
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(xor_file_range_in_process, self.cipher.name, key_byte, file, output_file,
+                                       offset, length) for offset, length in ranges]
+                for future in futures:
+                    future.result()
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                futures = [pool.submit(self.xor_file_range, key_byte, file, output_file, offset, length)
+                           for offset, length in ranges]
+                for future in futures:
+                    future.result()
+
+    # 源文件和预先截断到同样大小的目标文件都做内存映射，直接在两个映射之间异或，没有read()拷贝
+    def encrypt_file_mmap(self, key, file, output_file):
+        key_byte = self.get_key_byte(key)
+        file_size = os.path.getsize(file)
+        with open(file, "rb") as f, open(output_file, "w+b") as of:
+            of.truncate(file_size)
+            if file_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as src, \
+                    mmap.mmap(of.fileno(), file_size, access=mmap.ACCESS_WRITE) as dst:
+                if hasattr(src, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                    src.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(src) as src_view, memoryview(dst) as dst_view:
+                    for start in range(0, file_size, self.mmap_chunk_size):
+                        end = min(start + self.mmap_chunk_size, file_size)
+                        self.cipher.xor_into(src_view[start:end], dst_view[start:end], key_byte)
+
+    # 对比 read()循环、stream、mmap 三种方式加密同一个文件的速度，返回 {方式: MB/s}
+    def benchmark_io_modes(self, key, file, dest_dir_path, io_modes: list = None) -> dict:
+        if io_modes is None:
+            io_modes = ["read", "stream", "mmap"]
+        if not os.path.exists(dest_dir_path):
+            os.mkdir(dest_dir_path)
+        file_size = os.path.getsize(file)
+        output_file = os.path.join(dest_dir_path, os.path.split(file)[-1] + ".bench")
+        origin_io_mode = self.io_mode
+        result = {}
+        try:
+            for io_mode in io_modes:
+                start = time.perf_counter()
+                if io_mode == "read":
+                    # 原有的 f.read + 新建 bytearray 方式，作为基准
+                    key_bytes = bytes(key, "u8")
+                    with open(file, "rb") as f, open(output_file, "wb") as of:
+                        chuck_block = f.read(1024 * 1024 * 100)
+                        while chuck_block:
+                            of.write(self.encrypt_xor(chuck_block, key_bytes))
+                            chuck_block = f.read(1024 * 1024 * 100)
+                else:
+                    self.io_mode = io_mode
+                    self.encrypt_file(key, file, output_file)
+                cost = time.perf_counter() - start
+                result[io_mode] = file_size / 1024 / 1024 / cost if cost > 0 else 0
+                log.info("benchmark file {} io mode {} cost {:.3f}s {:.1f} MB/s"
+                         .format(file, io_mode, cost, result[io_mode]))
+                os.remove(output_file)
+        finally:
+            self.io_mode = origin_io_mode
+        return result
+
+    # 加密file中[offset, offset + length)区间，写入output_file相同偏移处
+    def xor_file_range(self, key_byte: int, file: str, output_file: str, offset: int, length: int) -> int:
+        buf = self.buffer_pool.acquire(length)
+        fd = os.open(output_file, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            with open(file, "rb") as f, memoryview(buf) as view:
+                f.seek(offset)
+                total = 0
+                while total < length:
+                    n = f.readinto(view[total:length])
+                    if not n:
+                        break
+                    total += n
+                block = view[:total]
+                self.cipher.xor_into(block, block, key_byte)
+                written = 0
+                while written < total:
+                    if hasattr(os, "pwrite"):
+                        written += os.pwrite(fd, block[written:], offset + written)
+                    else:
+                        # windows 无 pwrite，每个区间独占 fd，seek 后写入同样安全
+                        os.lseek(fd, offset + written, os.SEEK_SET)
+                        written += os.write(fd, block[written:])
+                return total
+        finally:
+            os.close(fd)
+            self.buffer_pool.release(buf)
 
     def decrypt_file(self, key, file, output_file, chunk_size=1024 * 1024 * 100):
         if os.path.exists(output_file):
@@ -220,8 +1089,12 @@ class MediaEncrypt:
         return new_name
 
     # departed
+    @staticmethod
+    def new_filename_with_subfix(source_name: str) -> str:
+        return ".".join([str(uuid.uuid1()), source_name.split(".")[-1]])
+
     def anonymous_filename_with_subfix(self, source_name: str, file_size):
-        new_name = ".".join([str(uuid.uuid1()), source_name.split(".")[-1]])
+        new_name = self.new_filename_with_subfix(source_name)
         self.con.insert_meta(source_name, new_name, file_size, datetime.datetime.now())
         return new_name
 
@@ -231,9 +1104,15 @@ class MediaEncrypt:
         return new_name
 
     def anonymous_filename_with_subfix_by_group(self, source_name: str, file_size: int, group_name: str):
-        new_name = str(group_name) + "#" + ".".join([str(uuid.uuid1()), source_name.split(".")[-1]])
-        self.con.insert_meta(source_name, new_name, file_size, datetime.datetime.now())
-        return new_name
+        return self.anonymous_filenames_with_subfix_by_group([(source_name, file_size)], group_name)[0]
+
+    # files 为 [(source_name, file_size)]，一次 executemany 写入全部记录，返回与 files 顺序一致的新文件名
+    def anonymous_filenames_with_subfix_by_group(self, files: list, group_name: str) -> list[str]:
+        now = datetime.datetime.now()
+        rows = [(source_name, str(group_name) + "#" + ".".join([str(uuid.uuid1()), source_name.split(".")[-1]]),
+                 file_size, now) for source_name, file_size in files]
+        self.con.insert_meta_many(rows)
+        return [row[1] for row in rows]
 
     def get_last_row(self) -> int:
         return self.con.get_last_row_id()
@@ -248,62 +1127,713 @@ class MediaEncrypt:
         if not os.path.exists(dest_dir_path):
             os.mkdir(dest_dir_path)
         dir = os.listdir(dir_path)
-        for file in dir:
-            file_path = os.path.join(dir_path, file)
-            if not os.path.isfile(file_path):
-                continue
-            new_filename = self.anonymous_filename(file, os.path.getsize(file_path))
-            log.info("start encrypting file {}".format(file))
-            self.encrypt_file(key, file_path, os.path.join(dest_dir_path, new_filename))
-            log.info("file {} encrypted.".format(file))
+        tasks = []
+        # 所有记录在一个事务里写入，只提交一次
+        with self.con.transaction():
+            for file in dir:
+                file_path = os.path.join(dir_path, file)
+                if not os.path.isfile(file_path):
+                    continue
+                file_size = os.path.getsize(file_path)
+                new_filename = self.anonymous_filename(file, file_size)
+                tasks.append(FileTask(file, file_size, self.__encrypt_file_task__,
+                                      (key, file, file_path, os.path.join(dest_dir_path, new_filename))))
+        self.run_file_tasks(tasks)
 
     def decrypt_files(self, key, dir_path, dest_dir_path):
         if not os.path.exists(dest_dir_path):
             os.mkdir(dest_dir_path)
         dir = os.listdir(dir_path)
+        tasks = []
         for file in dir:
             file_path = os.path.join(dir_path, file)
             if not os.path.isfile(file_path):
                 continue
             new_filename = self.get_real_filename(file)
             if new_filename is None:
-                log.info("file name {} not found in meta_table")
+                log.info("file name {} not found in meta_table".format(file))
                 continue
-            log.info("start decrypting file {}".format(file))
-            self.decrypt_file(key, file_path, os.path.join(dest_dir_path, new_filename))
-            log.info("file {} decrypted.".format(file))
+            tasks.append(FileTask(file, os.path.getsize(file_path), self.__decrypt_file_task__,
+                                  (key, file, file_path, os.path.join(dest_dir_path, new_filename))))
+        self.run_file_tasks(tasks)
 
     def encrypt_files_with_subfix(self, key, dir_path, dest_dir_path):
         if not os.path.exists(dest_dir_path):
             os.mkdir(dest_dir_path)
         dir = os.listdir(dir_path)
-        for file in dir:
-            file_path = os.path.join(dir_path, file)
-            if not os.path.isfile(file_path):
-                continue
-            new_filename_with_subfix = self.anonymous_filename_with_subfix(file, os.path.getsize(file_path))
-            log.info("start encrypting file {}".format(file))
-            self.encrypt_file(key, file_path, os.path.join(dest_dir_path, new_filename_with_subfix))
-            log.info("file {} encrypted.".format(file))
+        tasks = []
+        # 所有记录在一个事务里写入，只提交一次
+        with self.con.transaction():
+            for file in dir:
+                file_path = os.path.join(dir_path, file)
+                if not os.path.isfile(file_path):
+                    continue
+                file_size = os.path.getsize(file_path)
+                new_filename_with_subfix = self.anonymous_filename_with_subfix(file, file_size)
+                tasks.append(FileTask(file, file_size, self.__encrypt_file_task__,
+                                      (key, file, file_path, os.path.join(dest_dir_path, new_filename_with_subfix))))
+        self.run_file_tasks(tasks)
 
     def encrypt_files_with_subfix_by_group(self, key, dir_path, dest_dir_path, group_name: str):
         if not os.path.exists(dest_dir_path):
             os.mkdir(dest_dir_path)
         dir = os.listdir(dir_path)
+        files = []
         for file in dir:
             file_path = os.path.join(dir_path, file)
             if not os.path.isfile(file_path):
                 continue
-            new_filename_with_subfix = self.anonymous_filename_with_subfix_by_group(file, os.path.getsize(file_path),
-                                                                                    group_name)
-            log.info("start encrypting file {}".format(file))
-            self.encrypt_file(key, file_path, os.path.join(dest_dir_path, new_filename_with_subfix))
-            log.info("file {} encrypted.".format(file))
+            files.append((file, os.path.getsize(file_path)))
+        new_filenames = self.anonymous_filenames_with_subfix_by_group(files, group_name)
+        tasks = []
+        for (file, file_size), new_filename_with_subfix in zip(files, new_filenames):
+            tasks.append(FileTask(file, file_size, self.__encrypt_file_task__,
+                                  (key, file, os.path.join(dir_path, file),
+                                   os.path.join(dest_dir_path, new_filename_with_subfix))))
+        self.run_file_tasks(tasks)
+
+    # 数据库记录都在调用线程中写入(单一写入者)，线程池只负责文件读写。整批结束后释放缓冲区
+    def run_file_tasks(self, tasks: list):
+        scheduler = FileTaskScheduler(self.file_workers, self.progress_callback)
+        try:
+            scheduler.run(tasks)
+        finally:
+            self.release_buffers()
+
+    # 任务结束时调用，释放缓冲区池中空闲的缓冲区
+    def release_buffers(self):
+        self.buffer_pool.clear()
+
+    def __encrypt_file_task__(self, key, file, file_path, output_file):
+        log.info("start encrypting file {}".format(file))
+        self.encrypt_file(key, file_path, output_file, self.file_chunk_size())
+        log.info("file {} encrypted.".format(file))
+
+    def __decrypt_file_task__(self, key, file, file_path, output_file):
+        log.info("start decrypting file {}".format(file))
+        self.decrypt_file(key, file_path, output_file, self.file_chunk_size())
+        log.info("file {} decrypted.".format(file))
 
     def get_all_real_filename_by_group(self, group_name):
         meta_row = self.con.get_meta_by_new_name_group(group_name)
         return meta_row
 
+'''
+把按顺序拼接的一组加密片段当作一个连续的明文文件，支持 read/readinto/seek/tell
+构建时记录每个片段的累计起始偏移，seek 后二分查找定位片段和片内偏移，片段文件按需打开，读出后原地异或
+key 为 None 时只拼接不解密，用于读取拆分后未加密的片段
+'''
+class EncryptedGroupFile(io.RawIOBase):
+    file_paths: list = None
+    offsets: list = None
+    size: int = None
+    name: str = None
+    key_byte: int = None
+    cipher = None
+    position: int = None
+    current_index: int = None
+    current_file = None
+
+    def __init__(self, file_paths: list, key: str = None, name: str = None, cipher: str = None):
+        super().__init__()
+        self.file_paths = list(file_paths)
+        # offsets[i] 为第 i 个片段在拼接后文件中的起始位置，offsets[-1] 为总大小
+        self.offsets = [0]
+        for file_path in self.file_paths:
+            self.offsets.append(self.offsets[-1] + os.path.getsize(file_path))
+        self.size = self.offsets[-1]
+        self.name = name
+        self.key_byte = MediaEncrypt.get_key_byte(key) if key is not None else None
+        self.cipher = get_xor_cipher(cipher) if key is not None else None
+        self.position = 0
+
+    # 组内片段按拆分顺序排列，返回 (源文件名, [加密片段路径])，记录或片段缺失时返回 None
+    # metas 为 get_all_real_filename_by_group / get_meta_by_new_name_group 返回的该组 meta_info 记录
+    @staticmethod
+    def list_group_part_paths(db_con: DbCon, source_dir: str, group_name: str, metas: list = None):
+        try:
+            group_id = int(group_name)
+        except ValueError:
+            log.info("group {} is not a split file info id, skip.".format(group_name))
+            return None
+        file_info = db_con.get_split_file_info_by_id(group_id)
+        if file_info is None:
+            log.info("source file info of group {} not found.".format(group_name))
+            return None
+        if metas is None:
+            metas = db_con.get_meta_by_new_name_group(group_name)
+        meta_by_part_name: dict = {fn[1]: fn for fn in metas}
+        split_file_paths = []
+        for part_name in db_con.list_split_file_part_names("split_file_info", file_info):
+            meta = meta_by_part_name.get(part_name)
+            if meta is None:
+                log.info("split file {} not found in group {}. exit this process.".format(part_name, group_name))
+                return None
+            split_file_path = os.path.join(source_dir, meta[2])
+            if not os.path.exists(split_file_path):
+                log.info("split file {} not found. exit this process.".format(split_file_path))
+                return None
+            split_file_paths.append(split_file_path)
+        return file_info[1], split_file_paths
+
+    # SAE 加密后的一组片段
+    @classmethod
+    def open_group(cls, db_con: DbCon, source_dir: str, group_name: str, key: str, metas: list = None):
+        group = cls.list_group_part_paths(db_con, source_dir, group_name, metas)
+        if group is None:
+            raise Exception("group {} not found".format(group_name))
+        source_name, split_file_paths = group
+        return cls(split_file_paths, key, source_name)
+
+    # split_file_info* 记录的片段，文件名取 split_file_parts，key 为 None 时按未加密读取
+    @classmethod
+    def open_split_file_info(cls, db_con: DbCon, source_dir: str, source_table: str, file_info: list,
+                             key: str = None):
+        split_file_paths = [os.path.join(source_dir, part_name)
+                            for part_name in db_con.list_split_file_part_names(source_table, file_info)]
+        for split_file_path in split_file_paths:
+            if not os.path.exists(split_file_path):
+                raise Exception("split file {} not found".format(split_file_path))
+        return cls(split_file_paths, key, file_info[1])
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("whence {} not supported".format(whence))
+        if position < 0:
+            raise ValueError("negative seek position {}".format(position))
+        self.position = position
+        return self.position
+
+    # 每次最多读到当前片段末尾，read()/readall() 会继续读下一个片段
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if self.position >= self.size:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        f = self.__open_part__(index)
+        f.seek(self.position - self.offsets[index])
+        with memoryview(b) as view, view.cast("B") as view:
+            n = f.readinto(view[:min(len(view), self.offsets[index + 1] - self.position)])
+            if not n:
+                raise Exception("file {} shorter than {}".format(self.file_paths[index],
+                                                                 self.offsets[index + 1] - self.offsets[index]))
+            if self.key_byte is not None:
+                self.cipher.xor_into(view[:n], view[:n], self.key_byte)
+        self.position += n
+        return n
+
+    # 与普通文件一致，跨片段时读满 size 字节，只有到达末尾才少于 size
+    def read(self, size: int = -1) -> bytes:
+        remaining = max(self.size - self.position, 0)
+        buf = bytearray(remaining if size is None or size < 0 else min(size, remaining))
+        with memoryview(buf) as view:
+            total = 0
+            while total < len(buf):
+                total += self.readinto(view[total:])
+        return bytes(buf)
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def close(self):
+        if self.current_file is not None:
+            self.current_file.close()
+            self.current_file = None
+        super().close()
+
+    def __open_part__(self, index: int):
+        if self.current_index != index:
+            if self.current_file is not None:
+                self.current_file.close()
+            self.current_file = open(self.file_paths[index], "rb")
+            self.current_index = index
+        return self.current_file
+
+
+'''
+媒体探测缓存。以 (路径, 大小, 修改时间) 为键缓存 ffmpeg.probe 的结果，时长和码率计算共用一次探测
+传入 db_con 时缓存写入 SQLite，目录任务中断后重跑不用再探测
+'''
+class MediaProbe:
+    db_con: DbCon = None
+    cache: dict = None
+    lock: threading.Lock = None
+    # 流没有 bit_rate 时按 64k 估算
+    default_stream_bit_rate = 64 * 1000
+
+    def __init__(self, db_con: DbCon = None):
+        self.db_con = db_con
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def probe(self, file_path: str) -> dict:
+        return self.get_probe_info(file_path)["probe"]
+
+    def get_duration(self, file_path: str) -> float:
+        return self.get_probe_info(file_path)["duration"]
+
+    # 所有流码率之和，单位 bit/s
+    def get_bit_rate(self, file_path: str) -> int:
+        return self.get_probe_info(file_path)["bit_rate"]
+
+    def get_probe_info(self, file_path: str) -> dict:
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            info = self.cache.get(key)
+        if info is not None:
+            return info
+        row = None
+        if self.db_con is not None:
+            row = self.db_con.get_media_probe(path, stat.st_size, stat.st_mtime_ns)
+        if row is not None:
+            info = {"duration": row[3], "bit_rate": row[4], "probe": json.loads(row[5])}
+        else:
+            log.info("probe file {}".format(path))
+            probe: dict = ffmpeg.probe(path)
+            info = {"duration": self.__calc_duration__(probe), "bit_rate": self.__calc_bit_rate__(probe), "probe": probe}
+            if self.db_con is not None:
+                self.db_con.insert_media_probe(path, stat.st_size, stat.st_mtime_ns, info["duration"], info["bit_rate"],
+                                               json.dumps(probe), datetime.datetime.now())
+        with self.lock:
+            self.cache[key] = info
+        return info
+
+    def __calc_duration__(self, probe: dict) -> float:
+        duration = probe.get("format", {}).get("duration")
+        if duration is not None:
+            return float(duration)
+        stream_durations = [float(stream["duration"]) for stream in probe.get("streams", []) if "duration" in stream]
+        return max(stream_durations) if stream_durations else None
+
+    def __calc_bit_rate__(self, probe: dict) -> int:
+        rate = 0
+        for stream in probe.get("streams", []):
+            bit_rate_val = stream.get("bit_rate")
+            if bit_rate_val is None:
+                bit_rate_val = self.default_stream_bit_rate
+            rate += int(bit_rate_val)
+        return rate
+
+
+ffmpeg_format_spec_re = re.compile(r"%[-#0 +]*\d*(?:\.\d+)?[sdif]")
+
+
+# 拆分参数模板。只按空白分隔，单双引号包住带空格的参数并去掉引号，反斜杠原样保留，Windows 路径不会被改写
+# 界面旧模板中的 \" 按引号处理
+# example: split_ffmpeg_param('C:\\ffmpeg\\ffmpeg.exe -i \\"%s\\" "%s"') -> ["C:\\ffmpeg\\ffmpeg.exe", "-i", "%s", "%s"]
+def split_ffmpeg_param(ffmpeg_param: str) -> list:
+    args = []
+    token = None
+    quote = None
+    index = 0
+    while index < len(ffmpeg_param):
+        c = ffmpeg_param[index]
+        if c == "\\" and index + 1 < len(ffmpeg_param) and ffmpeg_param[index + 1] in "\"'":
+            index += 1
+            c = ffmpeg_param[index]
+        if quote is not None:
+            if c == quote:
+                quote = None
+            else:
+                token += c
+        elif c in "\"'":
+            quote = c
+            token = "" if token is None else token
+        elif c.isspace():
+            if token is not None:
+                args.append(token)
+                token = None
+        else:
+            token = c if token is None else token + c
+        index += 1
+    if quote is not None:
+        raise ValueError("ffmpeg param {} has unclosed quote {}".format(ffmpeg_param, quote))
+    if token is not None:
+        args.append(token)
+    return args
+
+
+# 拆分参数模板后逐个参数填值，路径中的空格和引号不会再被 shell 解释
+# example: build_ffmpeg_args('ffmpeg -ss %d -i "%s" "%s"', (10, "a b.mp4", "c.mp4")) -> ["ffmpeg", "-ss", "10", "-i", "a b.mp4", "c.mp4"]
+def build_ffmpeg_args(ffmpeg_param: str, values: tuple) -> list:
+    values = list(values)
+    args = []
+    for token in split_ffmpeg_param(ffmpeg_param):
+        count = len(ffmpeg_format_spec_re.findall(token.replace("%%", "")))
+        args.append(token % tuple(values[:count]))
+        values = values[count:]
+    if len(values) > 0:
+        raise ValueError("ffmpeg param {} has no placeholder for {}".format(ffmpeg_param, values))
+    return args
+
+
+'''
+ffmpeg/ffprobe 子进程运行器。基于 asyncio，参数以列表传入不经过 shell，支持超时、取消和 -progress 进度解析
+同一个事件循环可以同时驱动多个进程，stderr 保留最后若干行用于出错时的日志
+'''
+class FfmpegRunner:
+    timeout: float = None
+    stderr_lines: int = 200
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+
+    # 在当前线程新建事件循环同步运行，返回 (stdout, stderr)
+    def run(self, args: list, timeout: float = None, progress_callback=None) -> tuple:
+        return asyncio.run(self.run_async(args, timeout, progress_callback))
+
+    # progress_callback 不为空时加入 -progress pipe:1，ffmpeg 每输出一组进度就以 dict 回调一次，此时 stdout 返回空
+    # 超时或者任务被取消时结束子进程
+    async def run_async(self, args: list, timeout: float = None, progress_callback=None) -> tuple:
+        if progress_callback is not None and "-progress" not in args:
+            args = [args[0], "-progress", "pipe:1", "-nostats"] + list(args[1:])
+        timeout = self.timeout if timeout is None else timeout
+        log.info("cmd: {}".format(args))
+        process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+        stderr_lines = collections.deque(maxlen=self.stderr_lines)
+        try:
+            stdout, _, returncode = await asyncio.wait_for(asyncio.gather(
+                self.__read_stdout__(process.stdout, progress_callback),
+                self.__read_stderr__(process.stderr, stderr_lines),
+                process.wait()), timeout)
+        except BaseException:
+            if process.returncode is None:
+                log.warning("kill cmd: {}".format(args))
+                process.kill()
+                await process.wait()
+            raise
+        stderr = "".join(stderr_lines)
+        if returncode != 0:
+            log.error("cmd: {}".format(args))
+            raise Exception("{} exit {}. {}".format(args[0], returncode, stderr))
+        return stdout, stderr
+
+    async def __read_stdout__(self, stream, progress_callback) -> bytes:
+        if progress_callback is None:
+            return await stream.read()
+        progress = {}
+        async for line in stream:
+            key, _, value = line.decode("u8", "replace").strip().partition("=")
+            if key == "":
+                continue
+            progress[key] = value
+            # 每组进度以 progress=continue 或 progress=end 结束
+            if key == "progress":
+                progress_callback(progress)
+                progress = {}
+        return b""
+
+    async def __read_stderr__(self, stream, stderr_lines: collections.deque):
+        async for line in stream:
+            stderr_lines.append(line.decode("u8", "replace"))
+
+
+'''
+ffmpeg 切割进度统计。解析 -progress 输出的 out_time、speed、total_size，按片段和整个文件汇总 fps、速度倍数和字节/秒
+progress_callback(file_name, segment, stats) 每收到一组进度回调两次：segment 为片段序号时是该片段的统计，为 None 时是整个文件的汇总
+stats 为 {out_time, duration, percent, frame, fps, speed, total_size, bytes_per_sec, elapsed, done}，percent 取值 0~1
+'''
+class FfmpegProgress:
+    file_name: str = None
+    progress_callback = None
+    log_interval: float = None
+    segments: dict = None
+    start_time: float = None
+    last_log_time: float = None
+
+    def __init__(self, file_name: str, progress_callback=None, log_interval: float = 10):
+        self.file_name = file_name
+        self.progress_callback = progress_callback
+        self.log_interval = log_interval
+        self.segments = {}
+        self.start_time = None
+        self.last_log_time = time.perf_counter()
+
+    # 片段加入调度时登记输出时长，用于计算完成比例
+    def add_segment(self, segment: int, duration: float):
+        self.segments[segment] = {"out_time": 0.0, "duration": float(duration), "frame": 0, "fps": 0.0, "speed": 0.0,
+                                  "total_size": 0, "start": None, "done": False}
+
+    # 片段对应的 ffmpeg 进程开始时调用，返回传给 FfmpegRunner 的回调
+    def segment_callback(self, segment: int):
+        now = time.perf_counter()
+        self.segments[segment]["start"] = now
+        if self.start_time is None:
+            self.start_time = now
+        return lambda progress: self.__update__(segment, progress)
+
+    def finish_segment(self, segment: int):
+        seg = self.segments[segment]
+        seg["done"] = True
+        seg["out_time"] = seg["duration"]
+        stats = self.__segment_stats__(seg)
+        log.info("file {} segment {} done. {}".format(self.file_name, segment, self.format_stats(stats)))
+        self.__callback__(segment, stats)
+        self.__callback__(None, self.__file_stats__())
+
+    # 所有片段完成后调用，返回整个文件的汇总
+    def finish(self) -> dict:
+        stats = self.__file_stats__()
+        stats["done"] = True
+        log.info("file {} done. {}".format(self.file_name, self.format_stats(stats)))
+        self.__callback__(None, stats)
+        return stats
+
+    @staticmethod
+    def format_stats(stats: dict) -> str:
+        return "{:.0%} {:.1f}/{:.1f}s fps {:.1f} speed {:.2f}x {:.2f} MB/s elapsed {:.1f}s".format(
+            stats["percent"], stats["out_time"], stats["duration"], stats["fps"], stats["speed"],
+            stats["bytes_per_sec"] / 1024 / 1024, stats["elapsed"])
+
+    # N/A 或无法解析时返回 None，speed 形如 " 1.5x"
+    @staticmethod
+    def __parse_number__(value: str):
+        try:
+            return float(value.strip().rstrip("x"))
+        except (AttributeError, ValueError):
+            return None
+
+    def __update__(self, segment: int, progress: dict):
+        seg = self.segments[segment]
+        out_time_us = self.__parse_number__(progress.get("out_time_us", progress.get("out_time_ms")))
+        if out_time_us is not None and out_time_us >= 0:
+            seg["out_time"] = min(out_time_us / 1000000, seg["duration"])
+        for key in ("frame", "fps", "speed", "total_size"):
+            value = self.__parse_number__(progress.get(key))
+            if value is not None:
+                seg[key] = value
+        self.__callback__(segment, self.__segment_stats__(seg))
+        stats = self.__file_stats__()
+        self.__callback__(None, stats)
+        now = time.perf_counter()
+        if now - self.last_log_time >= self.log_interval:
+            self.last_log_time = now
+            log.info("file {} progress {}".format(self.file_name, self.format_stats(stats)))
+
+    def __segment_stats__(self, seg: dict) -> dict:
+        elapsed = time.perf_counter() - seg["start"] if seg["start"] is not None else 0.0
+        return {"out_time": seg["out_time"], "duration": seg["duration"],
+                "percent": seg["out_time"] / seg["duration"] if seg["duration"] > 0 else 1.0,
+                "frame": int(seg["frame"]), "fps": seg["fps"], "speed": seg["speed"],
+                "total_size": int(seg["total_size"]),
+                "bytes_per_sec": seg["total_size"] / elapsed if elapsed > 0 else 0.0,
+                "elapsed": elapsed, "done": seg["done"]}
+
+    # 并发的片段按墙钟时间汇总，fps 和速度倍数即为整个文件的吞吐
+    def __file_stats__(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        out_time = sum(seg["out_time"] for seg in self.segments.values())
+        duration = sum(seg["duration"] for seg in self.segments.values())
+        frame = sum(seg["frame"] for seg in self.segments.values())
+        total_size = sum(seg["total_size"] for seg in self.segments.values())
+        return {"out_time": out_time, "duration": duration,
+                "percent": out_time / duration if duration > 0 else 1.0,
+                "frame": int(frame), "fps": frame / elapsed if elapsed > 0 else 0.0,
+                "speed": out_time / elapsed if elapsed > 0 else 0.0, "total_size": int(total_size),
+                "bytes_per_sec": total_size / elapsed if elapsed > 0 else 0.0,
+                "elapsed": elapsed, "done": False}
+
+    def __callback__(self, segment, stats: dict):
+        if self.progress_callback is not None:
+            self.progress_callback(self.file_name, segment, stats)
+
+
+'''
+ffmpeg 任务调度器。同时运行多个 ffmpeg 子进程，并按提交顺序收集结果
+任务为协程函数时在同一个事件循环中并发运行，否则使用线程池
+'''
+class FfmpegJobScheduler:
+    max_workers: int = None
+    threads_per_job: int = None
+
+    def __init__(self, max_workers: int = 1, cpu_limit: int = None):
+        if cpu_limit is None:
+            cpu_limit = os.cpu_count() or 1
+        # 进程数不超过可用核数，每个进程平分核数
+        self.max_workers = max(1, min(max_workers, cpu_limit))
+        self.threads_per_job = max(1, cpu_limit // self.max_workers)
+
+    # jobs 为 [(fn, args)]，返回与 jobs 顺序一致的结果。任意任务失败时取消剩余任务并抛出异常
+    def run(self, jobs: list) -> list:
+        if len(jobs) > 0 and all(asyncio.iscoroutinefunction(fn) for fn, args in jobs):
+            return asyncio.run(self.run_async(jobs))
+        if self.max_workers <= 1:
+            return [fn(*args) for fn, args in jobs]
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = [pool.submit(fn, *args) for fn, args in jobs]
+            try:
+                return [future.result() for future in futures]
+            except Exception as e:
+                for future in futures:
+                    future.cancel()
+                raise e
+
+    async def run_async(self, jobs: list) -> list:
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run_job(fn, args):
+            async with semaphore:
+                return await fn(*args)
+
+        tasks = [asyncio.ensure_future(run_job(fn, args)) for fn, args in jobs]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException as e:
+            # 取消其余任务，运行中的 ffmpeg 进程由 FfmpegRunner 结束
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise e
+
+
+'''
+H.264 编码器探测。ffmpeg -encoders 列出编译进来的编码器，再用 lavfi 测试源试编码确认驱动和硬件可用
+结果按 ffmpeg 版本缓存到 SQLite，选择时取试编码帧率最高的编码器，帧率相同时按硬件优先的顺序
+'''
+class EncoderProbe:
+    # (编码器, 编码参数)，按优先顺序排列。libx264 为纯 CPU 机器的兜底，veryfast 在速度和体积之间折中
+    candidates = [
+        ("h264_nvenc", ["-preset", "p4", "-cq", "23"]),
+        ("h264_qsv", ["-global_quality", "15"]),
+        ("h264_amf", ["-quality", "speed", "-rc", "cqp", "-qp_i", "22", "-qp_p", "22"]),
+        ("h264_videotoolbox", ["-q:v", "65"]),
+        ("libx264", ["-preset", "veryfast", "-crf", "20"]),
+    ]
+    trial_source = "testsrc2=size=1280x720:rate=30"
+    # 试编码时长。过短时结果主要是进程启动和编码器初始化的时间
+    trial_seconds = 5
+    # 硬件编码器驱动异常时试编码可能卡住
+    trial_timeout = 60
+    db_con: DbCon = None
+    ffmpeg_path: str = None
+    ffmpeg_runner: FfmpegRunner = None
+    results: dict = None
+    lock: threading.Lock = None
+
+    def __init__(self, db_con: DbCon = None, ffmpeg_path: str = "ffmpeg", ffmpeg_runner: FfmpegRunner = None):
+        self.db_con = db_con
+        self.ffmpeg_path = ffmpeg_path
+        self.ffmpeg_runner = ffmpeg_runner if ffmpeg_runner is not None else FfmpegRunner()
+        self.results = None
+        self.lock = threading.Lock()
+
+    def get_ffmpeg_version(self) -> str:
+        stdout, _ = self.ffmpeg_runner.run([self.ffmpeg_path, "-hide_banner", "-version"])
+        return stdout.decode("u8", "replace").split("\n")[0].strip()
+
+    # ffmpeg -encoders 每行为 " V....D name  description"
+    def list_encoders(self) -> set:
+        stdout, _ = self.ffmpeg_runner.run([self.ffmpeg_path, "-hide_banner", "-encoders"])
+        encoders = set()
+        for line in stdout.decode("u8", "replace").splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and len(fields[0]) == 6 and fields[0][0] in "VAS":
+                encoders.add(fields[1])
+        return encoders
+
+    # 试编码 seconds 秒的测试画面，返回每秒编码帧数，编码失败返回 None
+    # 帧率取 ffmpeg -progress 最后输出的 fps，从开始编码起算，不含进程启动时间
+    def trial_encode(self, encoder: str, options: list, seconds: int = None) -> float:
+        if seconds is None:
+            seconds = self.trial_seconds
+        ffmpeg_args = [self.ffmpeg_path, "-hide_banner", "-v", "error", "-f", "lavfi", "-i", self.trial_source,
+                       "-t", str(seconds), "-c:v", encoder] + options + ["-f", "null", "-"]
+        progress = {}
+        start = time.perf_counter()
+        try:
+            self.ffmpeg_runner.run(ffmpeg_args, self.trial_timeout + seconds, progress.update)
+        except Exception as e:
+            log.info("encoder {} not usable. {}".format(encoder, e))
+            return None
+        elapsed = time.perf_counter() - start
+        try:
+            fps = float(progress.get("fps", 0))
+        except ValueError:
+            fps = 0
+        if fps > 0:
+            return fps
+        return seconds * 30 / elapsed if elapsed > 0 else None
+
+    # 缓存按 ffmpeg 版本和试编码时长区分，旧版本 1 秒试编码的结果不再使用
+    def __cache_key__(self, ffmpeg_version: str) -> str:
+        return "{}#trial{}s".format(ffmpeg_version, self.trial_seconds)
+
+    # 返回 {编码器: 试编码 fps}，不可用的编码器为 None。只探测一次
+    def probe(self) -> dict:
+        with self.lock:
+            if self.results is not None:
+                return self.results
+            ffmpeg_version = self.__cache_key__(self.get_ffmpeg_version())
+            results = {}
+            if self.db_con is not None:
+                for row in self.db_con.list_encoder_probe(ffmpeg_version):
+                    results[row[1]] = row[3] if row[2] else None
+            if len(results) < len(self.candidates):
+                encoders = self.list_encoders()
+                for encoder, options in self.candidates:
+                    if encoder in results:
+                        continue
+                    fps = self.trial_encode(encoder, options) if encoder in encoders else None
+                    results[encoder] = fps
+                    if self.db_con is not None:
+                        self.db_con.insert_encoder_probe(ffmpeg_version, encoder, fps is not None, fps,
+                                                         datetime.datetime.now())
+            log.info("encoder probe result {}".format(results))
+            self.results = results
+            return results
+
+    # 返回试编码最快的 (编码器, 编码参数)
+    def select_encoder(self) -> tuple:
+        results = self.probe()
+        usable = [(encoder, options) for encoder, options in self.candidates if results.get(encoder) is not None]
+        if len(usable) == 0:
+            raise Exception("no usable h264 encoder found in {}".format(self.ffmpeg_path))
+        # max 遇到相同帧率时保留先出现的，即优先顺序靠前的
+        return max(usable, key=lambda candidate: results[candidate[0]])
+
+    # 将 ffmpeg 参数模板中的 -c:v auto 替换为选出的编码器和参数
+    def resolve_ffmpeg_param(self, ffmpeg_param: str) -> str:
+        if "-c:v auto" not in ffmpeg_param:
+            return ffmpeg_param
+        encoder, options = self.select_encoder()
+        log.info("use encoder {} {}".format(encoder, options))
+        return ffmpeg_param.replace("-c:v auto", " ".join(["-c:v", encoder] + options), 1)
+
+    # 每个可用编码器试编码 seconds 秒，返回 {编码器: {"fps": 帧率, "speed": 相对实时的倍数}}
+    def benchmark(self, seconds: int = 10) -> dict:
+        encoders = self.list_encoders()
+        results = {}
+        for encoder, options in self.candidates:
+            if encoder not in encoders:
+                continue
+            fps = self.trial_encode(encoder, options, seconds)
+            if fps is None:
+                continue
+            results[encoder] = {"fps": round(fps, 1), "speed": round(fps / 30, 2)}
+            log.info("encoder {} fps {} speed {}x".format(encoder, results[encoder]["fps"], results[encoder]["speed"]))
+        return results
+
+
 '''
 文件拆分器，将一个文件拆分成指定大小的每一块。文件名同原文件_index
 '''
@@ -313,12 +1843,46 @@ class Spliter:
     max_size = None
     source_dir: str = None
     dest_dir: str = None
-
-    def __init__(self, db_con, source_dir: str,  dest_dir: str, max_size: int):
+    ffmpeg_scheduler = None
+    media_probe: MediaProbe = None
+    encoder_probe: EncoderProbe = None
+    ffmpeg_runner: FfmpegRunner = None
+    progress_callback = None
+
+    # ffmpeg_workers 为同时运行的 ffmpeg 进程数，cpu_limit 为这些进程总共可占用的核数，默认为全部核数
+    # progress_callback(file_name, segment, stats) 接收 ffmpeg 切割进度，见 FfmpegProgress
+    def __init__(self, db_con, source_dir: str,  dest_dir: str, max_size: int, ffmpeg_workers: int = 1,
+                 cpu_limit: int = None, media_probe: MediaProbe = None, encoder_probe: EncoderProbe = None,
+                 ffmpeg_runner: FfmpegRunner = None, progress_callback=None):
         self.db_con = db_con
         self.max_size = max_size
         self.dest_dir = dest_dir
         self.source_dir = source_dir
+        self.ffmpeg_scheduler = FfmpegJobScheduler(ffmpeg_workers, cpu_limit)
+        self.media_probe = media_probe if media_probe is not None else MediaProbe(db_con)
+        self.ffmpeg_runner = ffmpeg_runner if ffmpeg_runner is not None else FfmpegRunner()
+        self.encoder_probe = encoder_probe if encoder_probe is not None else EncoderProbe(db_con, ffmpeg_runner=self.ffmpeg_runner)
+        self.progress_callback = progress_callback
+
+    # name.ext -> name.index.ext
+    @staticmethod
+    def get_split_file_name(file_name: str, index: int) -> str:
+        t_of_a: list = file_name.split(".")
+        t_of_a.insert(len(t_of_a) - 1, str(index))
+        return ".".join(t_of_a)
+
+    # 片段大小取 dest_dir 中实际生成的文件，durations/offsets 与 new_filename_ary 一一对应
+    def __insert_split_file_info__(self, source_table: str, file_name: str, new_filename_ary: list,
+                                   durations: list = None, offsets: list = None) -> int:
+        parts = []
+        for i, new_filename in enumerate(new_filename_ary):
+            new_file_path = os.path.join(self.dest_dir, new_filename)
+            size = os.path.getsize(new_file_path) if os.path.exists(new_file_path) else None
+            parts.append((i + 1, new_filename, size, offsets[i] if offsets else None,
+                          durations[i] if durations else None, None))
+        return self.db_con.insert_split_file_info_with_parts(
+            source_table, file_name, os.path.getsize(os.path.join(self.source_dir, file_name)),
+            datetime.datetime.now(), parts)
 
     def split_file(self, file_name: str) -> list[str]:
         file = self.db_con.get_split_file_info_by_source_name(file_name)
@@ -326,14 +1890,16 @@ class Spliter:
             log.info("file {} already split.".format(file_name))
             return []
         origin_file_path = os.path.join(self.source_dir, file_name)
-        if not check_disk_space(dest_dir, os.path.getsize(origin_file_path)):
+        if not check_disk_space(self.dest_dir, os.path.getsize(origin_file_path)):
             log.info("disk free space is low. stop. current filename {}".format(file_name))
             exit(1)
         file_num = (os.path.getsize(origin_file_path) // self.max_size) + 1
         new_filename_ary = []
+        offsets = []
         if file_num <= 1:
             log.info("file size is {} , lt max_size {}.".format(os.path.getsize(origin_file_path), self.max_size))
             new_filename_ary.append(file_name)
+            offsets.append(0)
         else:
             log.info("file split to {} .".format(file_num))
 
@@ -343,9 +1909,7 @@ class Spliter:
                 mb: bytes = f.read(self.max_size)
                 i = 1
                 while mb:
-                    t_of_a: list = origin_filename.split(".")
-                    t_of_a.insert(len(t_of_a) - 1, str(i))
-                    new_filename: str = ".".join(t_of_a)
+                    new_filename: str = self.get_split_file_name(origin_filename, i)
                     log.info("new file is {}. index {} for {}".format(new_filename, i, origin_filename))
                     new_file_path = os.path.join(self.dest_dir, new_filename)
                     log.info("new file path in {}".format(new_file_path))
@@ -353,10 +1917,10 @@ class Spliter:
                         result_w = nf.write(mb)
                         log.info("write result is {}".format(result_w))
                     mb = f.read(self.max_size)
+                    offsets.append((i - 1) * self.max_size)
                     i += 1
                     new_filename_ary.append(new_filename)
-        self.db_con.insert_split_file_info(file_name, "#".join(new_filename_ary),
-                                           os.path.getsize(origin_file_path), datetime.datetime.now())
+        self.__insert_split_file_info__("split_file_info", file_name, new_filename_ary, offsets=offsets)
         return new_filename_ary
 
     def split_dir(self, exclude: list):
@@ -381,7 +1945,7 @@ class Spliter:
     ###
     # example param: ffmpeg -ss %d -t %d -accurate_seek -i %s -codec copy -avoid_negative_ts 1 %s
     ###
-    def split_file_with_ffmpeg(self, file_name: str, duration: int, ffmpeg_param: str):
+    def split_file_with_ffmpeg(self, file_name: str, duration: int, ffmpeg_param: str, journal: SplitJournal = None):
         file = self.db_con.get_split_file_info_by_source_name_mpeg(file_name)
         if file is not None:
             log.info("file {} already split.".format(file_name))
@@ -399,31 +1963,202 @@ class Spliter:
             new_filename_ary.append(file_name)
         else:
             log.info("file split to {} .".format(file_count_num))
+        # 片段的起止时间都可以提前算出，所有片段交给调度器并发切割，全部成功后才写入记录
+        jobs = []
+        progress = FfmpegProgress(file_name, self.progress_callback)
         for i in range(0, file_count_num):
             file_index = i + 1
             origin_filename = file_name
-            t_of_a: list = origin_filename.split(".")
-            t_of_a.insert(len(t_of_a) - 1, str(file_index))
-            new_filename: str = ".".join(t_of_a)
+            new_filename: str = self.get_split_file_name(origin_filename, file_index)
             log.info("new file is {}. index {} for {}".format(new_filename, file_index, origin_filename))
             new_file_path = os.path.join(self.dest_dir, new_filename)
             log.info("new file path in {}".format(new_file_path))
             # 众多ffmpeg的库无法实现 -ss参数前置，所以直接使用命令行
             # +1s 确保不漏掉任何frame
-            ffmpeg_cmd = ffmpeg_param % (start_time, duration + 1, origin_file_path, new_file_path)
-            result = os.popen(ffmpeg_cmd)
-            ret_msg = result.read()
-            ret_suc = result.close()
-            if ret_suc is not None:
-                raise Exception(str(ret_suc) + ret_msg)
-            log.info("file {} split result  {}".format(file_name, ret_msg))
+            ffmpeg_args = build_ffmpeg_args(ffmpeg_param, (start_time, duration + 1, origin_file_path, new_file_path))
+            self.__add_segment_job__(jobs, journal, file_index, new_file_path, start_time, duration + 1,
+                                     self.__run_ffmpeg__, (ffmpeg_args, origin_file_path), progress,
+                                     max(min(duration, media_duration - start_time), 0))
             start_time += duration
             new_filename_ary.append(new_filename)
-        self.db_con.insert_split_file_info_mpeg(file_name, "#".join(new_filename_ary),
-                                           os.path.getsize(origin_file_path), datetime.datetime.now())
+        self.ffmpeg_scheduler.run(jobs)
+        progress.finish()
+        self.__insert_split_file_info__("split_file_info_mpeg", file_name, new_filename_ary,
+                                        self.__get_segment_durations__(len(new_filename_ary), duration, media_duration))
         return new_filename_ary
 
-    def split_file_with_ffmpeg_fixed_size(self, file_name: str, max_size: int, duration: int, ffmpeg_param: str):
+    # journal 中已完成且计划一致的片段不再切割，新切出的片段完成后写入 journal
+    # progress 不为空时 fn 需接受 progress_callback 参数，output_duration 为片段实际输出的时长
+    def __add_segment_job__(self, jobs: list, journal: SplitJournal, index: int, new_file_path: str, start_time,
+                            duration, fn, args: tuple, progress: FfmpegProgress = None, output_duration=None):
+        if journal is not None and journal.is_part_done(index, "split", new_file_path, start_time, duration):
+            log.info("segment {} already done, skip.".format(new_file_path))
+            return
+        if progress is not None:
+            progress.add_segment(index, duration if output_duration is None else output_duration)
+        jobs.append((self.__run_segment_job__, (journal, index, new_file_path, start_time, duration, fn, args,
+                                                progress)))
+
+    # 进入这里的片段都未在 journal 中完成，上次中断时切了一半的文件先删掉，否则 ffmpeg 不会覆盖已存在的输出
+    # 校验和在线程中计算，不阻塞事件循环中其他片段的切割和进度
+    async def __run_segment_job__(self, journal: SplitJournal, index: int, new_file_path: str, start_time, duration,
+                                  fn, args: tuple, progress: FfmpegProgress = None):
+        if os.path.exists(new_file_path):
+            log.info("remove unfinished segment {}".format(new_file_path))
+            os.remove(new_file_path)
+        if progress is None:
+            await fn(*args)
+        else:
+            await fn(*args, progress_callback=progress.segment_callback(index))
+            progress.finish_segment(index)
+        if journal is not None:
+            checksum = await asyncio.to_thread(file_crc32, new_file_path)
+            journal.mark_file_done(index, "split", new_file_path, start_time, duration, checksum)
+
+    # 按固定时长切割时每段的时长，最后一段到文件末尾
+    def __get_segment_durations__(self, count: int, duration: float, media_duration: float) -> list:
+        return [max(min(duration, media_duration - i * duration), 0) for i in range(0, count)]
+
+    # 使用 ffmpeg segment 复用器一次性切出所有片段(-codec copy)，只顺序读取一遍源文件
+    # segment_times 不为空时按指定时间点切割，否则每 duration 秒一段
+    def split_file_with_segment(self, file_name: str, duration: int, segment_times: list = None):
+        file = self.db_con.get_split_file_info_by_source_name_mpeg(file_name)
+        if file is not None:
+            log.info("file {} already split.".format(file_name))
+            return
+        origin_file_path = os.path.join(self.source_dir, file_name)
+        if not check_disk_space(self.dest_dir, os.path.getsize(origin_file_path)):
+            log.info("disk free space is low. stop. current filename {}".format(file_name))
+            exit(1)
+        # name.ext -> name.%d.ext，文件名中的 % 需要转义
+        output_pattern = os.path.join(self.dest_dir, self.get_split_file_name(file_name.replace("%", "%%"), "%d"))
+        segment_list_path = os.path.join(self.dest_dir, file_name + ".segments.csv")
+        ffmpeg_args = ["ffmpeg", "-i", origin_file_path, "-map", "0", "-codec", "copy", "-f", "segment"]
+        if segment_times:
+            ffmpeg_args += ["-segment_times", ",".join([str(t) for t in segment_times])]
+        else:
+            ffmpeg_args += ["-segment_time", str(duration)]
+        ffmpeg_args += ["-segment_start_number", "1", "-reset_timestamps", "1", "-avoid_negative_ts", "1",
+                        "-segment_list", segment_list_path, "-segment_list_type", "csv",
+                        "-loglevel", "warning", "-y", output_pattern]
+        _, ret_msg = self.ffmpeg_runner.run(ffmpeg_args)
+        log.info("file {} split result  {}".format(file_name, ret_msg))
+        segment_list = self.__read_segment_list__(segment_list_path)
+        os.remove(segment_list_path)
+        new_filename_ary = [segment[0] for segment in segment_list]
+        for index, new_filename in enumerate(new_filename_ary):
+            if new_filename != self.get_split_file_name(file_name, index + 1):
+                raise Exception("segment {} of file {} not match name.index.ext".format(new_filename, file_name))
+        log.info("file {} split to {} .".format(file_name, len(new_filename_ary)))
+        self.__insert_split_file_info__("split_file_info_mpeg", file_name, new_filename_ary,
+                                        [round(end_time - start_time, 3) for _, start_time, end_time in segment_list])
+        return new_filename_ary
+
+    # segment 列表 csv 每行为 文件名,开始时间,结束时间，返回 [(文件名, 开始时间, 结束时间)]
+    def __read_segment_list__(self, segment_list_path: str) -> list:
+        with open(segment_list_path, "r", encoding="u8", newline="") as f:
+            return [(os.path.basename(row[0]), float(row[1]), float(row[2])) for row in csv.reader(f) if len(row) > 2]
+
+    def split_dir_with_segment(self, exclude: list, duration: int):
+        l_files = os.listdir(self.source_dir)
+        for f_name in l_files:
+            need_continue = False
+            for ec in exclude:
+                re_ec = re.compile(ec)
+                res_s = re_ec.search(f_name)
+                if res_s is not None:
+                    log.info("cause by {}, pass {}".format(ec, f_name))
+                    need_continue = True
+                    break
+            split_file_info = self.db_con.get_split_file_info_by_source_name_mpeg(f_name)
+            if split_file_info is not None:
+                log.info("file {} already split.".format(f_name))
+                need_continue = True
+            if need_continue:
+                continue
+            if not os.path.isfile(os.path.join(self.source_dir, f_name)):
+                log.info("file {} not file.".format(f_name))
+                continue
+            self.split_file_with_segment(f_name, duration)
+
+    # ffprobe 一次读出全部 packet 索引，返回 [(时间, 字节数, 是否可切割的关键帧)]，按时间排序
+    # 有视频流时只有视频关键帧可作为切割点，纯音频文件每个 packet 都可切割
+    def probe_packets(self, file_path: str) -> list:
+        ffprobe_args = ["ffprobe", "-v", "error", "-show_entries",
+                        "packet=stream_index,pts_time,dts_time,size,flags:stream=index,codec_type",
+                        "-of", "compact=p=1:nk=0", file_path]
+        try:
+            stdout, _ = self.ffmpeg_runner.run(ffprobe_args)
+        except Exception as e:
+            log.error("ffprobe error file{}, exception{}".format(file_path, e))
+            raise e
+        stream_types = {}
+        raw_packets = []
+        for line in stdout.decode("u8", "replace").splitlines():
+            section, _, fields = line.partition("|")
+            entry = dict(kv.split("=", 1) for kv in fields.split("|") if "=" in kv)
+            if section == "stream":
+                stream_types[entry.get("index")] = entry.get("codec_type")
+            elif section == "packet":
+                raw_packets.append(entry)
+        has_video = "video" in stream_types.values()
+        packets = []
+        last_time = 0.0
+        for entry in raw_packets:
+            packet_time = entry.get("pts_time", "N/A")
+            if packet_time == "N/A":
+                packet_time = entry.get("dts_time", "N/A")
+            # 没有时间戳的 packet 归到前一个 packet 所在的片段
+            packet_time = last_time if packet_time == "N/A" else float(packet_time)
+            last_time = packet_time
+            is_key = "K" in entry.get("flags", "")
+            if has_video:
+                is_key = is_key and stream_types.get(entry.get("stream_index")) == "video"
+            packets.append((packet_time, int(entry.get("size", 0)), is_key))
+        packets.sort(key=lambda p: p[0])
+        return packets
+
+    # 按 packet 累计字节数计算切割点：每段在不超过 budget 的前提下切在最后一个关键帧处
+    # 返回 [(开始时间, 时长)]，最后一段时长覆盖到文件末尾
+    @staticmethod
+    def plan_fixed_size_segments(packets: list, start_time: float, budget: int, media_duration: float) -> list:
+        cut_times = [start_time]
+        segment_size = 0
+        last_key_time = None
+        size_before_last_key = 0
+        for packet_time, packet_size, is_key in packets:
+            if packet_time < start_time:
+                continue
+            if is_key and packet_time > cut_times[-1]:
+                if segment_size > budget:
+                    # 单个 GOP 已超过 budget，只能切在下一个关键帧，由调用方处理超出的片段
+                    log.warning("gop before {} larger than budget {}".format(packet_time, budget))
+                    cut_times.append(packet_time)
+                    segment_size = 0
+                    last_key_time = None
+                else:
+                    last_key_time = packet_time
+                    size_before_last_key = segment_size
+            segment_size += packet_size
+            if segment_size > budget and last_key_time is not None:
+                cut_times.append(last_key_time)
+                segment_size -= size_before_last_key
+                last_key_time = None
+        segments = []
+        for i, cut_time in enumerate(cut_times):
+            if i + 1 < len(cut_times):
+                segments.append((cut_time, cut_times[i + 1] - cut_time))
+            else:
+                # +1s 确保不漏掉任何frame
+                segments.append((cut_time, max(media_duration - cut_time, 0) + 1))
+        return segments
+
+    ###
+    # 先用 ffprobe 的 packet 索引算好所有切割点，每个片段只切一次，不再反复试切调整时长
+    # example param: ffmpeg -ss %d -t %d -accurate_seek -i "%s" -codec copy -avoid_negative_ts 1 "%s"
+    ###
+    def split_file_with_ffmpeg_fixed_size(self, file_name: str, max_size: int, duration: int, ffmpeg_param: str,
+                                          journal: SplitJournal = None):
         file = self.db_con.get_split_file_info_by_source_name_mpeg(file_name)
         if file is not None:
             log.info("file {} already split.".format(file_name))
@@ -432,96 +2167,66 @@ class Spliter:
         if not check_disk_space(self.dest_dir, os.path.getsize(origin_file_path)):
             log.info("disk free space is low. stop. current filename {}".format(file_name))
             exit(1)
-        start_time = 0
         new_filename_ary = []
         media_duration = self.get_media_duration_time(origin_file_path)
-        calc_duration = self.cacl_media_duration_by_fixed_size(max_size, origin_file_path)
-        file_count_num = int(media_duration // duration) + 1
-        if media_duration <= duration:
+        if media_duration <= duration or os.path.getsize(origin_file_path) <= max_size:
             log.info("media duration is {} , lt {}.".format(media_duration, duration))
             new_filename_ary.append(file_name)
             shutil.copyfile(origin_file_path, os.path.join(self.dest_dir, file_name))
             return new_filename_ary
-        else:
-            log.info("file split to {} .".format(file_count_num))
-        for i in range(0, file_count_num):
-            file_index = i + 1
-            origin_filename = file_name
-            t_of_a: list = origin_filename.split(".")
-            t_of_a.insert(len(t_of_a) - 1, str(file_index))
-            new_filename: str = ".".join(t_of_a)
-            log.info("new file is {}. index {} for {}".format(new_filename, file_index, origin_filename))
-            new_file_path = os.path.join(self.dest_dir, new_filename)
-            log.info("new file path in {}".format(new_file_path))
-            is_file_size_ok = False
-            exec_time = 0
-            real_duration = duration
-            last_file_size = 0
-            one_sec_size = 0
-            is_first_round = True
-            exec_time_list = []
-            while not is_file_size_ok:
-                # 众多ffmpeg的库无法实现 -ss参数前置，所以直接使用命令行
-                if exec_time != 0 or is_first_round:
-                    log.info("change duration for file {} time {}".format(new_filename, exec_time))
-                    real_duration = calc_duration + exec_time
-                    if real_duration <= 0:
-                        log.warning("file {} real_duration is {} exception.".format(new_filename, real_duration))
-                        raise Exception("file {} real_duration is {} exception.".format(new_filename, real_duration))
-                    ffmpeg_cmd = ffmpeg_param % (start_time, real_duration, origin_file_path, new_file_path)
-                    result = os.popen(ffmpeg_cmd)
-                    ret_msg = result.read()
-                    ret_suc = result.close()
-                    if ret_suc is not None:
-                        raise Exception(str(ret_suc) + ret_msg)
-                    #计算切片文件大小是否符合maxsize，误差1s
-                    cur_file_size = os.path.getsize(new_file_path)
-                    file_size_check = (cur_file_size) - max_size
-                    is_file_size_ok = False
-                    if abs(file_size_check) <= one_sec_size and file_size_check >= 0:#差距小于1s
-                        break
-                    if exec_time in exec_time_list:
-                        log.info("stop loop 1s file size split.")
-                        break
-                    else:
-                        is_file_size_ok = False
-                    is_first_round = False
-                    exec_time_list.append(exec_time)
-                if last_file_size != 0 and cur_file_size != last_file_size:#利用文件大小差距计算增减时间
-                    one_sec_size = cur_file_size - last_file_size
-                    addtion_sec = int((max_size - cur_file_size) / one_sec_size)
-                    if abs(addtion_sec) > (calc_duration / 2):
-                        if addtion_sec >= 0:
-                            exec_time += calc_duration / 2
-                        else:
-                            exec_time -= calc_duration / 2
-                    elif addtion_sec == 0:
-                        exec_time += 1
-                    else:
-                        exec_time += addtion_sec
-                elif cur_file_size == last_file_size and not is_file_size_ok:
-                    if real_duration > media_duration:
-                        # 最个一个片段： 计算时间比实际时间长，直接复制
-                        new_filename_ary.append(new_filename)
-                        self.db_con.insert_split_file_info_mpeg(file_name, "#".join(new_filename_ary),
-                                                                os.path.getsize(origin_file_path),
-                                                                datetime.datetime.now())
-                        return new_filename_ary
-                    elif start_time + real_duration > media_duration:
-                        new_filename_ary.append(new_filename)
-                        self.db_con.insert_split_file_info_mpeg(file_name, "#".join(new_filename_ary),
-                                                                os.path.getsize(origin_file_path),
-                                                                datetime.datetime.now())
-                        # 计算时间分块时;间已经到末尾，最大时长
-                        return new_filename_ary
-                    else:
-                        exec_time += 1
-                last_file_size = cur_file_size
-            log.info("file {} split result  {}".format(file_name, ret_msg))
-            start_time += real_duration
-            new_filename_ary.append(new_filename)
-        self.db_con.insert_split_file_info_mpeg(file_name, "#".join(new_filename_ary),
-                                           os.path.getsize(origin_file_path), datetime.datetime.now())
+        # 切割点精确到毫秒，%d 会截断小数
+        ffmpeg_param = ffmpeg_param.replace("%d", "%s")
+        packets = self.probe_packets(origin_file_path)
+        # 预留 2% 给容器头等额外开销
+        budget = max_size - max_size // 50
+        segments = self.plan_fixed_size_segments(packets, 0, budget, media_duration)
+        log.info("file split to {} .".format(len(segments)))
+        first_index = 0
+        retry = 0
+        while True:
+            jobs = []
+            progress = FfmpegProgress(file_name, self.progress_callback)
+            for i in range(first_index, len(segments)):
+                start_time, real_duration = segments[i]
+                new_filename: str = self.get_split_file_name(file_name, i + 1)
+                new_file_path = os.path.join(self.dest_dir, new_filename)
+                log.info("new file is {}. start {} duration {}".format(new_file_path, start_time, real_duration))
+                ffmpeg_args = build_ffmpeg_args(ffmpeg_param, ("%.3f" % start_time, "%.3f" % real_duration,
+                                                               origin_file_path, new_file_path))
+                self.__add_segment_job__(jobs, journal, i + 1, new_file_path, start_time, real_duration,
+                                         self.__run_ffmpeg__, (ffmpeg_args, origin_file_path), progress,
+                                         min(real_duration, media_duration - start_time))
+            self.ffmpeg_scheduler.run(jobs)
+            progress.finish()
+            oversize_index = None
+            for i in range(first_index, len(segments)):
+                cur_file_size = os.path.getsize(os.path.join(self.dest_dir, self.get_split_file_name(file_name, i + 1)))
+                if cur_file_size > max_size:
+                    oversize_index = i
+                    break
+            if oversize_index is None:
+                break
+            retry += 1
+            if retry > 3:
+                raise Exception("file {} segment {} still larger than {} after re-plan".format(
+                    file_name, oversize_index + 1, max_size))
+            # 容器开销超出预估时，按实际比例缩小 budget，从超出的片段开始重新规划剩余部分
+            # 2% 余量已包含在初始 budget 中，这里只按比例缩放，不再重复扣除
+            budget = int(budget * max_size / cur_file_size)
+            log.info("segment {} size {} over {}, re-plan with budget {}".format(
+                oversize_index + 1, cur_file_size, max_size, budget))
+            for i in range(oversize_index, len(segments)):
+                stale_file_path = os.path.join(self.dest_dir, self.get_split_file_name(file_name, i + 1))
+                if os.path.exists(stale_file_path):
+                    os.remove(stale_file_path)
+            segments = segments[:oversize_index] + self.plan_fixed_size_segments(
+                packets, segments[oversize_index][0], budget, media_duration)
+            first_index = oversize_index
+        for i in range(0, len(segments)):
+            new_filename_ary.append(self.get_split_file_name(file_name, i + 1))
+        self.__insert_split_file_info__("split_file_info_mpeg", file_name, new_filename_ary,
+                                        [min(real_duration, media_duration - start_time)
+                                         for start_time, real_duration in segments])
         return new_filename_ary
 
 
@@ -569,25 +2274,15 @@ class Spliter:
             self.split_file_with_ffmpeg_fixed_size(f_name, max_size, duration, ffmpeg_param)
 
     def cacl_media_duration_by_fixed_size(self, max_size: int, file_name: str):
-        probe: dict = ffmpeg.probe(os.path.join(self.source_dir, file_name))
-        rate = 0
-        for stream in probe.get("streams"):
-            bit_rate_val = stream.get("bit_rate")
-            if bit_rate_val is None:
-                bit_rate_val = 64 * 1000
-            bit_rate = int(bit_rate_val)
-            if bit_rate is None:
-                raise Exception("file {} stream {} bit_rate is None. probe is {}".format(file_name, stream.get("index"), probe))
-            rate += bit_rate
+        rate = self.media_probe.get_bit_rate(os.path.join(self.source_dir, file_name))
+        if rate <= 0:
+            raise Exception("file {} bit_rate is {}.".format(file_name, rate))
         duration = 8 * (max_size - 10 * 1024 * 1024) // rate
         return duration
 
     def get_media_duration_time(self, file_path: str):
         try:
-            result = os.popen("ffprobe -i \"%s\" -show_entries format=duration -v quiet -of csv=\"p=0\"" % file_path)
-            result_plant = result.readlines().pop(0)
-            result.close()
-            return float(result_plant.strip())
+            return self.media_probe.get_duration(file_path)
         except Exception as e:
             log.error("ffprobe error file{}, exception{}".format(file_path, e))
             raise e
@@ -612,7 +2307,8 @@ class Spliter:
             self.split_file_with_translate(f_name, duration, ffmpeg_param)
 
     # return split file name list
-    def split_file_with_translate(self, file_name: str, duration: int, ffmpeg_param: str) -> list[str]:
+    def split_file_with_translate(self, file_name: str, duration: int, ffmpeg_param: str,
+                                  journal: SplitJournal = None) -> list[str]:
         file = self.db_con.get_split_file_info_by_source_name_translate(file_name)
         if file is not None:
             log.info("file {} already split.".format(file_name))
@@ -630,17 +2326,22 @@ class Spliter:
             new_filename_ary.append(file_name)
         else:
             log.info("file split to {} .".format(file_count_num))
+        # -c:v auto 时使用本机最快的可用编码器
+        ffmpeg_param = self.encoder_probe.resolve_ffmpeg_param(ffmpeg_param)
+        jobs = []
+        progress = FfmpegProgress(file_name, self.progress_callback)
         for i in range(0, file_count_num):
             file_index = i + 1
             origin_filename = file_name
-            t_of_a: list = origin_filename.split(".")
-            t_of_a.insert(len(t_of_a) - 1, str(file_index))
-            new_filename: str = ".".join(t_of_a)
+            new_filename: str = self.get_split_file_name(origin_filename, file_index)
             log.info("new file is {}. index {} for {}".format(new_filename, file_index, origin_filename))
             new_file_path = os.path.join(self.dest_dir, new_filename)
             log.info("new file path in {}".format(new_file_path))
             # 众多ffmpeg的库无法实现 -ss参数前置，所以直接使用命令行
-            self.__ffmpeg_cmd__(ffmpeg_param, start_time, duration, origin_file_path, new_file_path)
+            self.__add_segment_job__(jobs, journal, file_index, new_file_path, start_time, duration,
+                                     self.__ffmpeg_cmd__, (ffmpeg_param, start_time, duration, origin_file_path,
+                                                           new_file_path), progress,
+                                     max(min(duration, media_duration - start_time), 0))
             # ffmpeg_cmd = ffmpeg_param % (start_time, duration, "\"" + origin_file_path + "\"", "\"" + new_file_path + "\"")
             # log.info("cmd: {}".format(ffmpeg_cmd))
             # result = os.popen(ffmpeg_cmd)
@@ -652,31 +2353,37 @@ class Spliter:
             # result.close()
             start_time += duration
             new_filename_ary.append(new_filename)
-        self.db_con.insert_split_file_info_translate(file_name, "#".join(new_filename_ary),
-                                                os.path.getsize(origin_file_path), datetime.datetime.now())
+        # 转码最耗时，所有片段并发转码，全部成功后才写入记录
+        self.ffmpeg_scheduler.run(jobs)
+        progress.finish()
+        self.__insert_split_file_info__("split_file_info_translate", file_name, new_filename_ary,
+                                        self.__get_segment_durations__(len(new_filename_ary), duration, media_duration))
         return new_filename_ary
 
-    def __ffmpeg_cmd__(self, ffmpeg_param: str, start_time: int, duration: int, origin_file_path: str, new_file_path: str):
-        ffmpeg_cmd = ffmpeg_param % (start_time, duration, "\"" + origin_file_path + "\"", "\"" + new_file_path + "\"")
-        log.info("cmd: {}".format(ffmpeg_cmd))
-        result = os.popen(ffmpeg_cmd)
-        ret_msg = result.read()
-        ret_suc = result.close()
-        if ret_suc is not None:
-            log.error("ffmpeg_cmd: {}".format(ffmpeg_cmd))
-            raise Exception(str(ret_suc) + ret_msg)
+    async def __ffmpeg_cmd__(self, ffmpeg_param: str, start_time: int, duration: int, origin_file_path: str,
+                             new_file_path: str, progress_callback=None):
+        ffmpeg_args = build_ffmpeg_args(ffmpeg_param, (start_time, duration, origin_file_path, new_file_path))
+        if self.ffmpeg_scheduler.max_workers > 1:
+            # 并发转码时限制每个进程的编码线程数，-i 输入之后的参数作用于输出
+            input_index = ffmpeg_args.index(origin_file_path) + 1
+            ffmpeg_args[input_index:input_index] = ["-threads", str(self.ffmpeg_scheduler.threads_per_job)]
+        await self.__run_ffmpeg__(ffmpeg_args, origin_file_path, progress_callback)
+
+    async def __run_ffmpeg__(self, ffmpeg_args: list, origin_file_path: str, progress_callback=None):
+        _, ret_msg = await self.ffmpeg_runner.run_async(ffmpeg_args, progress_callback=progress_callback)
         log.info("file {} split result  {}".format(origin_file_path, ret_msg))
-        result.close()
 
 class Combo:
     db_con: DbCon = None
     source_dir: str = None
     dest_dir: str = None
+    ffmpeg_runner: FfmpegRunner = None
 
-    def __init__(self, db_con, source_dir: str,  dest_dir: str):
+    def __init__(self, db_con, source_dir: str,  dest_dir: str, ffmpeg_runner: FfmpegRunner = None):
         self.db_con = db_con
         self.dest_dir = dest_dir
         self.source_dir = source_dir
+        self.ffmpeg_runner = ffmpeg_runner if ffmpeg_runner is not None else FfmpegRunner()
 
     def combo_file(self, file_name: str):
         source_name = self.__get_source_name_by_new_name(file_name)
@@ -689,21 +2396,15 @@ class Combo:
             log.info("source file info {} not found.".format(source_name))
             return
         source_file_path = os.path.join(self.dest_dir, source_name)
-        with open(source_file_path, "wb") as f:
-            new_name: str = file_info[2]
-            new_name_ary = new_name.split("#")
-            for nn in new_name_ary:
-                split_file_path = os.path.join(self.source_dir, nn)
-                if not os.path.exists(split_file_path):
-                    log.info("split file {} not found. exit this process.".format(split_file_path))
-                    return
-                with open(split_file_path, "rb") as sf:
-                    buff_size = 1024 * 1024 * 10
-                    mb = sf.read(buff_size)
-                    while mb:
-                        f.write(mb)
-                        mb = sf.read(buff_size)
-                log.info("split file {} combo done.".format(nn))
+        try:
+            group_file = EncryptedGroupFile.open_split_file_info(self.db_con, self.source_dir, "split_file_info",
+                                                                 file_info)
+        except Exception as e:
+            log.info("{}. exit this process.".format(e))
+            return
+        with group_file, open(source_file_path, "wb") as f:
+            shutil.copyfileobj(group_file, f, 1024 * 1024 * 10)
+        log.info("split file {} combo done.".format(source_name))
 
     def combo_dir(self):
         l_files = os.listdir(self.source_dir)
@@ -728,22 +2429,21 @@ class Combo:
             log.info("source file info {} not found.".format(source_name))
             return
         source_file_path = os.path.join(self.dest_dir, source_name)
-        new_name: str = file_info[2]
-        new_name_ary = new_name.split("#")
+        new_name_ary = self.db_con.list_split_file_part_names("split_file_info_mpeg", file_info)
         new_name_path_ary: list = []
         for nn in new_name_ary:
             split_file_path = os.path.join(self.source_dir, nn)
             if not os.path.exists(split_file_path):
                 log.info("split file {} not found. exit this process.".format(split_file_path))
                 return
-            new_name_path_ary.append("file '" + split_file_path.replace("\\", "/") + "'")
+            # concat 列表中的相对路径相对于列表文件，单引号需要转义为 '\''
+            new_name_path_ary.append("file '" + os.path.abspath(split_file_path).replace("\\", "/")
+                                     .replace("'", "'\\''") + "'")
         concat_file_path = os.path.join(self.dest_dir, "concat.txt")
         with open(concat_file_path, "w", encoding="u8") as cf:
             cf.write('\n'.join(new_name_path_ary))
-        cmd = ffmpeg_param % (concat_file_path, "\"" + source_file_path + "\"")
-        result = os.popen(cmd)
-        log.info("split file {} reuslut is {} combo done.".format(source_name, result.readlines()))
-        result.close()
+        _, ret_msg = self.ffmpeg_runner.run(build_ffmpeg_args(ffmpeg_param, (concat_file_path, source_file_path)))
+        log.info("split file {} reuslut is {} combo done.".format(source_name, ret_msg))
 
     def combo_dir_with_ffmpeg(self, ffmpeg_param: str):
         l_files = os.listdir(self.source_dir)
@@ -760,31 +2460,114 @@ class SplitAndEncrypt:
     source_dir: str
     dest_dir: str
     max_size: int
-
-    def __init__(self, db_con: DbCon, source_dir: str,  dest_dir: str, key: str, max_size: int = 99 * 1024 * 1024):
+    ffmpeg_workers: int
+    media_probe: MediaProbe
+    encoder_probe: EncoderProbe
+    progress_callback = None
+    chunk_size = 1024 * 1024 * 16
+
+    def __init__(self, db_con: DbCon, source_dir: str,  dest_dir: str, key: str, max_size: int = 99 * 1024 * 1024,
+                 ffmpeg_workers: int = 1, progress_callback=None):
         self.db_con = db_con
+        self.ffmpeg_workers = ffmpeg_workers
+        self.progress_callback = progress_callback
+        self.media_probe = MediaProbe(db_con)
+        self.encoder_probe = EncoderProbe(db_con)
         self.combo = Combo(db_con, source_dir, dest_dir)
-        self.split = Spliter(db_con, source_dir, dest_dir, max_size)
+        self.split = Spliter(db_con, source_dir, dest_dir, max_size, ffmpeg_workers, media_probe=self.media_probe,
+                             encoder_probe=self.encoder_probe, progress_callback=progress_callback)
         self.encrypt = MediaEncrypt(db_con)
         self.encrypt_key = key
         self.source_dir = source_dir
         self.dest_dir = dest_dir
         self.max_size = max_size
 
+    # 单次读取源文件，按max_size切块的同时加密，直接写入dest_dir，不再经过tmp目录中转
+    # return dest dir
     def split_and_encrypt_file(self, file_name: str) -> str:
-        tmp_dir: str = os.path.join(self.source_dir, "tmp")
-        if not os.path.exists(tmp_dir):
-            os.mkdir(tmp_dir)
-        s: Spliter = Spliter(self.db_con, self.source_dir, tmp_dir, self.max_size)
-        split_file_name_list: list[str] = s.split_file(file_name)
-        group_name: str = self.db_con.get_split_file_info_by_source_name(file_name)[0]
-        log.info("split file list is {} group name is {}".format(split_file_name_list, group_name))
-        self.encrypt.encrypt_files_with_subfix_by_group(self.encrypt_key, tmp_dir, self.dest_dir, group_name)
-        log.info("encrypt {} done, delete source files".format(split_file_name_list))
-        self.delete_files(tmp_dir, split_file_name_list)
-        return tmp_dir
+        is_recorded = self.db_con.get_split_file_info_by_source_name(file_name) is not None
+        if is_recorded and not SplitJournal.is_running(self.db_con, "SAE", file_name):
+            log.info("file {} already split.".format(file_name))
+            return self.dest_dir
+        if is_recorded:
+            # 记录已提交，在改名阶段中断
+            journal = SplitJournal(self.db_con, "SAE", self.source_dir, file_name)
+            journal.restore_parts(self.dest_dir, "encrypt")
+            journal.sweep_tmp(self.dest_dir)
+            journal.finish()
+            log.info("split and encrypt {} restored".format(file_name))
+            return self.dest_dir
+        origin_file_path = os.path.join(self.source_dir, file_name)
+        file_size = os.path.getsize(origin_file_path)
+        if not os.path.exists(self.dest_dir):
+            os.mkdir(self.dest_dir)
+        if not check_disk_space(self.dest_dir, file_size):
+            log.info("disk free space is low. stop. current filename {}".format(file_name))
+            exit(1)
+        key_byte = self.encrypt.get_key_byte(self.encrypt_key)
+        is_single = (file_size // self.max_size) + 1 <= 1
+        part_count = max(1, -(-file_size // self.max_size))
+        # 组名是split_file_info的id，所有片段写完才插入记录，所以先写入临时文件名，最后再改名
+        # 每个加密完成的临时文件记录到任务日志，中断后重跑只处理未完成的片段
+        journal = SplitJournal(self.db_con, "SAE", self.source_dir, file_name)
+        journal.sweep_tmp(self.dest_dir)
+        parts: list = []
+        with open(origin_file_path, "rb") as f:
+            for index in range(1, part_count + 1):
+                offset = (index - 1) * self.max_size
+                length = min(self.max_size, file_size - offset)
+                part_name = file_name if is_single else Spliter.get_split_file_name(file_name, index)
+                done_part = journal.get_part(index, "encrypt")
+                if done_part is not None and journal.is_part_done(
+                        index, "encrypt", os.path.join(self.dest_dir, done_part[3]), offset, length):
+                    log.info("file {} already encrypted to {}, skip.".format(part_name, done_part[3]))
+                    parts.append((part_name, os.path.join(self.dest_dir, done_part[3]), done_part[6]))
+                    continue
+                tmp_file_path = os.path.join(self.dest_dir, journal.tmp_name(index, "encrypt"))
+                try:
+                    f.seek(offset)
+                    with open(tmp_file_path, "wb") as of:
+                        crc_writer = Crc32Writer(of)
+                        part_size = self.encrypt.xor_stream(key_byte, f, crc_writer, length, self.chunk_size)
+                except Exception as e:
+                    if os.path.exists(tmp_file_path):
+                        os.remove(tmp_file_path)
+                    raise e
+                journal.mark_part_done(index, "encrypt", os.path.basename(tmp_file_path), part_size,
+                                       crc_writer.hexdigest(), offset, length)
+                log.info("new file is {}. index {} for {}".format(part_name, index, file_name))
+                parts.append((part_name, tmp_file_path, part_size))
+        # 拆分记录、片段记录和所有加密记录在同一个事务里提交，同时任务日志改记最终文件名
+        # 改名完成后才结束任务日志，改名中断时重跑会继续改名
+        with self.db_con.transaction():
+            offset = 0
+            split_file_parts = []
+            for index, (part_name, tmp_file_path, part_size) in enumerate(parts):
+                checksum = journal.get_part(index + 1, "encrypt")[7]
+                split_file_parts.append((index + 1, part_name, part_size, offset, None, checksum))
+                offset += part_size
+            group_name = self.db_con.insert_split_file_info_with_parts("split_file_info", file_name, file_size,
+                                                                       datetime.datetime.now(), split_file_parts)
+            new_names = self.encrypt.anonymous_filenames_with_subfix_by_group(
+                [(part_name, part_size) for part_name, tmp_file_path, part_size in parts], group_name)
+            for index, new_name in enumerate(new_names):
+                done_part = journal.get_part(index + 1, "encrypt")
+                journal.mark_part_done(index + 1, "encrypt", new_name, done_part[6], done_part[7], done_part[4],
+                                       done_part[5])
+        for (part_name, tmp_file_path, part_size), new_name in zip(parts, new_names):
+            os.replace(tmp_file_path, os.path.join(self.dest_dir, new_name))
+            log.info("file {} encrypted to {}.".format(part_name, new_name))
+        journal.finish()
+        log.info("split and encrypt {} done, group name is {}".format(file_name, group_name))
+        return self.dest_dir
 
     def split_and_encrypt_dir(self, exclude: list):
+        try:
+            self.__split_and_encrypt_files__(exclude)
+        finally:
+            self.encrypt.release_buffers()
+
+    def __split_and_encrypt_files__(self, exclude: list):
         l_files = os.listdir(self.source_dir)
         for f_name in l_files:
             need_continue = False
@@ -796,7 +2579,7 @@ class SplitAndEncrypt:
                     need_continue = True
                     break
             split_file_info = self.db_con.get_split_file_info_by_source_name(f_name)
-            if split_file_info is not None:
+            if split_file_info is not None and not SplitJournal.is_running(self.db_con, "SAE", f_name):
                 log.info("file {} already split.".format(f_name))
                 need_continue = True
             if need_continue:
@@ -806,32 +2589,63 @@ class SplitAndEncrypt:
                 continue
             self.split_and_encrypt_file(f_name)
 
+    # file_name_array 为同一组的 meta_info 记录。按 split_file_info 中的片段顺序逐个解密，直接追加写入最终文件
     def decrypt_and_combo_file(self, file_name_array: list):
-        tmp_dir: str = os.path.join(self.source_dir, "tmp")
-        delete_file_name_array: list = []
-        if not os.path.exists(tmp_dir):
-            os.mkdir(tmp_dir)
-        for fn in file_name_array:
-            fn_path: str = os.path.join(self.source_dir, fn[2])
-            dest_path = os.path.join(tmp_dir, fn[1])
-            self.encrypt.decrypt_file(self.encrypt_key, fn_path, dest_path)
-            delete_file_name_array.append(fn[1])
-        log.info("decrypt {} done".format(file_name_array))
-        cb: Combo = Combo(self.db_con, tmp_dir, self.dest_dir)
-        cb.combo_dir()
-        log.info("combo {} done".format(file_name_array))
-        self.delete_files(tmp_dir, delete_file_name_array)
-
+        if len(file_name_array) == 0:
+            return
+        group_name: str = file_name_array[0][2].split("#")[0]
+        group = EncryptedGroupFile.list_group_part_paths(self.db_con, self.source_dir, group_name, file_name_array)
+        if group is None:
+            return
+        source_name, split_file_paths = group
+        if not os.path.exists(self.dest_dir):
+            os.mkdir(self.dest_dir)
+        source_file_path = os.path.join(self.dest_dir, source_name)
+        if os.path.exists(source_file_path):
+            log.info("source {} already found.".format(source_name))
+            return
+        if not self.__verify_group_parts__(group_name, split_file_paths):
+            return
+        # 先写入临时文件，全部片段完成后再改名，避免中断后残缺文件被当作已完成
+        tmp_file_path = source_file_path + ".tmp"
+        try:
+            with EncryptedGroupFile(split_file_paths, self.encrypt_key, source_name, self.encrypt.cipher.name) as gf, \
+                    open(tmp_file_path, "wb") as f:
+                shutil.copyfileobj(gf, f, self.chunk_size)
+            os.replace(tmp_file_path, source_file_path)
+        finally:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+        log.info("decrypt and combo {} to {} done".format(group_name, source_file_path))
+
+    # 解密前核对片段记录中的 crc32，没有校验和的旧记录跳过
+    def __verify_group_parts__(self, group_name: str, split_file_paths: list) -> bool:
+        parts = self.db_con.list_split_file_parts("split_file_info", int(group_name))
+        for part, split_file_path in zip(parts, split_file_paths):
+            if part[8] is not None and file_crc32(split_file_path) != part[8]:
+                log.error("split file {} checksum mismatch, group {} skipped.".format(split_file_path, group_name))
+                return False
+        return True
+
+    # 不落盘播放整组：把组内片段按顺序拼接为一个流加入 server，返回播放地址
+    def stream_group(self, server, group_name: str) -> str:
+        group = EncryptedGroupFile.list_group_part_paths(self.db_con, self.source_dir, group_name)
+        if group is None:
+            raise Exception("group {} not found".format(group_name))
+        source_name, split_file_paths = group
+        return server.add_stream(self.encrypt_key, split_file_paths, source_name)
+
+    # 一次遍历目录按组名分桶，再一次批量查询所有组的记录，整组交给 decrypt_and_combo_file
     def decrypt_and_combo_dir(self, exclude: list):
         l_files: list[str] = os.listdir(self.source_dir)
-        already_process_file_arr: list[str] = []
+        exclude_res = [re.compile(ec) for ec in exclude]
+        file_groups: dict = {}
         for f_name in l_files:
             need_continue = False
-            for ec in exclude:
-                re_ec = re.compile(ec)
+            for re_ec in exclude_res:
                 res_s = re_ec.search(f_name)
                 if res_s is not None:
-                    log.info("cause by {}, pass {}".format(ec, f_name))
+                    log.info("cause by {}, pass {}".format(re_ec.pattern, f_name))
                     need_continue = True
                     break
             if need_continue:
@@ -843,68 +2657,117 @@ class SplitAndEncrypt:
             if f_name.find("#") == -1:
                 log.warning("file {} not a group encrypt file.".format(f_name))
                 continue
-            else:
-                # 是否是已处理过的组文件
-                if f_name in already_process_file_arr:
-                    log.warning("file {} already handled".format(f_name))
-                    continue
-                # 匹配本地文件和数据库记录
-                f_group_name: str = f_name.split("#")[0]
-                file_group_array: list[str] = []
-                for f in l_files:
-                    if f.find(f_group_name + "#") != -1:
-                        file_group_array.append(f)
-                new_filename_array = self.encrypt.get_all_real_filename_by_group(f_group_name)
-                if len(new_filename_array) != len(file_group_array):
-                    log.warning("local file not match db record. local files {}, db records {}"
-                                .format(file_group_array, new_filename_array))
-                log.info("start decrypting and combo file {}".format(new_filename_array))
-                self.decrypt_and_combo_file(new_filename_array)
-                for nf in new_filename_array:
-                    already_process_file_arr.append(nf[2])
-                log.info("file {}  decrypted and combed".format(new_filename_array))
+            file_groups.setdefault(f_name.split("#")[0], set()).add(f_name)
+        meta_groups: dict = self.db_con.list_meta_by_new_name_groups(list(file_groups.keys()))
+        for f_group_name, file_group_set in file_groups.items():
+            # 匹配本地文件和数据库记录
+            new_filename_array = meta_groups.get(f_group_name)
+            if len(new_filename_array) != len(file_group_set):
+                log.warning("local file not match db record. local files {}, db records {}"
+                            .format(sorted(file_group_set), new_filename_array))
+            log.info("start decrypting and combo file {}".format(new_filename_array))
+            self.decrypt_and_combo_file(new_filename_array)
+            log.info("file {}  decrypted and combed".format(new_filename_array))
 
     # return translate files dir
     def split_translate_and_encrypt_file(self, file_name: str, duration: int, ffmpeg_param: str) -> str:
-        tmp_dir: str = os.path.join(self.source_dir, "tmp")
-        if not os.path.exists(tmp_dir):
-            os.mkdir(tmp_dir)
-        s: Spliter = Spliter(self.db_con, self.source_dir, tmp_dir, 0)
-        split_file_name_list: list[str] = s.split_file_with_translate(file_name, duration, ffmpeg_param)
-        log.info("split file list is {}".format(split_file_name_list))
-        self.encrypt.encrypt_files_with_subfix(self.encrypt_key, tmp_dir, self.dest_dir)
-        log.info("encrypt {} done, delete source files".format(split_file_name_list))
-        self.delete_files(tmp_dir, split_file_name_list)
-        return tmp_dir
+        return self.__split_and_encrypt_with_journal__(
+            "STAE", file_name, "split_file_info_translate",
+            lambda s, journal: s.split_file_with_translate(file_name, duration, ffmpeg_param, journal))
 
     # return ffmpeg files dir
     def split_ffmpeg_and_encrypt_file(self, file_name: str, duration: int, ffmpeg_param: str) -> str:
-        tmp_dir: str = os.path.join(self.source_dir, "tmp")
-        shutil.rmtree(tmp_dir)
-        if not os.path.exists(tmp_dir):
-            os.mkdir(tmp_dir)
-        s: Spliter = Spliter(self.db_con, self.source_dir, tmp_dir, 0)
-        split_file_name_list: list[str] = s.split_file_with_ffmpeg(file_name, duration, ffmpeg_param)
-        log.info("split file list is {}".format(split_file_name_list))
-        self.encrypt.encrypt_files_with_subfix(self.encrypt_key, tmp_dir, self.dest_dir)
-        log.info("encrypt {} done, delete source files".format(split_file_name_list))
-        self.delete_files(tmp_dir, split_file_name_list)
-        return tmp_dir
+        return self.__split_and_encrypt_with_journal__(
+            "SFAE", file_name, "split_file_info_mpeg",
+            lambda s, journal: s.split_file_with_ffmpeg(file_name, duration, ffmpeg_param, journal))
 
     def split_ffmpeg_and_encrypt_file_fixed_size(self, file_name: str, duration: int, max_size: int, ffmpeg_param: str) -> str:
+        return self.__split_and_encrypt_with_journal__(
+            "SFAE_FIXED_SIZE", file_name, "split_file_info_mpeg",
+            lambda s, journal: s.split_file_with_ffmpeg_fixed_size(file_name, max_size, duration, ffmpeg_param,
+                                                                   journal))
+
+    # 先切割到 tmp 目录再逐个加密。切好和加密好的片段都记录在任务日志中，中断后重跑从第一个未完成的片段继续
+    # split 为 (Spliter, SplitJournal) -> 片段文件名列表
+    def __split_and_encrypt_with_journal__(self, job_type: str, file_name: str, source_table: str, split) -> str:
         tmp_dir: str = os.path.join(self.source_dir, "tmp")
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
         if not os.path.exists(tmp_dir):
             os.mkdir(tmp_dir)
-        s: Spliter = Spliter(self.db_con, self.source_dir, tmp_dir, 0)
-        split_file_name_list: list[str] = s.split_file_with_ffmpeg_fixed_size(file_name, max_size, duration, ffmpeg_param)
+        if self.__get_split_file_info__(source_table, file_name) is not None and \
+                not SplitJournal.is_running(self.db_con, job_type, file_name):
+            log.info("file {} already split.".format(file_name))
+            return tmp_dir
+        journal = SplitJournal(self.db_con, job_type, self.source_dir, file_name)
+        s: Spliter = Spliter(self.db_con, self.source_dir, tmp_dir, 0, self.ffmpeg_workers,
+                             media_probe=self.media_probe, encoder_probe=self.encoder_probe,
+                             progress_callback=self.progress_callback)
+        split_file_name_list: list[str] = split(s, journal)
+        if not split_file_name_list:
+            # 上次已切割完成，在加密阶段中断
+            file_info = self.__get_split_file_info__(source_table, file_name)
+            split_file_name_list = [] if file_info is None else self.db_con.list_split_file_part_names(source_table,
+                                                                                                      file_info)
         log.info("split file list is {}".format(split_file_name_list))
-        self.encrypt.encrypt_files_with_subfix(self.encrypt_key, tmp_dir, self.dest_dir)
+        file_info = self.__get_split_file_info__(source_table, file_name)
+        self.__encrypt_split_files__(journal, tmp_dir, split_file_name_list, source_table,
+                                     None if file_info is None else file_info[0])
         log.info("encrypt {} done, delete source files".format(split_file_name_list))
         self.delete_files(tmp_dir, split_file_name_list)
+        journal.finish()
         return tmp_dir
 
+    def __get_split_file_info__(self, source_table: str, file_name: str) -> list:
+        if source_table == "split_file_info_translate":
+            return self.db_con.get_split_file_info_by_source_name_translate(file_name)
+        if source_table == "split_file_info_mpeg":
+            return self.db_con.get_split_file_info_by_source_name_mpeg(file_name)
+        return self.db_con.get_split_file_info_by_source_name(file_name)
+
+    # 加密写入临时文件时不持有数据库锁。完成后 meta 记录和任务日志在一个短事务中提交，提交后再改成最终文件名
+    # 中断时未提交的片段会重新加密，已提交未改名的片段在重跑时补上改名
+    # source_id 不为空时加密文件的 crc32 同时写入 split_file_parts
+    def __encrypt_split_files__(self, journal: SplitJournal, tmp_dir: str, split_file_name_list: list[str],
+                                source_table: str = None, source_id: int = None):
+        if not os.path.exists(self.dest_dir):
+            os.mkdir(self.dest_dir)
+        journal.restore_parts(self.dest_dir, "encrypt")
+        journal.sweep_tmp(self.dest_dir)
+        try:
+            self.__encrypt_split_parts__(journal, tmp_dir, split_file_name_list, source_table, source_id)
+        finally:
+            self.encrypt.release_buffers()
+
+    def __encrypt_split_parts__(self, journal: SplitJournal, tmp_dir: str, split_file_name_list: list[str],
+                                source_table: str, source_id: int):
+        for index, split_file_name in enumerate(split_file_name_list):
+            done_part = journal.get_part(index + 1, "encrypt")
+            if done_part is not None and journal.is_part_done(index + 1, "encrypt",
+                                                              os.path.join(self.dest_dir, done_part[3])):
+                log.info("file {} already encrypted to {}, skip.".format(split_file_name, done_part[3]))
+                continue
+            split_file_path = os.path.join(tmp_dir, split_file_name)
+            if not os.path.exists(split_file_path):
+                raise Exception("split file {} not found.".format(split_file_path))
+            new_name = MediaEncrypt.new_filename_with_subfix(split_file_name)
+            tmp_output_file = os.path.join(self.dest_dir, journal.tmp_name(index + 1, "encrypt"))
+            log.info("start encrypting file {}".format(split_file_name))
+            try:
+                self.encrypt.encrypt_file(self.encrypt_key, split_file_path, tmp_output_file)
+            except Exception as e:
+                if os.path.exists(tmp_output_file):
+                    os.remove(tmp_output_file)
+                raise e
+            part_size = os.path.getsize(tmp_output_file)
+            checksum = file_crc32(tmp_output_file)
+            with self.db_con.transaction():
+                self.db_con.insert_meta(split_file_name, new_name, os.path.getsize(split_file_path),
+                                        datetime.datetime.now())
+                journal.mark_part_done(index + 1, "encrypt", new_name, part_size, checksum)
+                if source_id is not None:
+                    self.db_con.update_split_file_part_checksum(source_table, source_id, index + 1, checksum)
+            os.replace(tmp_output_file, os.path.join(self.dest_dir, new_name))
+            log.info("file {} encrypted to {}.".format(split_file_name, new_name))
+
     def delete_files(self, dir_path: str, file_name_list: list[str]):
         for fn in file_name_list:
             fn_path: str = os.path.join(dir_path, fn)
@@ -926,7 +2789,7 @@ class SplitAndEncrypt:
                     need_continue = True
                     break
             split_file_info = self.db_con.get_split_file_info_by_source_name_translate(f_name)
-            if split_file_info is not None:
+            if split_file_info is not None and not SplitJournal.is_running(self.db_con, "STAE", f_name):
                 log.info("file {} already split.".format(f_name))
                 need_continue = True
             if need_continue:
@@ -949,7 +2812,7 @@ class SplitAndEncrypt:
                     need_continue = True
                     break
             split_file_info = self.db_con.get_split_file_info_by_source_name_mpeg(f_name)
-            if split_file_info is not None:
+            if split_file_info is not None and not SplitJournal.is_running(self.db_con, "SFAE", f_name):
                 log.info("file {} already split.".format(f_name))
                 need_continue = True
             if need_continue:
@@ -985,7 +2848,7 @@ class SplitAndEncrypt:
                     need_continue = True
                     break
             split_file_info = self.db_con.get_split_file_info_by_source_name_mpeg(f_name)
-            if split_file_info is not None:
+            if split_file_info is not None and not SplitJournal.is_running(self.db_con, "SFAE_FIXED_SIZE", f_name):
                 log.info("file {} already split.".format(f_name))
                 need_continue = True
             if need_continue:
@@ -1001,67 +2864,481 @@ class SplitAndEncrypt:
             #self.generate_thumbnail(os.path.join(self.source_dir, f_name), os.path., 60, 300)
 
     def cacl_media_duration_by_fixed_size(self, max_size: int, file_name: str):
-        probe: dict = ffmpeg.probe(os.path.join(self.source_dir, file_name))
-        rate = 0
-        for stream in probe.get("streams"):
-            bit_rate_val = stream.get("bit_rate")
-            if bit_rate_val is None:
-                bit_rate_val = 64 * 1000
-            bit_rate = int(bit_rate_val)
-            if bit_rate is None:
-                raise Exception("file {} stream {} bit_rate is None. probe is {}".format(file_name, stream.get("index"), probe))
-            rate += bit_rate
+        rate = self.media_probe.get_bit_rate(os.path.join(self.source_dir, file_name))
+        if rate <= 0:
+            raise Exception("file {} bit_rate is {}.".format(file_name, rate))
         duration = 8 * (max_size - 10 * 1024 * 1024) // rate
         return duration
 
+'''
+本地解密流媒体服务。只监听 127.0.0.1，按 HTTP Range 读取加密文件的对应区间，边读边异或后返回，明文不落盘
+每个地址对应一个加密文件，或按顺序拼接的一组片段，播放器直接打开地址即可播放和任意拖动
+'''
+class DecryptStreamServer:
+    host: str = None
+    port: int = None
+    cipher = None
+    httpd: ThreadingHTTPServer = None
+    thread: threading.Thread = None
+    streams: dict = None
+    chunk_size = 1024 * 1024
+
+    # port 为 0 时由系统分配空闲端口
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, cipher: str = None):
+        self.host = host
+        self.port = port
+        self.cipher = get_xor_cipher(cipher)
+        self.streams = {}
+
+    def start(self):
+        if self.httpd is not None:
+            return
+        self.httpd = ThreadingHTTPServer((self.host, self.port), DecryptStreamRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stream_server = self
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="decrypt-stream-server", daemon=True)
+        self.thread.start()
+        log.info("decrypt stream server listen on {}:{}".format(self.host, self.port))
+
+    def stop(self):
+        if self.httpd is None:
+            return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd = None
+
+    # file_paths 为按顺序拼接的加密文件，name 决定地址中的文件名和 Content-Type，默认取第一个文件名
+    def add_stream(self, key: str, file_paths: list, name: str = None) -> str:
+        self.start()
+        # 校验密钥
+        MediaEncrypt.get_key_byte(key)
+        if name is None:
+            name = os.path.basename(file_paths[0])
+        token = uuid.uuid4().hex
+        self.streams[token] = {"key": key, "file_paths": list(file_paths), "name": name}
+        return "http://{}:{}/{}/{}".format(self.host, self.port, token, urllib.parse.quote(name))
+
+    def remove_stream(self, url: str):
+        self.streams.pop(urllib.parse.urlparse(url).path.split("/")[1], None)
+
+    # 每个请求单独打开，多个连接可以同时读取同一个流
+    def open_stream(self, path: str):
+        stream = self.streams.get(urllib.parse.urlparse(path).path.split("/")[1])
+        if stream is None:
+            return None
+        return EncryptedGroupFile(stream["file_paths"], stream["key"], stream["name"], self.cipher.name)
+
+    # 把 [start, end] 区间的明文写入 wfile
+    def write_range(self, group_file: EncryptedGroupFile, start: int, end: int, wfile):
+        buf = bytearray(self.chunk_size)
+        with memoryview(buf) as view:
+            group_file.seek(start)
+            remaining = end + 1 - start
+            while remaining > 0:
+                n = group_file.readinto(view[:min(self.chunk_size, remaining)])
+                if not n:
+                    break
+                wfile.write(view[:n])
+                remaining -= n
+
+
+class DecryptStreamRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    range_re = re.compile(r"bytes=(\d*)-(\d*)$")
+
+    def do_HEAD(self):
+        self.__serve__(False)
+
+    def do_GET(self):
+        self.__serve__(True)
+
+    def __serve__(self, with_body: bool):
+        stream_server: DecryptStreamServer = self.server.stream_server
+        group_file = stream_server.open_stream(self.path)
+        if group_file is None:
+            self.send_error(404)
+            return
+        with group_file:
+            self.__serve_range__(stream_server, group_file, with_body)
+
+    def __serve_range__(self, stream_server, group_file: EncryptedGroupFile, with_body: bool):
+        size = group_file.size
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header is not None:
+            match = self.range_re.match(range_header.strip())
+            if match is None or (match.group(1) == "" and match.group(2) == ""):
+                self.__send_unsatisfiable__(size)
+                return
+            if match.group(1) == "":
+                # bytes=-N 为最后 N 个字节
+                start = max(size - int(match.group(2)), 0)
+            else:
+                start = int(match.group(1))
+                if match.group(2) != "":
+                    end = min(int(match.group(2)), size - 1)
+            if start > end:
+                self.__send_unsatisfiable__(size)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", mimetypes.guess_type(group_file.name)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if not with_body or end < start:
+            return
+        try:
+            stream_server.write_range(group_file, start, end, self.wfile)
+        except (BrokenPipeError, ConnectionResetError):
+            # 播放器拖动时会直接断开旧连接
+            self.close_connection = True
+
+    def __send_unsatisfiable__(self, size: int):
+        self.send_response(416)
+        self.send_header("Content-Range", "bytes */{}".format(size))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug("stream server " + format % args)
+
+
+'''
+预览缓存。preview/ 中下载的分段和 thumb/ 中的缩略图登记在 SQLite 中，记录大小和最后访问时间
+总大小超过 max_bytes 时按最后访问时间从旧到新删除，pin 住的文件(正在播放的分段)不删除
+'''
+class PreviewCache:
+    db_path: str = None
+    con: sqlite3.Connection = None
+    max_bytes: int = None
+    pinned: set = None
+    lock = None
+    table_ddl_preview_cache = """
+        CREATE TABLE IF NOT EXISTS preview_cache (
+            "path" TEXT NOT NULL PRIMARY KEY,
+            "size" INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+    """
+    index_ddl_preview_cache = "CREATE INDEX IF NOT EXISTS idx_preview_cache_last_access ON preview_cache (last_access)"
+
+    def __init__(self, db_path: str = "cache/cache.db", max_bytes: int = 10 * 1024 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.pinned = set()
+        # 下载线程和界面线程都会访问
+        self.lock = threading.RLock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir != "" and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.con = sqlite3.connect(db_path, check_same_thread=False)
+        cursor = self.con.cursor()
+        cursor.execute(self.table_ddl_preview_cache)
+        cursor.execute(self.index_ddl_preview_cache)
+        cursor.close()
+        self.con.commit()
+
+    def __del__(self):
+        if self.con is not None:
+            self.con.close()
+
+    @staticmethod
+    def __key__(path: str) -> str:
+        return os.path.abspath(path)
+
+    # 文件存在时刷新访问时间并返回 True。登记过但已被删除的记录一并清理，未登记的已有文件补登记
+    def get(self, path: str) -> bool:
+        with self.lock:
+            if not os.path.exists(path):
+                self.__remove__(path)
+                return False
+            self.put(path, evict=False)
+            return True
+
+    # 登记新写入的文件，超出预算时淘汰最久未访问的文件
+    def put(self, path: str, evict: bool = True):
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("insert or replace into preview_cache (`path`, `size`, last_access) values (?, ?, ?)",
+                           (self.__key__(path), os.path.getsize(path), time.time()))
+            cursor.close()
+            self.con.commit()
+            if evict:
+                self.evict()
+
+    # 启动时登记目录中已有但未登记的文件，访问时间取文件修改时间
+    def add_dir(self, dir_path: str):
+        if not os.path.isdir(dir_path):
+            return
+        rows = []
+        for f_name in os.listdir(dir_path):
+            file_path = os.path.join(dir_path, f_name)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                rows.append((self.__key__(file_path), stat.st_size, stat.st_mtime))
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.executemany("insert or ignore into preview_cache (`path`, `size`, last_access) values (?, ?, ?)",
+                               rows)
+            cursor.close()
+            self.con.commit()
+
+    # 替换 pin 住的文件集合，传入空列表即全部解除
+    def pin(self, paths: list):
+        with self.lock:
+            self.pinned = set(self.__key__(path) for path in paths)
+
+    def total_size(self) -> int:
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("select coalesce(sum(`size`), 0) from preview_cache")
+            total = cursor.fetchone()[0]
+            cursor.close()
+            return total
+
+    # 返回释放的字节数
+    def evict(self) -> int:
+        freed = 0
+        with self.lock:
+            total = self.total_size()
+            if total <= self.max_bytes:
+                return 0
+            cursor = self.con.cursor()
+            cursor.execute("select `path`, `size` from preview_cache order by last_access")
+            rows = cursor.fetchall()
+            cursor.close()
+            for path, size in rows:
+                if total - freed <= self.max_bytes:
+                    break
+                if path in self.pinned:
+                    continue
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError as e:
+                    # 文件被播放器占用时跳过，下次再淘汰
+                    log.warning("evict preview cache {} failed {}".format(path, e))
+                    continue
+                self.__remove__(path)
+                freed += size
+                log.info("evict preview cache {} size {}".format(path, size))
+        return freed
+
+    def __remove__(self, path: str):
+        cursor = self.con.cursor()
+        cursor.execute("delete from preview_cache where `path`=?", (self.__key__(path),))
+        cursor.close()
+        self.con.commit()
+
+
+'''
+分段预取流水线。最多 prefetch 个分段同时下载，每个分段下载完后立即在同一线程中解密
+按分段顺序回调 on_ready(index, part, result)，第一个分段就绪即可开始播放，之后的分段在播放期间继续下载
+'''
+class PrefetchPipeline:
+    download_fn = None
+    decrypt_fn = None
+    prefetch: int = None
+    cancelled: threading.Event = None
+
+    # download_fn(part) 返回下载后的文件路径，decrypt_fn(part, path) 返回解密后的文件路径
+    def __init__(self, download_fn, decrypt_fn, prefetch: int = 3):
+        self.download_fn = download_fn
+        self.decrypt_fn = decrypt_fn
+        self.prefetch = max(1, prefetch)
+        self.cancelled = threading.Event()
+
+    # 阻塞直到全部分段完成，返回按顺序排列的解密结果。被取消时返回已就绪的部分，任一分段失败时取消其余分段并抛出异常
+    def run(self, parts: list, on_ready=None) -> list:
+        results = []
+        with ThreadPoolExecutor(self.prefetch) as pool:
+            futures = [pool.submit(self.__fetch__, part) for part in parts]
+            try:
+                for index, future in enumerate(futures):
+                    result = future.result()
+                    if self.cancelled.is_set():
+                        break
+                    results.append(result)
+                    if on_ready is not None:
+                        on_ready(index, parts[index], result)
+            finally:
+                for future in futures:
+                    future.cancel()
+        return results
+
+    # 正在下载的分段会完成，排队中的分段不再开始
+    def cancel(self):
+        self.cancelled.set()
+
+    def __fetch__(self, part):
+        if self.cancelled.is_set():
+            return None
+        file_path = self.download_fn(part)
+        if self.cancelled.is_set():
+            return None
+        return self.decrypt_fn(part, file_path)
+
+
+'''
+百度一刻请求共用一个连接池。pybaiduphoto 每次请求都调用 requests.get/post 新建 TLS 连接，并发上传时改为复用 Session 中的长连接
+'''
+class YiKePooledRequests(YiKeRequests):
+    session: requests.Session = None
+
+    def __init__(self, cookies, proxies=None, pool_size: int = 4):
+        super().__init__(cookies=cookies, proxies=proxies)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url=url, proxies=self.get_proxies(), cookies=self.cookies, headers=self.headers,
+                                **self.__with_bdstoken__(kwargs))
+
+    def post(self, url, **kwargs):
+        return self.session.post(url=url, proxies=self.get_proxies(), cookies=self.cookies, headers=self.headers,
+                                 **self.__with_bdstoken__(kwargs))
+
+    def __with_bdstoken__(self, kwargs: dict) -> dict:
+        kwargs.setdefault("params", {})["bdstoken"] = self.get_bdstoken_Cache()
+        return kwargs
+
+
+'''
+百度一刻并发上传。有界线程池同时上传多个文件，单个文件失败后按 backoff * 2^n 秒退避重试
+相册只在开始时查找一次，上传成功的条目攒够 append_batch_size 个再一次性加入相册
+'''
+class YiKeUploadEngine:
+    client = None
+    max_workers: int = None
+    max_retries: int = None
+    backoff: float = None
+    append_batch_size: int = None
+    progress_callback = None
+
+    # client 为 YiKeAPI 或接口相同的对象(测试中的 FakeYiKeAPI)，progress_callback(完成比例) 每完成一个文件回调一次
+    def __init__(self, client, max_workers: int = 4, max_retries: int = 3, backoff: float = 1.0,
+                 append_batch_size: int = 50, progress_callback=None):
+        self.client = client
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.append_batch_size = append_batch_size
+        self.progress_callback = progress_callback
+
+    def find_album(self, album_name: str):
+        for album in self.client.getAlbumList_All():
+            if album.info['title'] == album_name:
+                return album
+        raise Exception("album {} not found".format(album_name))
+
+    # 返回 {文件路径: 上传后的条目}。失败的文件不影响其他文件，全部结束后抛出异常列出失败的文件
+    def upload_files(self, file_paths: list, album_name=None) -> dict:
+        album = self.find_album(album_name) if album_name is not None else None
+        items = {}
+        pending = []
+        failed = []
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {pool.submit(self.upload_file, file_path): file_path for file_path in file_paths}
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    items[file_path] = future.result()
+                    pending.append(items[file_path])
+                except Exception as e:
+                    log.error("file {} upload failed {}".format(file_path, e))
+                    failed.append(file_path)
+                if album is not None and len(pending) >= self.append_batch_size:
+                    self.__append_to_album__(album, pending)
+                    pending = []
+                if self.progress_callback is not None:
+                    self.progress_callback((len(items) + len(failed)) / len(file_paths))
+        if album is not None and len(pending) > 0:
+            self.__append_to_album__(album, pending)
+        if len(failed) > 0:
+            raise Exception("{} of {} files upload failed: {}".format(len(failed), len(file_paths), failed))
+        return items
+
+    def upload_file(self, file_path: str):
+        item = self.__retry__(lambda: self.client.upload_1file(file_path), "upload file {}".format(file_path))
+        log.info("file {} upload done".format(file_path))
+        return item
+
+    def __append_to_album__(self, album, items: list):
+        self.__retry__(lambda: album.append(items), "append {} items to album {}".format(len(items),
+                                                                                        album.info['title']))
+        log.info("append {} items to album {} done".format(len(items), album.info['title']))
+
+    def __retry__(self, fn, name: str):
+        attempt = 0
+        while True:
+            try:
+                result = fn()
+                if result is None:
+                    raise Exception("{} returned nothing".format(name))
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    raise e
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                log.warning("{} failed {}, retry {} in {}s".format(name, e, attempt, delay))
+                time.sleep(delay)
+
+
 class YiKeClient:
     client: YiKeAPI
     thumb_dir_path: str
+    media_probe: MediaProbe
+    upload_workers: int
 
-    def __init__(self, cookies: str = None, thumb_dir_path: str = os.path.join(os.getcwd(), "thumb")):
+    # upload_workers 为同时上传的文件数，也是连接池大小。client 不为空时直接使用(如测试中的 FakeYiKeAPI)
+    def __init__(self, cookies: str = None, thumb_dir_path: str = os.path.join(os.getcwd(), "thumb"),
+                 media_probe: MediaProbe = None, upload_workers: int = 4, client=None):
         self.thumb_dir_path = thumb_dir_path
+        self.media_probe = media_probe if media_probe is not None else MediaProbe()
+        self.upload_workers = upload_workers
         if not os.path.exists(self.thumb_dir_path):
             os.mkdir(self.thumb_dir_path)
+        if client is not None:
+            self.client = client
+            return
         if cookies is not None:
-            self.client = YiKeAPI(YiKeClient.__cookie_to_dic__(self, cookies))
+            cookies = YiKeClient.__cookie_to_dic__(self, cookies)
         else:
-            self.client = YiKeAPI(browser_cookie3.firefox())
+            cookies = browser_cookie3.firefox()
+        self.client = YiKeAPI(cookies)
+        # 替换为共用连接池的请求，API 与 General 持有同一个 req，之后创建的相册和条目也会沿用
+        self.client.req = YiKePooledRequests(cookies, pool_size=upload_workers)
+        self.client.g.req = self.client.req
 
     def upload_file(self, file_path: str, album_name=None):
-        item_info = self.client.upload_1file(file_path)
-        if album_name is not None:
-            all_albums = self.client.getAlbumList_All("Album")
-            al_info = None
-            for al in all_albums:
-                if al.info['title'] == album_name:
-                    al_info = al
-                    break
-            al_info.append(item_info)
-        log.info("file {} upload done".format(file_path))
+        YiKeUploadEngine(self.client, 1).upload_files([file_path], album_name)
 
     def list_page(self, type_name: str = "Item", cursor=None):
         return self.client.get_self_1page(type_name, cursor)
 
     def upload_dirs(self, dir: str, exclude: list = None, album_name=None, method_progress_bar_update=None):
-        l_files: list[str] = os.listdir(dir)
-        for f_name in l_files:
+        exclude_res = [re.compile(ec) for ec in (exclude or [])]
+        l_files: list[str] = []
+        for f_name in os.listdir(dir):
             need_continue = False
-            for ec in exclude:
-                re_ec = re.compile(ec)
-                res_s = re_ec.search(f_name)
-                if res_s is not None:
-                    log.info("cause by {}, pass {}".format(ec, f_name))
+            for re_ec in exclude_res:
+                if re_ec.search(f_name) is not None:
+                    log.info("cause by {}, pass {}".format(re_ec.pattern, f_name))
                     need_continue = True
                     break
-            if need_continue:
+            if need_continue or not os.path.isfile(os.path.join(dir, f_name)):
                 continue
+            l_files.append(f_name)
         log.info("start upload dir {} to yiKeAlbum".format(dir))
-        index = 0
-        for fn in l_files:
-            self.upload_file(os.path.join(dir, fn), album_name)
-            if method_progress_bar_update is not None:
-                index += 1
-                method_progress_bar_update(index / len(l_files))
+        engine = YiKeUploadEngine(self.client, self.upload_workers, progress_callback=method_progress_bar_update)
+        engine.upload_files([os.path.join(dir, fn) for fn in l_files], album_name)
 
     def upload_dirs_qt(self, dir: str, exclude: list = None, album_name=None, method_progress_bar_update=None):
         self.upload_dirs(dir, exclude, album_name, method_progress_bar_update)
@@ -1076,7 +3353,8 @@ class YiKeClient:
         return cookie_dic
 
     def play(self, file_path: str):
-        os.popen("ffplay {}".format(file_path))
+        # 播放器独立运行，不等待退出
+        subprocess.Popen(["ffplay", file_path])
 
     def __do_generate_thumbnail(self, in_filename, out_filename, time, width):
         try:
@@ -1092,15 +3370,25 @@ class YiKeClient:
             log.warning(e.stderr.decode())
             return
 
+    # thumb_file_name 为空时取 file_path 的文件名加 .jpg
     def generate_thumbnail(self, file_path: str, sep: str, thumb_dir_path: str = os.path.join(os.getcwd(), "thumb"),
-                           time: int = 60):
+                           time: int = 60, thumb_file_name: str = None):
         file_name = os.path.split(file_path)[-1]
         thumb_path = None
         if thumb_dir_path is None:
             thumb_path = self.thumb_dir_path
         else:
             thumb_path = thumb_dir_path
-        thumb_file_path = os.path.join(thumb_path, file_name) + ".jpg"
+        if thumb_file_name is None:
+            thumb_file_name = file_name + ".jpg"
+        thumb_file_path = os.path.join(thumb_path, thumb_file_name)
+        try:
+            # 视频短于截图时间时取中间帧，否则 ffmpeg 截不到画面
+            duration = self.media_probe.get_duration(file_path)
+            if duration is not None and time >= duration:
+                time = duration / 2
+        except Exception as e:
+            log.warning("probe file {} failed {}".format(file_path, e))
         self.__do_generate_thumbnail(file_path, thumb_file_path, time, 300)
         return thumb_file_path
 
@@ -1147,22 +3435,38 @@ if __name__ == '__main__':
     dest_dir = sys.argv[3]
     type = sys.argv[4]  # [E|D|S|C] E encrypt D decrypt S split(can't preview) C combo SF (split with ffmpeg)
     # CF (combo with ffmpeg) ST (translate codec with ffmpeg) CT (combo with ffmpeg equals CF)
+    # SFM (split with ffmpeg segment muxer, one ffmpeg run per file, same records as SF)
     # SAE(split and encrypt) CAE(decrypt and combo)
     # SFAE (split with ffmpeg and encrypt)
     # CFAE (combo with ffmpeg and dencrypt)
     # STAE (split translate with ffmpeg and encrypt)
     # CTAE (decrypt and combo translate files with ffmpeg)
+    # BM (benchmark read/stream/mmap encrypt io modes for files in source_dir)
+    # BE (benchmark h264 encoders available to ffmpeg, ST/STAE use the fastest one via -c:v auto)
+    # --file-workers=N after the positional args: files processed at once by E/D, default cpu count
     # !!! CF and SF timeline is not accurate
     # YKU (upload to yiKeAlbum)
     log.info("start date in {} source_dir={}, dest_dir={}".format(datetime.datetime.now(), source_dir, dest_dir))
-    dbcon = DbCon()
+    file_workers = None
+    for arg in sys.argv[5:]:
+        if arg.startswith("--file-workers="):
+            file_workers = int(arg.split("=", 1)[1])
+    dbcon = DbCon(journal_mode="WAL", synchronous="NORMAL")
     try:
         if type == "E":
-            encrypt = MediaEncrypt(dbcon)
+            encrypt = MediaEncrypt(dbcon, io_mode="mmap", file_workers=file_workers)
             encrypt.encrypt_files(key, source_dir, dest_dir)
         elif type == "D":
-            encrypt = MediaEncrypt(dbcon)
+            encrypt = MediaEncrypt(dbcon, io_mode="mmap", file_workers=file_workers)
             encrypt.decrypt_files(key, source_dir, dest_dir)
+        elif type == "BM":
+            encrypt = MediaEncrypt(dbcon)
+            for f_name in os.listdir(source_dir):
+                f_path = os.path.join(source_dir, f_name)
+                if os.path.isfile(f_path):
+                    log.info("benchmark {} result {}".format(f_name, encrypt.benchmark_io_modes(key, f_path, dest_dir)))
+        elif type == "BE":
+            log.info("encoder benchmark result {}".format(EncoderProbe(dbcon).benchmark()))
         elif type == "S":
             split = Spliter(dbcon, source_dir, dest_dir, 99 * 1024 * 1024)
             split.split_dir([r'*.ini'])
@@ -1173,13 +3477,16 @@ if __name__ == '__main__':
             sf = Spliter(dbcon, source_dir, dest_dir, 0)
             ffmpeg_param = "ffmpeg -ss %d -t %d -accurate_seek -i \"%s\" -codec copy -avoid_negative_ts 1 \"%s\" -loglevel warning -y"
             sf.split_dir_with_ffmpeg([r'*.ini'], int(60 * 1.1), ffmpeg_param)
+        elif type == "SFM":
+            sfm = Spliter(dbcon, source_dir, dest_dir, 0)
+            sfm.split_dir_with_segment([r'*.ini'], int(60 * 1.1))
         elif type == "CF" or type == "CT":
             combo = Combo(dbcon, source_dir, dest_dir)
             ffmpeg_param = "ffmpeg -f concat -safe 0 -i %s -c copy -strict -2 %s -loglevel warning"
             combo.combo_dir_with_ffmpeg(ffmpeg_param)
         elif type == "ST":
-            st = Spliter(dbcon, source_dir, dest_dir, 0)
-            ffmpeg_param = "ffmpeg -ss %d -t %d -i \"%s\" -c:v h264_qsv -global_quality 10 -c:a mp3 -strict experimental \"%s\" -loglevel warning -y"
+            st = Spliter(dbcon, source_dir, dest_dir, 0, max(1, (os.cpu_count() or 1) // 4))
+            ffmpeg_param = "ffmpeg -ss %d -t %d -i \"%s\" -c:v auto -c:a mp3 -strict experimental \"%s\" -loglevel warning -y"
             st.split_dir_with_translate([r'*.ini'], int(60 * 1.0), ffmpeg_param)
         elif type == "SAE":
             se = SplitAndEncrypt(dbcon, source_dir, dest_dir, key, 99 * 1024 * 1024)
@@ -1221,10 +3528,8 @@ ff.run()
 
             raise NotImplementedError()
         elif type == "STAE":
-            print("in cpu platform use:ffmpeg -ss %d -t %d -i %s -c:v libx264 -crf 20 -maxrate 6000k -bufsize 5000k  -c:a copy -strict experimental %s -loglevel warning -y")
-            print("in amd platform use:")
-            stae = SplitAndEncrypt(dbcon, source_dir, dest_dir, key)
-            ffmpeg_param = "ffmpeg -ss %d -t %d -i \"%s\" -c:v h264_qsv -global_quality 15 -c:a mp3 -strict experimental \"%s\" -loglevel warning -y"
+            stae = SplitAndEncrypt(dbcon, source_dir, dest_dir, key, ffmpeg_workers=max(1, (os.cpu_count() or 1) // 4))
+            ffmpeg_param = "ffmpeg -ss %d -t %d -i \"%s\" -c:v auto -c:a mp3 -strict experimental \"%s\" -loglevel warning -y"
             stae.split_translate_and_encrypt_dir([r'*.ini'], int(60 * 1.0), ffmpeg_param)
         elif type == "CTAE":
             raise NotImplementedError()
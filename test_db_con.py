@@ -0,0 +1,96 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import main
+
+
+# 初始版本只建了 meta_info、split_file_info、split_file_info_mpeg 三张表，user_version 为 0
+baseline_ddl = [
+    """
+CREATE TABLE "meta_info" (
+	"id"	INTEGER NOT NULL UNIQUE COLLATE BINARY,
+	"source_name"	TEXT NOT NULL,
+	"new_name"	TEXT NOT NULL,
+	"size"	INTEGER NOT NULL,
+	"date"	TEXT NOT NULL,
+	PRIMARY KEY("id" AUTOINCREMENT)
+);
+""",
+    """
+CREATE TABLE "split_file_info" (
+	"id"	INTEGER NOT NULL UNIQUE,
+	"source_name"	TEXT NOT NULL,
+	"new_name"	TEXT NOT NULL,
+	"size"	INTEGER NOT NULL,
+	"date"	TEXT NOT NULL,
+	PRIMARY KEY("id" AUTOINCREMENT)
+);
+""",
+    """
+CREATE TABLE "split_file_info_mpeg" (
+	"id"	INTEGER NOT NULL UNIQUE,
+	"source_name"	TEXT NOT NULL,
+	"new_name"	TEXT NOT NULL,
+	"size"	INTEGER NOT NULL,
+	"date"	TEXT NOT NULL,
+	PRIMARY KEY("id" AUTOINCREMENT)
+);
+""",
+]
+
+
+class DbConMigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir_path, "meta.db")
+        con = sqlite3.connect(self.db_path)
+        for ddl in baseline_ddl:
+            con.execute(ddl)
+        con.execute("insert into split_file_info (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)",
+                    ("a.mp4", "a.1.mp4#a.2.mp4", 30, "2023-01-01"))
+        con.executemany("insert into meta_info (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)",
+                        [("a.1.mp4", "1#x.mp4", 20, "2023-01-01"), ("a.2.mp4", "1#y.mp4", 10, "2023-01-01")])
+        con.execute("insert into split_file_info_mpeg (source_name, new_name, `size`, `date`) values (?, ?, ?, ?)",
+                    ("b.mp4", "b.1.mp4#b.2.mp4#b.3.mp4", 99, "2023-01-01"))
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_migrate_baseline(self):
+        db_con = main.DbCon(self.db_path)
+        self.assertEqual(len(main.schema_migrations), db_con.con.execute("PRAGMA user_version").fetchone()[0])
+        tables = set(row[0] for row in db_con.con.execute("select name from sqlite_master where type='table'"))
+        for table in ["split_file_info_translate", "media_probe", "split_file_parts", "split_job",
+                      "split_job_part", "encoder_probe"]:
+            self.assertIn(table, tables)
+        indexes = set(row[0] for row in db_con.con.execute("select name from sqlite_master where type='index'"))
+        self.assertIn("idx_meta_info_new_name", indexes)
+        db_con.con.close()
+
+    # 旧数据的 new_name 拆成片段记录，SAE 组的片段大小和偏移取自 meta_info
+    def test_backfill_split_file_parts(self):
+        db_con = main.DbCon(self.db_path)
+        parts = db_con.list_split_file_parts("split_file_info", 1)
+        self.assertEqual([(1, "a.1.mp4", 20, 0), (2, "a.2.mp4", 10, 20)],
+                         [(part[3], part[4], part[5], part[6]) for part in parts])
+        file_info = db_con.get_split_file_info_by_source_name_mpeg("b.mp4")
+        self.assertEqual(["b.1.mp4", "b.2.mp4", "b.3.mp4"],
+                         db_con.list_split_file_part_names("split_file_info_mpeg", file_info))
+        db_con.con.close()
+
+    # 升级过的库再次打开不重复执行
+    def test_migrate_twice(self):
+        main.DbCon(self.db_path).con.close()
+        db_con = main.DbCon(self.db_path)
+        self.assertEqual(2, len(db_con.list_split_file_parts("split_file_info", 1)))
+        db_con.con.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import http.client
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.parse
+
+import main
+
+
+class DecryptStreamServerTest(unittest.TestCase):
+
+    # 明文拆成两个加密片段，按顺序拼接成一个流
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.data = os.urandom(3000)
+        self.file_paths = []
+        for index, part in enumerate([self.data[:1200], self.data[1200:]]):
+            file_path = os.path.join(self.dir_path, "a.{}.mp4".format(index + 1))
+            with open(file_path, "wb") as f:
+                f.write(bytes(b ^ ord("k") for b in part))
+            self.file_paths.append(file_path)
+        self.server = main.DecryptStreamServer()
+        self.url = self.server.add_stream("k", self.file_paths, "a.mp4")
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir_path)
+
+    def request(self, method: str = "GET", range_header: str = None, url: str = None):
+        url = urllib.parse.urlparse(url or self.url)
+        con = http.client.HTTPConnection(url.hostname, url.port, timeout=5)
+        try:
+            con.request(method, url.path, headers={"Range": range_header} if range_header is not None else {})
+            response = con.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            con.close()
+
+    def test_full_body(self):
+        status, headers, body = self.request()
+        self.assertEqual(200, status)
+        self.assertEqual("bytes", headers["Accept-Ranges"])
+        self.assertEqual("video/mp4", headers["Content-Type"])
+        self.assertEqual(self.data, body)
+
+    # 区间跨过两个片段
+    def test_range_across_parts(self):
+        status, headers, body = self.request(range_header="bytes=1000-1499")
+        self.assertEqual(206, status)
+        self.assertEqual("bytes 1000-1499/3000", headers["Content-Range"])
+        self.assertEqual(self.data[1000:1500], body)
+
+    def test_open_ended_range(self):
+        status, headers, body = self.request(range_header="bytes=2500-")
+        self.assertEqual(206, status)
+        self.assertEqual("bytes 2500-2999/3000", headers["Content-Range"])
+        self.assertEqual(self.data[2500:], body)
+
+    def test_suffix_range(self):
+        status, headers, body = self.request(range_header="bytes=-100")
+        self.assertEqual(206, status)
+        self.assertEqual("bytes 2900-2999/3000", headers["Content-Range"])
+        self.assertEqual(self.data[-100:], body)
+
+    def test_range_end_clamped(self):
+        status, headers, body = self.request(range_header="bytes=2990-9999")
+        self.assertEqual(206, status)
+        self.assertEqual(self.data[2990:], body)
+
+    def test_unsatisfiable_range(self):
+        for range_header in ["bytes=3000-", "bytes=20-10", "bytes=-", "items=0-1"]:
+            with self.subTest(range_header=range_header):
+                status, headers, body = self.request(range_header=range_header)
+                self.assertEqual(416, status)
+                self.assertEqual("bytes */3000", headers["Content-Range"])
+
+    def test_head(self):
+        status, headers, body = self.request("HEAD", "bytes=0-99")
+        self.assertEqual(206, status)
+        self.assertEqual("100", headers["Content-Length"])
+        self.assertEqual(b"", body)
+
+    def test_removed_stream(self):
+        self.server.remove_stream(self.url)
+        self.assertEqual(404, self.request()[0])
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            self.server.add_stream("kk", self.file_paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+import main
+
+
+class BuildFfmpegArgsTest(unittest.TestCase):
+
+    def test_windows_path(self):
+        args = main.build_ffmpeg_args('C:\\ffmpeg\\bin\\ffmpeg.exe -ss %d -i "%s" -c copy "%s"',
+                                      (10, "C:\\v\\a b.mp4", "D:\\out\\a.1.mp4"))
+        self.assertEqual(["C:\\ffmpeg\\bin\\ffmpeg.exe", "-ss", "10", "-i", "C:\\v\\a b.mp4", "-c", "copy",
+                          "D:\\out\\a.1.mp4"], args)
+
+    def test_gui_default_template(self):
+        template = 'ffmpeg -ss %d -t %d -i "%s" -c:v h264_qsv -global_quality 10 -c:a aac -strict experimental ' \
+                   '"%s" -loglevel warning'
+        args = main.build_ffmpeg_args(template, (0, 60, "C:/v/a.mp4", "C:/v/tmp/a.1.mp4"))
+        self.assertEqual(["ffmpeg", "-ss", "0", "-t", "60", "-i", "C:/v/a.mp4", "-c:v", "h264_qsv",
+                          "-global_quality", "10", "-c:a", "aac", "-strict", "experimental", "C:/v/tmp/a.1.mp4",
+                          "-loglevel", "warning"], args)
+
+    # 旧版界面模板用 \" 包住路径，保存在 config.ini 中仍会被读出来
+    def test_legacy_escaped_quote_template(self):
+        template = 'ffmpeg -ss %d -t %d -i \\"%s\\" -c:a aac \\"%s\\" -loglevel warning'
+        args = main.build_ffmpeg_args(template, (0, 60, "C:/v/a b.mp4", "C:/v/tmp/a.1.mp4"))
+        self.assertEqual(["ffmpeg", "-ss", "0", "-t", "60", "-i", "C:/v/a b.mp4", "-c:a", "aac",
+                          "C:/v/tmp/a.1.mp4", "-loglevel", "warning"], args)
+
+    def test_value_with_quote_not_split(self):
+        args = main.build_ffmpeg_args("ffmpeg -i %s %s", ("it's a.mp4", 'b "c".mp4'))
+        self.assertEqual(["ffmpeg", "-i", "it's a.mp4", 'b "c".mp4'], args)
+
+    def test_missing_placeholder(self):
+        with self.assertRaises(ValueError):
+            main.build_ffmpeg_args("ffmpeg -i %s", ("a.mp4", "b.mp4"))
+
+    def test_unclosed_quote(self):
+        with self.assertRaises(ValueError):
+            main.split_ffmpeg_param('ffmpeg -i "%s')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+
+
+class SplitAndEncryptResumeTest(unittest.TestCase):
+
+    # check_disk_space 取路径的第一段查询磁盘，和命令行一样使用相对路径
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir_path = tempfile.mkdtemp()
+        os.chdir(self.dir_path)
+        self.source_dir = "src"
+        self.dest_dir = "dst"
+        self.combo_dir = "combo"
+        os.mkdir(self.source_dir)
+        self.data = os.urandom(5500)
+        with open(os.path.join(self.source_dir, "a.bin"), "wb") as f:
+            f.write(self.data)
+        self.db_con = main.DbCon("meta.db")
+
+    def tearDown(self):
+        self.db_con.con.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir_path)
+
+    # 第 4 个片段加密时中断，重跑只加密剩下的片段，解密合并后与源文件一致
+    def test_resume_after_crash(self):
+        sae = main.SplitAndEncrypt(self.db_con, self.source_dir, self.dest_dir, "k", max_size=1000)
+        xor_stream = sae.encrypt.xor_stream
+        calls = []
+
+        def crash_on_fourth(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 4:
+                raise IOError("disk gone")
+            return xor_stream(*args, **kwargs)
+
+        sae.encrypt.xor_stream = crash_on_fourth
+        with self.assertRaises(IOError):
+            sae.split_and_encrypt_file("a.bin")
+        self.assertTrue(main.SplitJournal.is_running(self.db_con, "SAE", "a.bin"))
+        self.assertEqual(3, len(os.listdir(self.dest_dir)))
+
+        sae.split_and_encrypt_file("a.bin")
+        self.assertEqual(7, len(calls))
+        self.assertFalse(main.SplitJournal.is_running(self.db_con, "SAE", "a.bin"))
+        self.assertEqual(6, len(os.listdir(self.dest_dir)))
+
+        main.SplitAndEncrypt(self.db_con, self.dest_dir, self.combo_dir, "k").decrypt_and_combo_dir([])
+        with open(os.path.join(self.combo_dir, "a.bin"), "rb") as f:
+            self.assertEqual(self.data, f.read())
+
+    # 片段记录中保存加密后片段的 crc32，片段被改动后不再解密合并
+    def test_checksum_mismatch_skipped(self):
+        main.SplitAndEncrypt(self.db_con, self.source_dir, self.dest_dir, "k", max_size=1000) \
+            .split_and_encrypt_file("a.bin")
+        parts = self.db_con.list_split_file_parts("split_file_info", 1)
+        self.assertTrue(all(part[8] is not None for part in parts))
+        part_path = os.path.join(self.dest_dir, sorted(os.listdir(self.dest_dir))[0])
+        with open(part_path, "r+b") as f:
+            f.write(b"x")
+        main.SplitAndEncrypt(self.db_con, self.dest_dir, self.combo_dir, "k").decrypt_and_combo_dir([])
+        self.assertFalse(os.path.exists(os.path.join(self.combo_dir, "a.bin")))
+
+
+class PlanFixedSizeSegmentsTest(unittest.TestCase):
+
+    # 每秒一个 100 字节的 packet，每 2 秒一个关键帧
+    def packets(self, count: int) -> list:
+        return [(float(i), 100, i % 2 == 0) for i in range(count)]
+
+    def test_cut_at_last_key_frame_under_budget(self):
+        segments = main.Spliter.plan_fixed_size_segments(self.packets(10), 0, 450, 10)
+        self.assertEqual([(0, 4.0), (4.0, 4.0), (8.0, 3.0)], segments)
+
+    def test_start_time(self):
+        segments = main.Spliter.plan_fixed_size_segments(self.packets(10), 4.0, 450, 10)
+        self.assertEqual([(4.0, 4.0), (8.0, 3.0)], segments)
+
+    # 单个 GOP 超过 budget 时切在下一个关键帧
+    def test_gop_larger_than_budget(self):
+        packets = [(float(i), 100, i % 4 == 0) for i in range(8)]
+        segments = main.Spliter.plan_fixed_size_segments(packets, 0, 250, 8)
+        self.assertEqual([(0, 4.0), (4.0, 5.0)], segments)
+
+    def test_whole_file_under_budget(self):
+        self.assertEqual([(0, 11)], main.Spliter.plan_fixed_size_segments(self.packets(10), 0, 5000, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
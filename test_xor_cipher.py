@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+
+
+class XorCipherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(3 * 1024 + 7)
+        self.expected = bytes(b ^ 0x5a for b in self.data)
+
+    def cipher_names(self) -> list:
+        return [name for name in main.XOR_CIPHERS if name != main.NumpyXorCipher.name or main.numpy is not None]
+
+    def test_xor_same_output(self):
+        for name in self.cipher_names():
+            with self.subTest(cipher=name):
+                self.assertEqual(self.expected, bytes(main.get_xor_cipher(name).xor(self.data, 0x5a)))
+
+    def test_xor_into_same_output(self):
+        for name in self.cipher_names():
+            with self.subTest(cipher=name):
+                buf = bytearray(self.data)
+                with memoryview(buf) as view:
+                    main.get_xor_cipher(name).xor_into(view, view, 0x5a)
+                self.assertEqual(self.expected, bytes(buf))
+
+    def test_unknown_cipher(self):
+        with self.assertRaises(ValueError):
+            main.get_xor_cipher("rot13")
+
+
+class MediaEncryptModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir_path, "a.bin")
+        self.data = os.urandom(100 * 1024 + 13)
+        with open(self.file_path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def encrypt(self, name: str, **kwargs) -> bytes:
+        e = main.MediaEncrypt(None, **kwargs)
+        e.parallel_chunk_size = 16 * 1024
+        output_file = os.path.join(self.dir_path, name)
+        e.encrypt_file("k", self.file_path, output_file, chunk_size=8 * 1024)
+        with open(output_file, "rb") as f:
+            return f.read()
+
+    # stream、mmap、按区间并行三种方式输出一致，且与逐字节异或结果相同
+    def test_io_modes_same_output(self):
+        expected = bytes(b ^ ord("k") for b in self.data)
+        self.assertEqual(expected, self.encrypt("stream"))
+        self.assertEqual(expected, self.encrypt("mmap", io_mode="mmap"))
+        self.assertEqual(expected, self.encrypt("thread", workers=3))
+        self.assertEqual(expected, self.encrypt("translate", cipher="translate"))
+
+    def test_decrypt_round_trip(self):
+        e = main.MediaEncrypt(None)
+        encrypt_file = os.path.join(self.dir_path, "a.enc")
+        decrypt_file = os.path.join(self.dir_path, "a.dec")
+        e.encrypt_file("k", self.file_path, encrypt_file)
+        e.decrypt_file("k", encrypt_file, decrypt_file)
+        with open(decrypt_file, "rb") as f:
+            self.assertEqual(self.data, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
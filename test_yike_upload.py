@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import main
+
+
+'''
+本地模拟的百度一刻接口，用于测试上传流程，不访问网络
+latency 为每次请求的往返时延(秒)，fail_times 为每个文件前几次上传失败的次数
+'''
+class FakeYiKeAlbum:
+    info: dict = None
+    items: list = None
+    append_calls: int = None
+    latency: float = None
+    lock = None
+
+    def __init__(self, title: str, latency: float = 0):
+        self.info = {"title": title}
+        self.items = []
+        self.append_calls = 0
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def append(self, items):
+        time.sleep(self.latency)
+        with self.lock:
+            self.append_calls += 1
+            self.items += items if isinstance(items, list) else [items]
+        return {"errno": 0}
+
+
+class FakeYiKeAPI:
+    albums: list = None
+    items: list = None
+    latency: float = None
+    fail_times: int = None
+    album_list_calls: int = None
+    attempts: dict = None
+    lock = None
+
+    def __init__(self, album_names: list = None, latency: float = 0.05, fail_times: int = 0):
+        self.latency = latency
+        self.fail_times = fail_times
+        self.albums = [FakeYiKeAlbum(name, latency) for name in (album_names or [])]
+        self.items = []
+        self.attempts = {}
+        self.album_list_calls = 0
+        self.lock = threading.Lock()
+
+    def getAlbumList_All(self, max=-1):
+        time.sleep(self.latency)
+        with self.lock:
+            self.album_list_calls += 1
+        return list(self.albums)
+
+    def upload_1file(self, filePath, album=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.attempts[filePath] = self.attempts.get(filePath, 0) + 1
+            if self.attempts[filePath] <= self.fail_times:
+                raise Exception("fake upload {} failed".format(filePath))
+            item = {"fsid": len(self.items) + 1, "path": filePath, "size": os.path.getsize(filePath)}
+            self.items.append(item)
+        if album is not None:
+            album.append(item)
+        return item
+
+
+class YiKeUploadEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.file_paths = []
+        for i in range(7):
+            file_path = os.path.join(self.dir_path, "f{}.bin".format(i))
+            with open(file_path, "wb") as f:
+                f.write(os.urandom(16))
+            self.file_paths.append(file_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_failed_upload_retried(self):
+        api = FakeYiKeAPI(latency=0, fail_times=2)
+        items = main.YiKeUploadEngine(api, 4, max_retries=3, backoff=0).upload_files(self.file_paths)
+        self.assertEqual(set(self.file_paths), set(items.keys()))
+        self.assertEqual({file_path: 3 for file_path in self.file_paths}, api.attempts)
+
+    def test_failed_upload_reported_after_retries(self):
+        api = FakeYiKeAPI(latency=0, fail_times=3)
+        with self.assertRaises(Exception) as cm:
+            main.YiKeUploadEngine(api, 4, max_retries=1, backoff=0).upload_files(self.file_paths)
+        self.assertIn("7 of 7 files upload failed", str(cm.exception))
+        self.assertEqual({file_path: 2 for file_path in self.file_paths}, api.attempts)
+
+    def test_album_list_fetched_once(self):
+        api = FakeYiKeAPI(["a", "b"], latency=0)
+        main.YiKeUploadEngine(api, 4, backoff=0).upload_files(self.file_paths, "b")
+        self.assertEqual(1, api.album_list_calls)
+
+    def test_album_append_batched(self):
+        api = FakeYiKeAPI(["a"], latency=0)
+        main.YiKeUploadEngine(api, 4, backoff=0, append_batch_size=3).upload_files(self.file_paths, "a")
+        album = api.albums[0]
+        self.assertEqual(3, album.append_calls)
+        self.assertEqual(set(self.file_paths), set(item["path"] for item in album.items))
+
+    def test_client_upload_dirs(self):
+        api = FakeYiKeAPI(["a"], latency=0)
+        thumb_dir_path = os.path.join(self.dir_path, "thumb")
+        client = main.YiKeClient(thumb_dir_path=thumb_dir_path, upload_workers=2, client=api)
+        client.upload_dirs(self.dir_path, [r"f0\.bin"], "a")
+        self.assertEqual(set(self.file_paths[1:]), set(item["path"] for item in api.albums[0].items))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,15 +3,12 @@
 import logging
 import os
 import sys
-import threading
 import uuid
-from concurrent import futures
 from typing import Optional, Callable, Any, Iterable, Mapping
 
 import vlc
 from main import DbCon
-import tempfile
-from main import MediaEncrypt
+from main import DecryptStreamServer
 
 # os.environ['PYTHON_VLC_MODULE_PATH'] = "C:\Program Files\VideoLAN\VLC"
 
@@ -125,6 +122,8 @@ class Player:
     vlc_player = None
     name = None
     log = None
+    stream_server = None
+    stream_url = None
 
     def __init__(self, player=VlcPlayer(), db_path="meta.db"):
         self.vlc_player = player
@@ -141,35 +140,32 @@ class Player:
     def get_source_file_meta(self, source_file_name):
         return self.db.get_meta_by_new_name(source_file_name)
 
+    # 返回本地解密流地址，vlc 按需读取区间并解密，不再写临时明文文件。只保留当前播放的流
     def decode(self, media_path, key):
-        class DecodeThread(threading.Thread):
-
-            db = None
-            dest_file = None
-            source_file = None
-            key = None
-
-            def __init__(self, db, dest_file, source_file, key):
-                super().__init__()
-                self.db = db
-                self.dest_file = dest_file
-                self.source_file = source_file
-                self.key = key
-
-            def run(self):
-                decoder = MediaEncrypt(self.db)
-                decoder.decrypt_file(self.key, self.source_file, self.dest_file, 1024 * 512)
-
-        tf = tempfile.NamedTemporaryFile('w+b')
-        futures.Executor()
-        decode_thread = DecodeThread(self.db, tf.name, media_path, key)
-        decode_thread.start()
-        # decode_thread.join()
-        return tf.name
-
+        if self.stream_server is None:
+            self.stream_server = DecryptStreamServer()
+            self.stream_server.start()
+        self.release_stream()
+        self.stream_url = self.stream_server.add_stream(key, [media_path])
+        return self.stream_url
+
+    # 注销当前播放的解密流
+    def release_stream(self, event=None):
+        if self.stream_url is not None:
+            self.stream_server.remove_stream(self.stream_url)
+            self.stream_url = None
+
+    # 播放停止或结束时注销解密流
     def play_encoded_media(self, encoded_media_path, key):
         decoded_media_path = self.decode(encoded_media_path, key)
-        self.play(decoded_media_path)
+        self.vlc_player.add_callback(vlc.EventType.MediaPlayerStopped, self.release_stream)
+        self.vlc_player.add_callback(vlc.EventType.MediaPlayerEndReached, self.release_stream)
+        try:
+            self.play(decoded_media_path)
+        finally:
+            self.vlc_player.remove_callback(vlc.EventType.MediaPlayerStopped, self.release_stream)
+            self.vlc_player.remove_callback(vlc.EventType.MediaPlayerEndReached, self.release_stream)
+            self.release_stream()
 
     def play(self, media_path):
         def my_call_back(event):